@@ -5,9 +5,11 @@ import numpy as np
 
 import oggm
 from oggm import cfg, tasks
-from oggm.core.climate import (local_t_star, mu_star_calibration, t_star_from_refmb)
-from oggm.core.inversion import (mass_conservation_inversion)
+from oggm.core.climate import (local_t_star, mu_star_calibration)
 from gmd_analysis_scripts import PLOT_DIR
+from gmd_cluster_scripts.inversion import (mass_conservation_inversion_multi,
+                                           calibrate_glacier_glen_a)
+from gmd_cluster_scripts.calibration import prcp_factor_inversion_sweep
 from oggm.utils import get_rgi_glacier_entities, mkdir, get_rgi_intersects_entities
 
 fig_path = os.path.join(PLOT_DIR, 'hef_inv.pdf')
@@ -39,64 +41,50 @@ tasks.prepare_for_inversion(gdir)
 
 
 facs = np.append((np.arange(9)+1)*0.1, (np.arange(19)+2) * 0.5)
-vols1 = facs * 0.
-vols2 = facs * 0.
-vols3 = facs * 0.
-vols4 = facs * 0.
-vols5 = facs * 0.
-vols6 = facs * 0.
-vols7 = facs * 0.
-vols8 = facs * 0.
 
 glen_a = cfg.PARAMS['glen_a']
 fs = 5.7e-20
-for i, f in enumerate(facs):
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a*f)
-    vols1[i] = v * 1e-9
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a*f, fs=fs*0.5)
-    vols2[i] = v * 1e-9
-    v, a = mass_conservation_inversion(gdir, glen_a=glen_a*f, fs=fs)
-    vols3[i] = v * 1e-9
 
+# All A factors at once
+out = mass_conservation_inversion_multi(gdir, facs, glen_a=glen_a,
+                                        fs=[0., fs*0.5, fs])
+vols1, vols2, vols3 = out['volume'] * 1e-9
+a = out['area']
 
-cfg.PARAMS['use_shape_factor_for_inversion'] = 'Adhikari'
+# The A factor matching the volume of Fischer et al.
+v_fischer = 0.573
+a_fischer = calibrate_glacier_glen_a(gdir, v_fischer, glen_a=glen_a, fs=0.)
+print('A factor for Fischer et al.: {:.2f}'.format(a_fischer / glen_a))
 
-for i, f in enumerate(facs):
-    # Adhikari
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a*f)
-    vols4[i] = v * 1e-9
+cfg.PARAMS['use_shape_factor_for_inversion'] = 'Adhikari'
 
+# Adhikari
+out = mass_conservation_inversion_multi(gdir, facs, glen_a=glen_a, fs=0.)
+vols4 = out['volume'][0] * 1e-9
 
 tasks.prepare_for_inversion(gdir, invert_with_rectangular=False)
-for i, f in enumerate(facs):
-    # Parab
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a * f)
-    vols5[i] = v * 1e-9
+# Parab
+out = mass_conservation_inversion_multi(gdir, facs, glen_a=glen_a, fs=0.)
+vols5 = out['volume'][0] * 1e-9
 
 tasks.prepare_for_inversion(gdir, invert_all_rectangular=True)
-
-for i, f in enumerate(facs):
-    # Rect
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a * f)
-    vols6[i] = v * 1e-9
+# Rect
+out = mass_conservation_inversion_multi(gdir, facs, glen_a=glen_a, fs=0.)
+vols6 = out['volume'][0] * 1e-9
 
 cfg.PARAMS['use_shape_factor_for_inversion'] = None
 
-for i, f in enumerate(facs):
-    # Rect no fac
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a * f)
-    vols7[i] = v * 1e-9
+# Rect no fac
+out = mass_conservation_inversion_multi(gdir, facs, glen_a=glen_a, fs=0.)
+vols7 = out['volume'][0] * 1e-9
 
 tasks.prepare_for_inversion(gdir, invert_with_rectangular=False)
-
-for i, f in enumerate(facs):
-    # Parab no fac
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a * f)
-    vols8[i] = v * 1e-9
+# Parab no fac
+out = mass_conservation_inversion_multi(gdir, facs, glen_a=glen_a, fs=0.)
+vols8 = out['volume'][0] * 1e-9
 
 
 v_vas = 0.034*((a*1e-6)**1.375)
-v_fischer = 0.573
 
 tx, ty = 0.02, .979
 letkm = dict(color='black', ha='left', va='top', fontsize=12,
@@ -130,26 +118,12 @@ ax1.text(tx, ty, 'a', transform=ax1.transAxes, **letkm)
 ax1.legend(loc=1)
 
 facs = np.arange(0.5, 5.01, 0.1)
-vols1 = facs * 0.
-vols2 = facs * 0.
-vols3 = facs * 0.
-
-for i, f in enumerate(facs):
-    cfg.PARAMS['prcp_scaling_factor'] = f
-    mbdf = gdir.get_ref_mb_data()
-    res = t_star_from_refmb(gdir, mbdf=mbdf.ANNUAL_BALANCE)
-    local_t_star(gdir, tstar=res['t_star'], bias=res['bias'])
-    mu_star_calibration(gdir)
-    tasks.prepare_for_inversion(gdir)
-
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a)
-    vols1[i] = v * 1e-9
-
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a*2)
-    vols2[i] = v * 1e-9
-
-    v, _ = mass_conservation_inversion(gdir, glen_a=glen_a*4)
-    vols3[i] = v * 1e-9
+
+# All precipitation factors at once: default A, 2 A, 4 A
+mbdf = gdir.get_ref_mb_data()
+out = prcp_factor_inversion_sweep(gdir, facs, [1, 2, 4], glen_a=glen_a, fs=0.,
+                                  mbdf=mbdf.ANNUAL_BALANCE)
+vols1, vols2, vols3 = out['volume'].T * 1e-9
 
 
 ax2.plot(facs, vols1, label='Default A', color=cs[0], linewidth=lw, alpha=alpha)
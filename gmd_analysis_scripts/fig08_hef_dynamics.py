@@ -8,6 +8,10 @@ import oggm
 from oggm import cfg, tasks
 from oggm import utils
 from gmd_analysis_scripts import PLOT_DIR
+from gmd_cluster_scripts.params import ParamsContext
+from gmd_cluster_scripts.dynamics import run_constant_climate
+from gmd_cluster_scripts.runoutput import SteadyState
+from gmd_cluster_scripts.scheduling import execute_entity_task_sweep
 from oggm.utils import get_rgi_glacier_entities, get_rgi_intersects_entities, mkdir
 
 fig_path = os.path.join(PLOT_DIR, 'hef_dyns.pdf')
@@ -52,37 +56,28 @@ glen_a = cfg.PARAMS['glen_a']
 fs = 5.7e-20
 nyears = 800
 
-tasks.run_random_climate(gdir, nyears=nyears, bias=0, seed=seed,
-                         output_filesuffix='_fromzero_def', reset=reset,
-                         zero_initial_glacier=True)
-
-tasks.run_constant_climate(gdir, nyears=nyears, bias=0,
-                           output_filesuffix='_fromzero_ct', reset=reset,
-                           zero_initial_glacier=True)
-
-cfg.PARAMS['fs'] = fs * 0.5
-tasks.run_random_climate(gdir, nyears=nyears, bias=0, seed=seed,
-                         output_filesuffix='_fromzero_fs', reset=reset,
-                         zero_initial_glacier=True)
-
-cfg.PARAMS['fs'] = 0
-cfg.PARAMS['glen_a'] = glen_a*2
-tasks.run_random_climate(gdir, nyears=nyears, bias=0, seed=seed,
-                         output_filesuffix='_fromzero_2A', reset=reset,
-                         zero_initial_glacier=True)
-
-cfg.PARAMS['fs'] = 0
-cfg.PARAMS['glen_a'] = glen_a/2
-tasks.run_random_climate(gdir, nyears=nyears, bias=0, seed=seed,
-                         output_filesuffix='_fromzero_halfA', reset=reset,
-                         zero_initial_glacier=True)
-
-cfg.PARAMS['fs'] = fs * 0.
-cfg.PARAMS['glen_a'] = glen_a
-cfg.PARAMS['use_shape_factor_for_fluxbasedmodel'] = "Adhikari"
-tasks.run_random_climate(gdir, nyears=nyears, bias=0, seed=seed,
-                         output_filesuffix='_fromzero_drag', reset=reset,
-                         zero_initial_glacier=True)
+# The constant climate run stops (and stays) at equilibrium
+run_constant_climate(gdir, nyears=nyears, bias=0,
+                     output_filesuffix='_fromzero_ct', reset=reset,
+                     zero_initial_glacier=True,
+                     steady_state=SteadyState(window=50, rtol=1e-3))
+
+# The random climate runs, each with its own parameters, all at once
+sweep = [
+    dict(output_filesuffix='_fromzero_def'),
+    dict(output_filesuffix='_fromzero_fs',
+         params=ParamsContext(fs=fs*0.5)),
+    dict(output_filesuffix='_fromzero_2A',
+         params=ParamsContext(fs=0, glen_a=glen_a*2)),
+    dict(output_filesuffix='_fromzero_halfA',
+         params=ParamsContext(fs=0, glen_a=glen_a/2)),
+    dict(output_filesuffix='_fromzero_drag',
+         params=ParamsContext(fs=0, glen_a=glen_a,
+                              use_shape_factor_for_fluxbasedmodel='Adhikari')),
+]
+execute_entity_task_sweep(tasks.run_random_climate, [gdir], sweep,
+                          nyears=nyears, bias=0, seed=seed, reset=reset,
+                          zero_initial_glacier=True)
 
 
 f = gdir.get_filepath('model_diagnostics', filesuffix='_fromzero_def')
@@ -0,0 +1,5 @@
+"""Shared helpers for the GMD cluster runs.
+
+The run scripts in the sub-directories are executed from their own folder,
+so the slurm scripts add the repository root to the ``PYTHONPATH``.
+"""
@@ -0,0 +1,724 @@
+"""Lockstep flowline model for many small glaciers at once.
+
+Most glaciers of a region have a few short flowlines with a few dozen grid
+points, so that ``FluxBasedModel`` spends its time in the Python overhead of
+each time step rather than in the numpy operations. :py:class:`BatchFluxModel`
+solves the same equations for a batch of glaciers (or of scenarios of the
+same glaciers):
+
+- the flowlines of all glaciers are packed as the rows of padded 2-D arrays
+  (masked after the last grid point of each row), with the tributary
+  junctions as index arrays
+- all glaciers advance with the same adaptive time step (the smallest of
+  their CFL time steps, as ``FluxBasedModel`` does for the flowlines of one
+  glacier)
+- a glacier is retired from the batch when it reaches its last year (its
+  output is written), or when it would need a time step below ``min_dt``
+  or fails the domain and NaN checks. The failed glaciers are run again on
+  their own, with the numerical fallbacks of ``run_random_climate``.
+
+The output files (``model_run`` and ``model_diagnostics``) have the same
+format as those of ``run_until_and_store``, or the diagnostics go to a
+region-level accumulator (:py:mod:`~gmd_cluster_scripts.runoutput`). The
+mass-balance is updated once per year (``mb_elev_feedback='annual'``, the
+default), and the shape factors of the flux-based model are not supported:
+glaciers which need them, tidewater glaciers and the largest glaciers are run
+as usual (:py:func:`execute_random_climate_batched`).
+
+The results differ from the single glacier runs by the time steps only.
+"""
+# Built ins
+import logging
+
+# External libs
+import numpy as np
+
+# Locals
+import oggm.cfg as cfg
+from oggm import utils, workflow
+from oggm.cfg import (SEC_IN_DAY, SEC_IN_YEAR, SEC_IN_HOUR, TWO_THIRDS, RHO,
+                      G, N, GAUSSIAN_KERNEL)
+from oggm.core.flowline import FluxBasedModel, MixedBedFlowline
+from gmd_cluster_scripts.dynamics import (run_random_climate_ensemble,
+                                          random_mb_model, scenario_defaults)
+from gmd_cluster_scripts.runoutput import (diag_dataset, write_run,
+                                           yearly_volume, yearly_diagnostics,
+                                           _flowline_params)
+from gmd_cluster_scripts.scheduling import execute_entity_task
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# The default size of the batches and largest glacier to batch
+BATCH_SIZE = 200
+MAX_AREA_KM2 = 5.
+
+
+def _trib_kernel(nx_to, ide):
+    """The grid points and weights of a tributary junction."""
+    for n in [9, 7, 5]:
+        if nx_to >= n:
+            ids = np.arange(ide - n // 2, ide + n // 2 + 1)
+            if ids[0] < 0 or ids[-1] >= nx_to:
+                # FluxBasedModel does not support it either
+                raise ValueError('tributary junction too close to the end '
+                                 'of the flowline')
+            return ids, GAUSSIAN_KERNEL[n]
+    raise ValueError('flowline too short for a tributary')
+
+
+def _batchable(fls):
+    """Whether the flowlines of a glacier can be run in a batch."""
+    if not all(isinstance(fl, MixedBedFlowline) for fl in fls):
+        return False
+    for fl in fls:
+        if fl.flows_to is not None:
+            try:
+                _trib_kernel(fl.flows_to.nx, fl.flows_to_indice)
+            except ValueError:
+                return False
+    return True
+
+
+class BatchFluxModel(object):
+    """Same as ``FluxBasedModel``, for a batch of glaciers.
+
+    Parameters
+    ----------
+    models : list of FluxBasedModel
+        one model per glacier, used for their flowlines, mass-balance model,
+        glen_a and fs (the models are not run, and their flowlines are
+        modified in place at the end of the run)
+    y0 : float
+        the starting year of the simulations
+    cfl_number, min_dt, max_dt : float
+        the time stepping parameters, as for ``FluxBasedModel``
+    """
+
+    def __init__(self, models, y0=0., cfl_number=0.05, min_dt=SEC_IN_HOUR,
+                 max_dt=10*SEC_IN_DAY):
+
+        self.models = models
+        self.y0 = y0
+        self.t = 0.
+        self.cfl_number = cfl_number
+        self.min_dt = min_dt
+        self.max_dt = max_dt
+
+        # One row per flowline
+        rows = []
+        for i, model in enumerate(models):
+            r0 = len(rows)
+            for k, fl in enumerate(model.fls):
+                to = -1
+                if fl.flows_to is not None:
+                    to = r0 + model.fls.index(fl.flows_to)
+                rows.append((i, k, fl, to))
+        self.nrows = len(rows)
+        self.width = max(fl.nx for _, _, fl, _ in rows)
+        shape = (self.nrows, self.width)
+
+        self.item = np.array([r[0] for r in rows])
+        self.fl_id = np.array([r[1] for r in rows])
+        self.nx = np.array([r[2].nx for r in rows])
+        self.dx = np.array([r[2].dx_meter for r in rows])
+        self.fd = np.array([2. / (N+2) * models[i].glen_a for i in self.item])
+        self.fs = np.array([models[i].fs for i in self.item])
+        self.mask = np.arange(self.width) < self.nx[:, np.newaxis]
+        # The staggered grid has one more point, up to nx included
+        self.stag_mask = np.arange(self.width + 1) <= self.nx[:, np.newaxis]
+
+        self.bed_h = np.zeros(shape)
+        self.thick = np.zeros(shape)
+        self.bed_shape = np.ones(shape)
+        self.w0 = np.ones(shape)
+        self.lambdas = np.zeros(shape)
+        self.is_trap = np.zeros(shape, dtype=bool)
+        for r, (_, _, fl, _) in enumerate(rows):
+            n = fl.nx
+            self.bed_h[r, :n] = fl.bed_h
+            self.thick[r, :n] = fl.thick
+            trap = fl.is_trapezoid
+            self.is_trap[r, :n] = trap
+            self.bed_shape[r, :n][~trap] = fl.bed_shape[~trap]
+            self.w0[r, :n][trap] = fl._w0_m[trap]
+            self.lambdas[r, :n][trap] = fl._lambdas[trap]
+        self.is_rect = self.is_trap & (self.lambdas == 0)
+        self.is_lambda = self.is_trap & ~self.is_rect
+        self._sqrt_bed = np.sqrt(self.bed_shape)
+
+        # Tributaries: their last point flows into a Gaussian window
+        self.trib = np.array([r for r, row in enumerate(rows) if row[3] >= 0],
+                             dtype=int)
+        self.main = np.array([r for r, row in enumerate(rows) if row[3] < 0],
+                             dtype=int)
+        self.trib_to = np.array([rows[r][3] for r in self.trib], dtype=int)
+        self.trib_ide = np.array([rows[r][2].flows_to_indice
+                                  for r in self.trib], dtype=int)
+        src, idx, wgt = [], [], []
+        for j, (r, to, ide) in enumerate(zip(self.trib, self.trib_to,
+                                             self.trib_ide)):
+            ids, gk = _trib_kernel(self.nx[to], ide)
+            src.extend([j] * len(ids))
+            idx.extend(to * self.width + ids)
+            wgt.extend(gk)
+        self._trib_src = np.array(src, dtype=int)
+        self._trib_idx = np.array(idx, dtype=int)
+        self._trib_wgt = np.array(wgt, dtype=float)
+
+        # The last flowline of each glacier
+        self.last = np.array([np.nonzero(self.item == i)[0][-1]
+                              for i in range(len(models))])
+
+        # The mass-balance of the current year
+        self.mb = np.zeros(shape)
+        self._mb_year = None
+
+    @property
+    def yr(self):
+        return self.y0 + self.t / SEC_IN_YEAR
+
+    @property
+    def surface_h(self):
+        return self.bed_h + self.thick
+
+    @property
+    def widths_m(self):
+        w = np.sqrt(4 * self.thick / self.bed_shape)
+        return np.where(self.is_trap, self.w0 + self.lambdas * self.thick, w)
+
+    @property
+    def section(self):
+        w = self.widths_m
+        return np.where(self.is_trap, (w + self.w0) / 2 * self.thick,
+                        TWO_THIRDS * w * self.thick)
+
+    @section.setter
+    def section(self, val):
+        out = (0.75 * val * self._sqrt_bed)**TWO_THIRDS
+        b = 2 * self.w0
+        a = np.where(self.is_lambda, 2 * self.lambdas, 1.)
+        out = np.where(self.is_lambda, (np.sqrt(b**2 + 4*a*val) - b) / a, out)
+        out = np.where(self.is_rect, val / self.w0, out)
+        self.thick = np.where(self.mask, out, 0.).clip(0)
+
+    def _per_item(self, values):
+        """Sum of the row values per glacier."""
+        return np.bincount(self.item, weights=values,
+                           minlength=len(self.models))
+
+    @property
+    def volume_m3(self):
+        return self._per_item(np.sum(self.section, axis=1) * self.dx)
+
+    @property
+    def area_m2(self):
+        widths = np.where(self.thick > 0., self.widths_m, 0.)
+        return self._per_item(np.sum(widths, axis=1) * self.dx)
+
+    @property
+    def length_m(self):
+        last = self.last
+        return np.sum(self.thick[last] > 0., axis=1) * self.dx[last]
+
+    def _update_mb(self):
+        """The mass-balance is computed once a year, as in FlowlineModel."""
+        year = utils.floatyear_to_date(self.yr)[0]
+        if year == self._mb_year:
+            return
+        self._mb_year = year
+        surface_h = self.surface_h
+        for r in range(self.nrows):
+            model = self.models[self.item[r]]
+            n = self.nx[r]
+            self.mb[r, :n] = model.mb_model.get_annual_mb(surface_h[r, :n],
+                                                          year=self.yr,
+                                                          fl_id=self.fl_id[r])
+
+    def _fluxes(self):
+        """The staggered velocities and fluxes."""
+
+        rows = np.arange(self.nrows)
+        nx = self.nx
+        surface_h = self.surface_h
+        thick = self.thick
+        section = self.section
+
+        # The grid point after the last one: on the downstream flowline for
+        # the tributaries, the same thickness and section
+        ext = self.width + 1
+        s_ext = np.zeros((self.nrows, ext))
+        s_ext[:, :-1] = surface_h
+        s_ext[self.trib, nx[self.trib]] = surface_h[self.trib_to,
+                                                    self.trib_ide]
+        t_ext = np.zeros((self.nrows, ext))
+        t_ext[:, :-1] = thick
+        t_ext[rows, nx] = thick[rows, nx - 1]
+        a_ext = np.zeros((self.nrows, ext))
+        a_ext[:, :-1] = section
+        a_ext[rows, nx] = section[rows, nx - 1]
+
+        slope_stag = np.zeros((self.nrows, ext))
+        slope_stag[:, 1:] = (s_ext[:, :-1] - s_ext[:, 1:]) / \
+            self.dx[:, np.newaxis]
+        slope_stag[self.main, nx[self.main]] = \
+            slope_stag[self.main, nx[self.main] - 1]
+
+        thick_stag = np.zeros((self.nrows, ext))
+        thick_stag[:, 1:] = (t_ext[:, :-1] + t_ext[:, 1:]) / 2.
+        thick_stag[:, 0] = thick[:, 0]
+        section_stag = np.zeros((self.nrows, ext))
+        section_stag[:, 1:] = (a_ext[:, :-1] + a_ext[:, 1:]) / 2.
+        section_stag[:, 0] = section[:, 0]
+
+        rhogh = (RHO*G*slope_stag)**N
+        u_stag = (thick_stag**(N+1)) * self.fd[:, np.newaxis] * rhogh + \
+                 (thick_stag**(N-1)) * self.fs[:, np.newaxis] * rhogh
+        u_stag = np.where(self.stag_mask, u_stag, 0.)
+        flx_stag = u_stag * section_stag / self.dx[:, np.newaxis]
+        return u_stag, flx_stag, section
+
+    def _cfl_dt(self, u_stag):
+        """The CFL time step of each glacier."""
+        maxu = np.max(np.abs(u_stag), axis=1)
+        with np.errstate(divide='ignore'):
+            dt = np.where(maxu > 0., self.cfl_number * self.dx / maxu,
+                          self.max_dt)
+        out = np.full(len(self.models), np.inf)
+        np.minimum.at(out, self.item, dt)
+        return out
+
+    def step(self, dt):
+        """Advance one step, or return the glaciers which can't.
+
+        Returns
+        -------
+        (dt, slow): the time step, and the indices of the glaciers which
+        would need a time step below ``min_dt`` (nothing is done if any)
+        """
+
+        # This is to guarantee a precise arrival on a specific date if asked
+        min_dt = dt if dt < self.min_dt else self.min_dt
+
+        u_stag, flx_stag, section = self._fluxes()
+        item_dt = np.minimum(self._cfl_dt(u_stag), dt)
+        slow = np.nonzero(item_dt < min_dt)[0]
+        if len(slow) > 0:
+            return 0., slow
+        dt = np.clip(np.min(item_dt), min_dt, self.max_dt)
+
+        # Mass balance, allowing parabolic beds to grow
+        self._update_mb()
+        widths = self.widths_m
+        widths = np.where((self.mb > 0.) & (widths == 0), 10., widths)
+
+        # Tributary fluxes
+        aflx = np.zeros(self.nrows * self.width)
+        if len(self.trib) > 0:
+            out_flx = flx_stag[self.trib, self.nx[self.trib]].clip(0)
+            np.add.at(aflx, self._trib_idx,
+                      out_flx[self._trib_src] * self._trib_wgt)
+        aflx = aflx.reshape(self.nrows, self.width)
+
+        new_section = section + (flx_stag[:, :-1] - flx_stag[:, 1:]) * dt + \
+            aflx * dt + dt * self.mb * widths
+        self.section = new_section.clip(0)
+        self.t += dt
+        return dt, slow
+
+    def run_until(self, y1):
+        """Run all glaciers until ``y1``.
+
+        Returns
+        -------
+        the indices of the glaciers which can't be run in the batch (the
+        others are not run in this case)
+        """
+        t = (y1 - self.y0) * SEC_IN_YEAR
+        while self.t < t:
+            _, slow = self.step(t - self.t)
+            if len(slow) > 0:
+                return slow
+
+        # Check for domain bounds and NaNs
+        last = self.last
+        finite = self._per_item(np.isfinite(self.thick).all(axis=1) * 1.)
+        bad = self.thick[last, self.nx[last] - 1] > 10
+        bad |= finite < self._per_item(np.ones(self.nrows))
+        return np.nonzero(bad)[0]
+
+    def keep(self, items):
+        """Remove all glaciers but ``items`` from the batch (in place)."""
+
+        items = np.asarray(items, dtype=int)
+        new_index = -np.ones(len(self.models), dtype=int)
+        new_index[items] = np.arange(len(items))
+        rows = np.nonzero(new_index[self.item] >= 0)[0]
+        new_row = -np.ones(self.nrows, dtype=int)
+        new_row[rows] = np.arange(len(rows))
+
+        # Tributaries (a tributary and its flowline belong to one glacier)
+        ktrib = new_row[self.trib] >= 0
+        old_trib = np.nonzero(ktrib)[0]
+        new_trib = -np.ones(len(self.trib), dtype=int)
+        new_trib[old_trib] = np.arange(len(old_trib))
+        ksrc = new_trib[self._trib_src] >= 0
+        self._trib_src = new_trib[self._trib_src[ksrc]]
+        old_idx = self._trib_idx[ksrc]
+        self._trib_idx = (new_row[old_idx // self.width] * self.width +
+                          old_idx % self.width)
+        self._trib_wgt = self._trib_wgt[ksrc]
+        self.trib = new_row[self.trib[ktrib]]
+        self.trib_to = new_row[self.trib_to[ktrib]]
+        self.trib_ide = self.trib_ide[ktrib]
+        self.main = new_row[self.main[new_row[self.main] >= 0]]
+
+        for name in ['fl_id', 'nx', 'dx', 'fd', 'fs', 'mask', 'stag_mask',
+                     'bed_h', 'thick', 'bed_shape', 'w0', 'lambdas',
+                     'is_trap', 'is_rect', 'is_lambda', '_sqrt_bed', 'mb']:
+            setattr(self, name, getattr(self, name)[rows])
+        self.item = new_index[self.item[rows]]
+        self.last = new_row[self.last[items]]
+        self.models = [self.models[i] for i in items]
+        self.nrows = len(rows)
+
+    def to_flowlines(self):
+        """Write the current thickness to the flowlines of the models."""
+        for r in range(self.nrows):
+            fl = self.models[self.item[r]].fls[self.fl_id[r]]
+            fl.thick = self.thick[r, :self.nx[r]].copy()
+
+
+def run_until_and_store(batch, y1s, run_paths=None, diag_paths=None,
+                        steady_state=None, sinks=None, retired=None):
+    """Same as ``FlowlineModel.run_until_and_store``, for a batch.
+
+    Parameters
+    ----------
+    batch : BatchFluxModel
+        the batch to run (glaciers are removed from it as they finish)
+    y1s : array-like
+        the end year of each glacier
+    run_paths, diag_paths : list of str
+        where to write the model run and diagnostics of each glacier (None
+        for no file)
+    steady_state : SteadyState
+        retire the glaciers which reach steady state (see
+        :py:mod:`~gmd_cluster_scripts.runoutput`)
+    sinks : list of callables
+        called with the yearly diagnostics of each glacier at the end of its
+        run (None for no call). Without any file to write, the glaciers are
+        stored yearly and without ELA.
+    retired : list
+        the indices of the glaciers whose output is written are appended to
+        it as they finish, so that the caller knows which ones are done if
+        the run raises
+
+    Returns
+    -------
+    the indices of the glaciers (in the initial batch) which could not be
+    run in the batch
+    """
+
+    n = len(batch.models)
+    y1s = np.asarray(y1s, dtype=float)
+    run_paths = run_paths or [None] * n
+    diag_paths = diag_paths or [None] * n
+    sinks = sinks or [None] * n
+    for model, run_path in zip(batch.models, run_paths):
+        if run_path is not None:
+            model.to_netcdf(run_path)
+
+    # time
+    monthly = any(p is not None for p in run_paths + diag_paths)
+    yearly_times = [np.arange(np.floor(batch.yr), np.floor(y1)+1)
+                    for y1 in y1s]
+    if monthly:
+        times = utils.monthly_timeseries(batch.yr, np.max(y1s))
+        nms = [len(utils.monthly_timeseries(batch.yr, y1)) for y1 in y1s]
+    else:
+        times = yearly_times[int(np.argmax(y1s))]
+        nms = [len(yt) for yt in yearly_times]
+    yrs, months = utils.floatyear_to_date(times)
+
+    # init output
+    names = ['volume_m3', 'area_m2', 'length_m']
+    if monthly:
+        names.append('ela_m')
+    diags = [{k: np.zeros(nm) * np.nan for k in names} for nm in nms]
+    sects = [[np.zeros((len(yt), fl.nx)) * np.nan for fl in model.fls]
+             for yt, model in zip(yearly_times, batch.models)]
+    widths = [[np.zeros((len(yt), fl.nx)) * np.nan for fl in model.fls]
+              for yt, model in zip(yearly_times, batch.models)]
+
+    # Run
+    active = np.arange(n)
+    failed = []
+    j = 0
+    for i, (yr, mo) in enumerate(zip(times, months)):
+        while True:
+            bad = batch.run_until(yr)
+            if len(bad) == 0:
+                break
+            failed.extend(active[bad])
+            keep = np.setdiff1d(np.arange(len(active)), bad)
+            batch.keep(keep)
+            active = active[keep]
+            if len(active) == 0:
+                return np.sort(failed)
+
+        # Model run
+        if mo == 1 and monthly:
+            section = batch.section
+            widths_m = batch.widths_m
+            for r in range(batch.nrows):
+                g = active[batch.item[r]]
+                nx = batch.nx[r]
+                sects[g][batch.fl_id[r]][j, :] = section[r, :nx]
+                widths[g][batch.fl_id[r]][j, :] = widths_m[r, :nx]
+        if mo == 1:
+            j += 1
+        # Diagnostics
+        for name, values in [('volume_m3', batch.volume_m3),
+                             ('area_m2', batch.area_m2),
+                             ('length_m', batch.length_m)]:
+            for k, g in enumerate(active):
+                diags[g][name][i] = values[k]
+        if monthly:
+            for k, g in enumerate(active):
+                diags[g]['ela_m'][i] = batch.models[k].mb_model.get_ela(
+                    year=yr)
+
+        # Retire the glaciers which are done, or in steady state
+        done = np.array([nms[g] == i + 1 for g in active])
+        stops = dict()
+        if steady_state is not None and mo == 1:
+            for k, g in enumerate(active):
+                if (not done[k] and steady_state.converged(
+                        yearly_volume(diags[g], months, i))):
+                    std = steady_state.fill(diags[g], i, sects[g],
+                                            widths[g], j,
+                                            per_year=12 if monthly else 1)
+                    stops[g] = (yr, std)
+                    done[k] = True
+        done = np.nonzero(done)[0]
+        if len(done) == 0:
+            continue
+        batch.to_flowlines()
+        for k in done:
+            g = active[k]
+            if run_paths[g] is not None:
+                write_run(run_paths[g], yearly_times[g], sects[g],
+                          widths[g])
+            if diag_paths[g] is not None:
+                diag_ds = diag_dataset(times[:nms[g]], yrs[:nms[g]],
+                                       months[:nms[g]], diags[g])
+                if g in stops:
+                    steady_state.annotate(diag_ds, *stops[g])
+                diag_ds.to_netcdf(diag_paths[g])
+            if sinks[g] is not None:
+                sinks[g](yearly_diagnostics(diags[g], months[:nms[g]]))
+            if retired is not None:
+                retired.append(g)
+        keep = np.setdiff1d(np.arange(len(active)), done)
+        if len(keep) == 0:
+            break
+        batch.keep(keep)
+        active = active[keep]
+
+    return np.sort(failed)
+
+
+def run_random_climate_batch(items, nyears=1000, y0=None, halfsize=15,
+                             bias=None, climate_filename='climate_monthly',
+                             climate_input_filesuffix='',
+                             zero_initial_glacier=False, steady_state=None,
+                             accumulator=None, **kwargs):
+    """Run random climate scenarios for a batch of glaciers, in lockstep.
+
+    The glaciers which can't be run in the batch (and, if the batch itself
+    fails, those which were not done yet) are run again one by one with
+    :py:func:`~gmd_cluster_scripts.dynamics.run_random_climate_ensemble`,
+    which falls back to the conservative time stepping if needed.
+
+    Parameters
+    ----------
+    items : list of (GlacierDirectory, dict) tuples
+        the glaciers and the arguments of their scenario (see
+        :py:data:`~gmd_cluster_scripts.dynamics.SCENARIO_KEYS`)
+    nyears, y0, halfsize, bias, climate_filename, climate_input_filesuffix,
+    zero_initial_glacier :
+        as for ``run_random_climate``
+    steady_state : SteadyState
+        stop the runs which reach steady state (see
+        :py:mod:`~gmd_cluster_scripts.runoutput`)
+    accumulator : RunOutputAccumulator
+        write the diagnostics there instead of the glacier directories
+    **kwargs :
+        ``glen_a`` and ``fs`` (default: as for ``run_random_climate``)
+    """
+
+    models = []
+    paths = []
+    ok_items = []
+    solo = []
+    # The scenarios of a glacier with the same climate period share their
+    # mass-balance tables
+    tables = dict()
+    for gdir, scenario in items:
+        s = scenario_defaults(y0=y0, halfsize=halfsize, bias=bias)
+        s.update(scenario)
+        task_name = 'run_random_climate' + s['output_filesuffix']
+        try:
+            fls = gdir.read_pickle('model_flowlines')
+            if not _batchable(fls):
+                solo.append((gdir, scenario))
+                continue
+            if zero_initial_glacier:
+                for fl in fls:
+                    fl.thick = fl.thick * 0.
+            key = (gdir.rgi_id, s['y0'], s['halfsize'], s['bias'])
+            mb = random_mb_model(gdir, s, climate_filename,
+                                 climate_input_filesuffix, fls=fls,
+                                 tables=tables.setdefault(key, dict()))
+            glen_a, fs = _flowline_params(gdir, kwargs)
+            models.append(FluxBasedModel(fls, mb_model=mb, y0=0.,
+                                         glen_a=glen_a, fs=fs))
+        except Exception as err:
+            log.warning('(%s) %s failed: %s', gdir.rgi_id, task_name, err)
+            gdir.log(task_name, err=err)
+            continue
+        fsuf = s['output_filesuffix']
+        if accumulator is None:
+            paths.append((gdir.get_filepath('model_run', filesuffix=fsuf,
+                                            delete=True),
+                          gdir.get_filepath('model_diagnostics',
+                                            filesuffix=fsuf, delete=True),
+                          None))
+        else:
+            paths.append((None, None, accumulator.sink(gdir.rgi_id, fsuf)))
+        ok_items.append((gdir, scenario, task_name))
+
+    failed = []
+    retired = []
+    if len(models) > 0:
+        try:
+            batch = BatchFluxModel(models)
+            failed = run_until_and_store(batch, [nyears] * len(models),
+                                         run_paths=[p[0] for p in paths],
+                                         diag_paths=[p[1] for p in paths],
+                                         steady_state=steady_state,
+                                         sinks=[p[2] for p in paths],
+                                         retired=retired)
+        except Exception as err:
+            # Not a numerical failure of a glacier (e.g. an output which
+            # can't be written): the glaciers which were not written yet
+            # run again on their own
+            failed = np.setdiff1d(np.arange(len(models)), retired)
+            log.warning('Batch of %d random climate runs failed (%d not '
+                        'done): %s', len(models), len(failed), err)
+    for i, (gdir, scenario, task_name) in enumerate(ok_items):
+        if i not in failed:
+            gdir.log(task_name)
+        else:
+            solo.append((gdir, scenario))
+    log.info('Batch of %d random climate runs, %d run on their own',
+             len(items), len(solo))
+
+    for gdir, scenario in solo:
+        run_random_climate_ensemble(gdir, [scenario], nyears=nyears, y0=y0,
+                                    halfsize=halfsize, bias=bias,
+                                    climate_filename=climate_filename,
+                                    climate_input_filesuffix=(
+                                        climate_input_filesuffix),
+                                    zero_initial_glacier=zero_initial_glacier,
+                                    steady_state=steady_state,
+                                    accumulator=accumulator, **kwargs)
+
+
+class _batch_runner(object):
+    """Picklable callable which runs one batch."""
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+
+    def __call__(self, items):
+        run_random_climate_batch(items, **self.kwargs)
+        return len(items)
+
+
+def execute_random_climate_batched(gdirs, scenarios, batch_size=BATCH_SIZE,
+                                   max_area_km2=MAX_AREA_KM2,
+                                   fallback_task=None, **kwargs):
+    """Run random climate scenarios, batching the small glaciers.
+
+    The (glacier, scenario) pairs of the glaciers smaller than
+    ``max_area_km2`` are run by batches of similar sizes, each batch in one
+    worker. The other glaciers (and all glaciers if the flux-based model
+    uses a shape factor) are run with ``fallback_task`` as usual.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory
+        the glaciers to run
+    scenarios : list of dict
+        the arguments of each scenario (see
+        :py:data:`~gmd_cluster_scripts.dynamics.SCENARIO_KEYS`)
+    batch_size : int
+        the number of runs per batch
+    max_area_km2 : float
+        the largest glacier to batch
+    fallback_task : function
+        the entity task for the other glaciers (default:
+        :py:func:`~gmd_cluster_scripts.dynamics.run_random_climate_ensemble`,
+        possibly wrapped, e.g. in a ``cached_task``)
+    **kwargs :
+        passed to the runs (``nyears``, ``y0``...). The runs already in the
+        ``accumulator`` (read back from its durable directory) are skipped
+    """
+
+    if fallback_task is None:
+        fallback_task = run_random_climate_ensemble
+    gdirs = utils.tolist(gdirs)
+    if cfg.PARAMS.get('use_shape_factor_for_fluxbasedmodel'):
+        small = []
+    else:
+        small = [gd for gd in gdirs if gd.rgi_area_km2 <= max_area_km2 and
+                 not gd.is_tidewater]
+    small_ids = set(gd.rgi_id for gd in small)
+    large = [gd for gd in gdirs if gd.rgi_id not in small_ids]
+
+    # The runs of an earlier job, already in the accumulator
+    acc = kwargs.get('accumulator')
+    if acc is not None and acc.done:
+        def done(gd, s):
+            fsuf = s['output_filesuffix']
+            if acc.has(gd.rgi_id, fsuf):
+                gd.log('run_random_climate' + fsuf)
+                return True
+            return False
+        large = [gd for gd in large
+                 if not all([done(gd, s) for s in scenarios])]
+    else:
+        def done(gd, s):
+            return False
+
+    # Batches of similar glaciers
+    small = sorted(small, key=lambda gd: gd.rgi_area_km2)
+    items = [(gd, s) for gd in small for s in scenarios if not done(gd, s)]
+    batches = [items[i:i + batch_size]
+               for i in range(0, len(items), batch_size)]
+    log.workflow('Random climate runs: %d glaciers in %d batches, %d on '
+                 'their own', len(small), len(batches), len(large))
+
+    if len(batches) > 0:
+        runner = _batch_runner(kwargs)
+        if cfg.PARAMS['use_multiprocessing']:
+            mppool = workflow.init_mp_pool(cfg.CONFIG_MODIFIED)
+            for _ in mppool.imap_unordered(runner, batches[::-1]):
+                pass
+        else:
+            for batch in batches:
+                runner(batch)
+
+    execute_entity_task(fallback_task, large, scenarios=scenarios, **kwargs)
@@ -0,0 +1,270 @@
+"""Indexed, region-level archives of glacier directories.
+
+``utils.gdir_to_tar`` writes one gzip tar per glacier: reading a single file
+(e.g. ``inversion_output``) means extracting the whole directory, and the
+compression runs on one core. A glacier bundle holds many glacier directories
+in one file:
+
+- each file is compressed on its own (zlib, or stored as is if this does not
+  help), in parallel threads
+- an index at the end of the bundle gives the offset of each file, so that
+  a single file can be read without extracting anything
+
+Layout::
+
+    MAGIC | member data ... | JSON index | index offset (8 bytes) | MAGIC
+
+The index maps each RGI id to the glacier's path relative to the
+``per_glacier`` base directory and to its files:
+``{relpath: [offset, stored size, original size, method]}``.
+"""
+# Built ins
+import os
+import io
+import gzip
+import json
+import zlib
+import pickle
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# External libs
+import pandas as pd
+
+# Locals
+import oggm
+import oggm.cfg as cfg
+from oggm import utils
+
+# Module logger
+log = logging.getLogger(__name__)
+
+MAGIC = b'GDBUNDL1'
+_TRAILER = struct.Struct('<Q8s')
+
+# Compression methods
+STORED = 0
+ZLIB = 1
+
+
+def _compress_dir(gdir_path, level=6):
+    """Read and compress all files of a directory (run in threads)."""
+    out = []
+    for root, _, files in os.walk(gdir_path):
+        for fname in sorted(files):
+            fpath = os.path.join(root, fname)
+            with open(fpath, 'rb') as f:
+                data = f.read()
+            cdata = zlib.compress(data, level)
+            if len(cdata) < len(data):
+                out.append((os.path.relpath(fpath, gdir_path), cdata,
+                            len(data), ZLIB))
+            else:
+                out.append((os.path.relpath(fpath, gdir_path), data,
+                            len(data), STORED))
+    return out
+
+
+def write_bundle(path, gdir_paths, base_dir, nthreads=4, level=6):
+    """Write glacier directories to a bundle.
+
+    Parameters
+    ----------
+    path : str
+        the bundle file to write
+    gdir_paths : list of str
+        the glacier directories to add (their base name is the RGI id)
+    base_dir : str
+        the directory the glacier paths are relative to (the ``per_glacier``
+        directory)
+    nthreads : int
+        the number of compression threads
+    level : int
+        the zlib compression level
+    """
+
+    index = dict()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f, ThreadPoolExecutor(nthreads) as executor:
+        f.write(MAGIC)
+        offset = len(MAGIC)
+        # Bounded window of glaciers in flight, to limit memory usage
+        window = 4 * nthreads
+        for i in range(0, len(gdir_paths), window):
+            chunk = gdir_paths[i:i + window]
+            results = executor.map(lambda p: _compress_dir(p, level), chunk)
+            for gdir_path, members in zip(chunk, results):
+                rgi_id = os.path.basename(os.path.normpath(gdir_path))
+                files = dict()
+                for relpath, data, size, method in members:
+                    f.write(data)
+                    files[relpath] = [offset, len(data), size, method]
+                    offset += len(data)
+                index[rgi_id] = dict(dir=os.path.relpath(gdir_path, base_dir),
+                                     files=files)
+        f.write(json.dumps(index).encode('utf-8'))
+        f.write(_TRAILER.pack(offset, MAGIC))
+    os.replace(tmp, path)
+    return path
+
+
+def gdirs_to_bundle(gdirs, path, nthreads=4):
+    """Write glacier directories to a bundle (see :py:func:`write_bundle`).
+    """
+    gdirs = utils.tolist(gdirs)
+    if len(gdirs) == 0:
+        raise ValueError('no glacier directory to write to ' + path)
+    return write_bundle(path, [gdir.dir for gdir in gdirs],
+                        gdirs[0].base_dir, nthreads=nthreads)
+
+
+def _member_name(filename, filesuffix=''):
+    """Same file naming as GlacierDirectory.get_filepath."""
+    fname = cfg.BASENAMES[filename] if filename in cfg.BASENAMES else filename
+    if filesuffix:
+        fname = fname.split('.')
+        fname = fname[0] + filesuffix + '.' + fname[1]
+    return fname
+
+
+class GlacierBundle(object):
+    """Read access to a glacier bundle.
+
+    Only the index is read when opening the bundle: the files are read
+    (with ``pread``, so that the object can be shared by threads) when
+    they are asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._fd = os.open(path, os.O_RDONLY)
+        size = os.fstat(self._fd).st_size
+        if os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+            raise ValueError('{} is not a glacier bundle'.format(path))
+        trailer = os.pread(self._fd, _TRAILER.size, size - _TRAILER.size)
+        index_offset, magic = _TRAILER.unpack(trailer)
+        if magic != MAGIC:
+            raise ValueError('{} is truncated'.format(path))
+        raw = os.pread(self._fd, size - _TRAILER.size - index_offset,
+                       index_offset)
+        self.index = json.loads(raw.decode('utf-8'))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __contains__(self, rgi_id):
+        return rgi_id in self.index
+
+    @property
+    def rgi_ids(self):
+        return sorted(self.index.keys())
+
+    def list_files(self, rgi_id):
+        return sorted(self.index[rgi_id]['files'].keys())
+
+    def read_bytes(self, rgi_id, relpath):
+        """The content of one file of a glacier directory."""
+        offset, csize, size, method = self.index[rgi_id]['files'][relpath]
+        data = os.pread(self._fd, csize, offset)
+        if method == ZLIB:
+            data = zlib.decompress(data)
+        assert len(data) == size
+        return data
+
+    def has_file(self, rgi_id, filename, filesuffix=''):
+        files = self.index[rgi_id]['files']
+        return _member_name(filename, filesuffix) in files
+
+    def read_pickle(self, rgi_id, filename, filesuffix=''):
+        """Same as GlacierDirectory.read_pickle, without extraction."""
+        data = self.read_bytes(rgi_id, _member_name(filename, filesuffix))
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return pickle.loads(data)
+
+    def read_csv(self, rgi_id, filename, filesuffix='', **kwargs):
+        data = self.read_bytes(rgi_id, _member_name(filename, filesuffix))
+        return pd.read_csv(io.BytesIO(data), **kwargs)
+
+    def extract_file(self, rgi_id, relpath, dest_dir):
+        """Extract one file of a glacier directory to ``dest_dir``."""
+        opath = os.path.join(dest_dir, relpath)
+        utils.mkdir(os.path.dirname(opath))
+        with open(opath, 'wb') as f:
+            f.write(self.read_bytes(rgi_id, relpath))
+        return opath
+
+    def extract(self, rgi_id, base_dir=None):
+        """Extract a glacier directory.
+
+        Parameters
+        ----------
+        rgi_id : str
+            the glacier to extract
+        base_dir : str
+            the ``per_glacier`` directory to extract to (default: the one
+            of the working directory)
+
+        Returns
+        -------
+        the path to the glacier directory
+        """
+        if base_dir is None:
+            base_dir = os.path.join(cfg.PATHS['working_dir'], 'per_glacier')
+        gdir_path = os.path.join(base_dir, self.index[rgi_id]['dir'])
+        for relpath in self.index[rgi_id]['files']:
+            self.extract_file(rgi_id, relpath, gdir_path)
+        return gdir_path
+
+
+def init_glacier_regions_from_bundle(rgidf, path, reset=False):
+    """Initialize the glacier directories of ``rgidf`` from a bundle.
+
+    Unlike ``init_glacier_regions(from_prepro_level=...)``, only the
+    glaciers in ``rgidf`` are read from the region bundle, and the directories
+    which already exist in the working directory are left untouched.
+
+    Parameters
+    ----------
+    rgidf : GeoDataFrame or list of str
+        the glaciers to initialize
+    path : str
+        the bundle file
+    reset : bool
+        extract the directories even if they already exist
+
+    Returns
+    -------
+    the list of glacier directories
+    """
+
+    if hasattr(rgidf, 'RGIId'):
+        rgi_ids = rgidf.RGIId.values
+    else:
+        rgi_ids = utils.tolist(rgidf)
+
+    base_dir = os.path.join(cfg.PATHS['working_dir'], 'per_glacier')
+    gdirs = []
+    with GlacierBundle(path) as bundle:
+        for rgi_id in rgi_ids:
+            if rgi_id not in bundle:
+                log.warning('%s is not in %s', rgi_id, path)
+                continue
+            gdir_path = os.path.join(base_dir, bundle.index[rgi_id]['dir'])
+            if reset or not os.path.exists(gdir_path):
+                bundle.extract(rgi_id, base_dir=base_dir)
+            gdirs.append(oggm.GlacierDirectory(rgi_id, base_dir=base_dir))
+    return gdirs
@@ -0,0 +1,235 @@
+"""Mass-balance calibration for a vector of precipitation factors.
+
+The sensitivity of the inversion to the precipitation factor (second panel
+of the HEF inversion figure) was computed by setting
+``cfg.PARAMS['prcp_scaling_factor']`` and re-running ``t_star_from_refmb``,
+``local_t_star``, ``mu_star_calibration`` and ``prepare_for_inversion`` for
+each factor, re-reading the climate files every time.
+
+But the solid precipitation is proportional to the factor, and so are the
+mu* candidates and the modelled mass-balance of each t* candidate (the
+temperature for melt does not depend on it). Therefore:
+
+- the glacier-wide yearly temperature for melt and solid precipitation are
+  read once (with a factor of one), and the t* and bias are found for all
+  factors at once (:py:func:`t_star_for_prcp_factors`)
+- the calibration tasks run once per distinct t* (a handful for dozens of
+  factors), with a factor of one, and the fluxes of the inversion input are
+  scaled by each factor
+
+The mu* bounds (``min_mu_star`` and ``max_mu_star``) apply to the mu* at the
+actual factors, which are the mu* for a factor of one times the factor: they
+are checked for each factor after the calibration.
+"""
+# Built ins
+import logging
+
+# External libs
+import numpy as np
+
+# Locals
+import oggm.cfg as cfg
+from oggm import tasks
+from oggm.utils import entity_task
+from oggm.core.climate import (mb_yearly_climate_on_glacier, local_t_star,
+                               mu_star_calibration)
+from gmd_cluster_scripts.params import ParamsContext
+from gmd_cluster_scripts.inversion import _invert_flowlines
+
+# Module logger
+log = logging.getLogger(__name__)
+
+
+def _run_task(task, gdir, **kwargs):
+    """Run a task and raise if it failed (even with continue_on_error)."""
+    out = task(gdir, **kwargs)
+    if gdir.get_task_status(task.__name__) != 'SUCCESS':
+        raise RuntimeError('({}) {} failed'.format(gdir.rgi_id,
+                                                   task.__name__))
+    return out
+
+
+def tstar_search_window(gdir):
+    """The [y0, y1] years of the t* search, as in ``t_star_from_refmb``."""
+    y0, y1 = cfg.PARAMS['tstar_search_window']
+    ci = gdir.read_pickle('climate_info')
+    y0 = y0 or ci['baseline_hydro_yr_0']
+    y1 = y1 or ci['baseline_hydro_yr_1']
+    return [y0, y1]
+
+
+def climate_kernel(gdir, year_range=None):
+    """The glacier-wide yearly climate, for a precipitation factor of one.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    year_range : list, optional
+        the [y0, y1] years to read (default: the t* search window, see
+        :py:func:`tstar_search_window`)
+
+    Returns
+    -------
+    (years, temp, prcp): the hydrological years, the temperature for melt
+    and the solid precipitation
+    """
+    if year_range is None:
+        year_range = tstar_search_window(gdir)
+    with ParamsContext(prcp_scaling_factor=1.):
+        return mb_yearly_climate_on_glacier(gdir, year_range=year_range)
+
+
+def t_star_for_prcp_factors(gdir, prcp_factors, mbdf=None, kernel=None):
+    """Same as ``t_star_from_refmb``, for several precipitation factors.
+
+    Only the glacier-wide method (``cfg.PARAMS['tstar_search_glacierwide']``)
+    is implemented.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    prcp_factors : array-like
+        the precipitation factors
+    mbdf : pd.Series
+        the reference mass-balance (default: the glacier's annual balance)
+    kernel : tuple
+        the output of :py:func:`climate_kernel` (over the t* search window),
+        if already read
+
+    Returns
+    -------
+    (t_star, bias, mu_star): arrays with one value per factor
+    """
+
+    if not cfg.PARAMS['tstar_search_glacierwide']:
+        raise NotImplementedError('t_star_for_prcp_factors only implements '
+                                  'the glacier-wide t* search '
+                                  '(tstar_search_glacierwide)')
+    if mbdf is None:
+        mbdf = gdir.get_ref_mb_data()['ANNUAL_BALANCE']
+    if kernel is None:
+        kernel = climate_kernel(gdir)
+    years, temp, prcp = kernel
+    pfs = np.atleast_1d(np.asarray(prcp_factors, dtype=float))
+
+    # The years of the reference mass-balance
+    selind = np.searchsorted(years, mbdf.index.values)
+    sel_temp = np.mean(temp[selind])
+    sel_prcp = np.mean(prcp[selind])
+    ref_mb = np.mean(mbdf)
+
+    # The t* candidates: the kernel covers the search window, without the
+    # mu_hp years at both ends of it
+    mu_hp = int(cfg.PARAMS['mu_star_halfperiod'])
+    ok = np.ones(len(years), dtype=bool)
+    ok[:mu_hp] = False
+    ok[len(years) - mu_hp:] = False
+
+    # The mu* of each candidate (for a factor of one) from running means
+    n = 2 * mu_hp + 1
+    window = np.ones(n) / n
+    t_avg = np.convolve(temp, window, mode='same')
+    p_avg = np.convolve(prcp, window, mode='same')
+    ok &= t_avg > 1e-3  # if too cold no melt possible
+    cands = np.nonzero(ok)[0]
+    if len(cands) == 0:
+        raise RuntimeError('({}) no single valid mu candidate for this '
+                           'glacier!'.format(gdir.rgi_id))
+    mu = p_avg[cands] / t_avg[cands]
+
+    # The mass-balance of each factor and candidate, and the best candidate
+    diff = pfs[:, np.newaxis] * (sel_prcp - mu * sel_temp) - ref_mb
+    amin = np.argmin(np.abs(diff), axis=1)
+    rows = np.arange(len(pfs))
+    return years[cands[amin]], diff[rows, amin], pfs * mu[amin]
+
+
+@entity_task(log)
+def prcp_factor_inversion_sweep(gdir, prcp_factors, glen_a_factors,
+                                glen_a=None, fs=None, mbdf=None):
+    """The inverted volume for several precipitation factors and A factors.
+
+    The calibration tasks run once per distinct t* (see the module
+    documentation), and the glacier is then calibrated again with the
+    current ``cfg.PARAMS['prcp_scaling_factor']``.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    prcp_factors : array-like
+        the precipitation factors
+    glen_a_factors : array-like
+        the factors applied to ``glen_a``
+    glen_a : float
+        glen's creep parameter A (default: ``cfg.PARAMS['inversion_glen_a']``)
+    fs : float
+        the sliding parameter (default: ``cfg.PARAMS['inversion_fs']``)
+    mbdf : pd.Series
+        the reference mass-balance (default: the glacier's annual balance)
+
+    Returns
+    -------
+    a dict with the ``t_star``, ``bias`` and ``mu_star`` of each factor,
+    ``mu_star_ok`` (whether the glacier and flowline mu* are within the mu*
+    bounds for this factor), and the ``volume`` [m3] (array of shape
+    (n_prcp_factors, n_glen_a_factors), NaN for the factors out of bounds)
+    """
+
+    if glen_a is None:
+        glen_a = cfg.PARAMS['inversion_glen_a']
+    if fs is None:
+        fs = cfg.PARAMS['inversion_fs']
+    if mbdf is None:
+        mbdf = gdir.get_ref_mb_data()['ANNUAL_BALANCE']
+    pfs = np.atleast_1d(np.asarray(prcp_factors, dtype=float))
+    factors = np.atleast_1d(np.asarray(glen_a_factors, dtype=float))
+
+    kernel = climate_kernel(gdir)
+    t_star, bias, mu_star = t_star_for_prcp_factors(gdir, pfs, mbdf=mbdf,
+                                                    kernel=kernel)
+
+    # With a factor of one, the mu* bounds are those of all factors divided
+    # by the factor: they are checked below, for each factor
+    min_mu, max_mu = cfg.PARAMS['min_mu_star'], cfg.PARAMS['max_mu_star']
+    ctx = ParamsContext(prcp_scaling_factor=1.,
+                        min_mu_star=min_mu / np.max(pfs),
+                        max_mu_star=max_mu / np.min(pfs))
+
+    volume = np.zeros((len(pfs), len(factors))) * np.nan
+    mu_star_ok = np.zeros(len(pfs), dtype=bool)
+    for ts in np.unique(t_star):
+        sel = np.nonzero(t_star == ts)[0]
+        # The bias is not used by the inversion: that of the first factor
+        with ctx:
+            _run_task(local_t_star, gdir, tstar=ts, bias=bias[sel[0]])
+            _run_task(mu_star_calibration, gdir)
+            _run_task(tasks.prepare_for_inversion, gdir)
+        fl_mu = np.array([fl.mu_star for fl in
+                          gdir.read_pickle('inversion_flowlines')])
+        cls = gdir.read_pickle('inversion_input')
+        for i in sel:
+            mus = np.append(fl_mu * pfs[i], mu_star[i])
+            mu_star_ok[i] = np.all((mus >= min_mu) & (mus <= max_mu))
+            if not mu_star_ok[i]:
+                continue
+            scaled = [dict(cl, flux_a0=cl['flux_a0'] * pfs[i]) for cl in cls]
+            v, _, _, _ = _invert_flowlines(scaled, glen_a, factors,
+                                           np.atleast_1d(fs),
+                                           rgi_id=gdir.rgi_id)
+            volume[i, :] = v
+    log.info('(%s) %d precipitation factors, %d t* calibrations',
+             gdir.rgi_id, len(pfs), len(np.unique(t_star)))
+    if not np.all(mu_star_ok):
+        log.warning('(%s) mu* out of specified bounds for the precipitation '
+                    'factors %s', gdir.rgi_id, pfs[~mu_star_ok])
+
+    # Leave the glacier calibrated with the current factor
+    pf = cfg.PARAMS['prcp_scaling_factor']
+    ts, b, _ = t_star_for_prcp_factors(gdir, [pf], mbdf=mbdf, kernel=kernel)
+    _run_task(local_t_star, gdir, tstar=ts[0], bias=b[0])
+    _run_task(mu_star_calibration, gdir)
+    _run_task(tasks.prepare_for_inversion, gdir)
+
+    return dict(prcp_factors=pfs, glen_a_factors=factors, t_star=t_star,
+                bias=bias, mu_star=mu_star, mu_star_ok=mu_star_ok,
+                volume=volume)
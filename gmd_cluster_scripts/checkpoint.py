@@ -0,0 +1,345 @@
+"""Checkpoint and resume of region runs.
+
+The glacier directories live on the node-local disk, which is cleaned when
+the job ends: a job killed at the wall-time limit loses everything. With a
+:py:class:`Checkpoint` registered in the scheduler
+(:py:func:`~gmd_cluster_scripts.scheduling.set_checkpoint`), each worker
+writes to a durable directory (e.g. on the shared home), after each task (or
+task chain) on a glacier:
+
+- a compressed archive of the files of the glacier directory which were
+  added or modified since the last checkpoint (``{rgi_id}.{n}.tar.gz``, the
+  first one holds the whole directory)
+- then a record of the tasks done on this glacier and their outputs, the
+  archives it goes with (with their size and time) and the files of the
+  directory (``{rgi_id}.pkl``)
+
+When a glacier has too many archives, they are replaced by a single one.
+
+A restarted script extracts the checkpointed directories instead of the
+prepro ones (:py:meth:`Checkpoint.init_glacier_regions`), and the tasks
+already done on a glacier are skipped (same task and keyword arguments, in
+the same script). A glacier whose record does not match its archives (job
+killed in between) starts over. Each script has its own checkpoints, in a
+subdirectory of the checkpoint directory named after the script.
+
+:py:meth:`Checkpoint.compile_run_output` compiles the run output in chunks
+of glaciers, written to the durable directory as well, so that only the
+missing chunks are compiled after a restart.
+"""
+# Built ins
+import os
+import sys
+import json
+import glob
+import pickle
+import shutil
+import hashlib
+import logging
+import tarfile
+
+# External libs
+import numpy as np
+import xarray as xr
+from collections.abc import Mapping
+
+# Locals
+import oggm
+import oggm.cfg as cfg
+from oggm import utils, workflow
+
+# Module logger
+log = logging.getLogger(__name__)
+
+
+# Beyond this number of archives per glacier, they are merged into one
+MAX_LAYERS = 10
+
+
+def _stable(obj):
+    """A JSON-serializable value identifying ``obj`` across processes and jobs.
+
+    Objects other than the builtin types, numpy arrays, functions and classes
+    must define a ``checkpoint_key()`` method returning such a value.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, Mapping):
+        return {str(k): _stable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_stable(v) for v in obj]
+    if hasattr(obj, 'checkpoint_key'):
+        return [type(obj).__name__, _stable(obj.checkpoint_key())]
+    if isinstance(obj, type) or callable(obj):
+        func = getattr(obj, 'func', obj)  # functools.partial
+        if hasattr(func, '__qualname__'):
+            return func.__module__ + '.' + func.__qualname__
+    raise TypeError('cannot identify a task argument of type '
+                    '{}'.format(type(obj).__name__))
+
+
+def task_key(task, kwargs, name=''):
+    """How a task call of the script ``name`` is identified in the records.
+    """
+    s = json.dumps(_stable(kwargs), sort_keys=True)
+    return '{}:{}:{}'.format(name, task.__name__,
+                             hashlib.sha1(s.encode('utf-8')).hexdigest())
+
+
+def script_name():
+    """The name of the running script, with its directory (e.g.
+    ``dynamic_runs_run``, since the scripts of all stages are ``run.py``).
+    """
+    path = os.path.abspath(sys.argv[0])
+    return '{}_{}'.format(os.path.basename(os.path.dirname(path)),
+                          os.path.splitext(os.path.basename(path))[0])
+
+
+def _file_stamps(path):
+    """The size and time of all files in a directory (relative paths)."""
+    out = dict()
+    for root, _, files in os.walk(path):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            out[os.path.relpath(fpath, path)] = _stamp(fpath)
+    return out
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _write_atomic(path, obj):
+    tmp = path + '.tmp{}'.format(os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=-1)
+    os.replace(tmp, path)
+
+
+class Checkpoint(object):
+    """Durable per-glacier, per-task checkpoints of a region run.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        the durable directory (created if needed). If it already holds
+        checkpoints of this script, the run is resumed from them.
+    name : str
+        the name of the script, which has its checkpoints in the
+        ``checkpoint_dir/name`` subdirectory (default:
+        :py:func:`script_name`)
+    compresslevel : int
+        the gzip level of the glacier archives
+    """
+
+    def __init__(self, checkpoint_dir, name=None, compresslevel=1):
+        self.name = script_name() if name is None else name
+        self.checkpoint_dir = os.path.join(checkpoint_dir, self.name)
+        self.compresslevel = compresslevel
+        utils.mkdir(self._gdir_dir)
+        utils.mkdir(self._compile_dir)
+        self.records = self._read_records()
+        if self.records:
+            log.workflow('Resuming from the checkpoints of %d glaciers',
+                         len(self.records))
+
+    @property
+    def _gdir_dir(self):
+        return os.path.join(self.checkpoint_dir, 'per_glacier')
+
+    @property
+    def _compile_dir(self):
+        return os.path.join(self.checkpoint_dir, 'compile')
+
+    def _record_path(self, rgi_id):
+        return os.path.join(self._gdir_dir, rgi_id + '.pkl')
+
+    def _layer_path(self, rgi_id, n):
+        return os.path.join(self._gdir_dir, '{}.{}.tar.gz'.format(rgi_id, n))
+
+    def _read_records(self):
+        """Read the valid records, remove the others and unused archives."""
+        records = dict()
+        for rpath in glob.glob(os.path.join(self._gdir_dir, '*.pkl')):
+            rgi_id = os.path.basename(rpath)[:-4]
+            try:
+                with open(rpath, 'rb') as f:
+                    rec = pickle.load(f)
+                ok = all(os.path.exists(self._layer_path(rgi_id, n)) and
+                         _stamp(self._layer_path(rgi_id, n)) == stamp
+                         for n, stamp in rec['layers'])
+            except Exception:
+                ok = False
+            if ok:
+                records[rgi_id] = rec
+            else:
+                log.warning('(%s) inconsistent checkpoint, starting over',
+                            rgi_id)
+                os.remove(rpath)
+        used = set(self._layer_path(rgi_id, n) for rgi_id, rec in
+                   records.items() for n, _ in rec['layers'])
+        for path in glob.glob(os.path.join(self._gdir_dir, '*.tar.gz*')):
+            if path not in used:
+                os.remove(path)
+        return records
+
+    def __contains__(self, rgi_id):
+        return rgi_id in self.records
+
+    def task_key(self, task, kwargs):
+        """How a task call of this script is identified in the records."""
+        return task_key(task, kwargs, name=self.name)
+
+    def done_outputs(self, rgi_id, keys):
+        """The outputs of the tasks, if they are all done on this glacier.
+        """
+        done = self.records.get(rgi_id, dict()).get('done', dict())
+        if all(k in done for k in keys):
+            return [done[k] for k in keys]
+        return None
+
+    def mark_done(self, rgi_id, keys, outs):
+        """Update the in-memory records (the files are written by save)."""
+        rec = self.records.setdefault(rgi_id, dict(done=dict()))
+        rec['done'].update(zip(keys, outs))
+
+    def _write_layer(self, gdir, n, files):
+        path = self._layer_path(gdir.rgi_id, n)
+        tmp = path + '.tmp{}'.format(os.getpid())
+        with tarfile.open(tmp, 'w:gz',
+                          compresslevel=self.compresslevel) as tar:
+            for f in sorted(files):
+                fpath = os.path.join(gdir.dir, f)
+                tar.add(fpath, arcname=os.path.relpath(fpath, gdir.base_dir))
+        os.replace(tmp, path)
+        return n, _stamp(path)
+
+    def save(self, gdir, keys, outs):
+        """Checkpoint a glacier after its tasks ``keys`` (run in workers).
+        """
+
+        if not os.path.isdir(gdir.dir):
+            # e.g. deleted by gdir_to_tar: nothing left to checkpoint
+            log.info('(%s) no directory to checkpoint', gdir.rgi_id)
+            return
+
+        rpath = self._record_path(gdir.rgi_id)
+        rec = dict(done=dict(), layers=[], files=dict())
+        if os.path.exists(rpath):
+            with open(rpath, 'rb') as f:
+                rec = pickle.load(f)
+
+        # Only the files added or modified since the last checkpoint, all of
+        # them when there are too many archives already
+        files = _file_stamps(gdir.dir)
+        n = rec['layers'][-1][0] + 1 if rec['layers'] else 0
+        old_layers = []
+        if len(rec['layers']) >= MAX_LAYERS:
+            old_layers, rec['layers'] = rec['layers'], []
+            changed = list(files)
+        else:
+            changed = [f for f, st in files.items()
+                       if rec['files'].get(f) != st]
+        if changed:
+            rec['layers'].append(self._write_layer(gdir, n, changed))
+        rec['files'] = files
+        rec['arcname'] = os.path.relpath(gdir.dir, gdir.base_dir)
+
+        for k, out in zip(keys, outs):
+            try:
+                pickle.dumps(out)
+            except Exception:
+                out = None
+            rec['done'][k] = out
+        _write_atomic(rpath, rec)
+        for n, _ in old_layers:
+            os.remove(self._layer_path(gdir.rgi_id, n))
+
+    def _restore(self, rgi_id, base_dir):
+        """Extract the archives of a glacier, and return its directory."""
+        rec = self.records[rgi_id]
+        gdir_path = os.path.join(base_dir, rec['arcname'])
+        if os.path.exists(gdir_path):
+            shutil.rmtree(gdir_path)
+        for n, _ in rec['layers']:
+            with tarfile.open(self._layer_path(rgi_id, n), 'r') as tar:
+                tar.extractall(base_dir)
+        # The files deleted since they were archived
+        for f in set(_file_stamps(gdir_path)) - set(rec['files']):
+            os.remove(os.path.join(gdir_path, f))
+        # The archives do not keep the times to the nanosecond: this is the
+        # reference of the next checkpoint
+        rec['files'] = _file_stamps(gdir_path)
+        _write_atomic(self._record_path(rgi_id), rec)
+        return gdir_path
+
+    def init_glacier_regions(self, rgidf, **kwargs):
+        """Same as ``workflow.init_glacier_regions``, from the checkpoints.
+
+        The glaciers which have a checkpoint are extracted from it, the
+        others are initialized by ``init_glacier_regions(rgidf, **kwargs)``.
+
+        Returns
+        -------
+        the list of glacier directories, in the order of ``rgidf``
+        """
+
+        base_dir = os.path.join(cfg.PATHS['working_dir'], 'per_glacier')
+        is_ckpt = rgidf.RGIId.isin(list(self.records.keys())).values
+        gdirs = dict()
+        if (~is_ckpt).any():
+            for gdir in workflow.init_glacier_regions(rgidf.loc[~is_ckpt],
+                                                      **kwargs):
+                gdirs[gdir.rgi_id] = gdir
+        for rgi_id in rgidf.RGIId.values[is_ckpt]:
+            self._restore(rgi_id, base_dir)
+            gdirs[rgi_id] = oggm.GlacierDirectory(rgi_id, base_dir=base_dir)
+        return [gdirs[rgi_id] for rgi_id in rgidf.RGIId.values
+                if rgi_id in gdirs]
+
+    def compile_run_output(self, gdirs, filesuffix='', chunk_size=500):
+        """Same as ``utils.compile_run_output``, resumable.
+
+        The glaciers are compiled by chunks (sorted by RGI id), which are
+        kept in the checkpoint directory, and merged at the end.
+
+        Parameters
+        ----------
+        gdirs : list of GlacierDirectory
+            the glaciers to compile
+        filesuffix : str
+            the run output suffix
+        chunk_size : int
+            the number of glaciers per chunk
+        """
+
+        gdirs = sorted(utils.tolist(gdirs), key=lambda gd: gd.rgi_id)
+        paths = []
+        for i in range(0, len(gdirs), chunk_size):
+            chunk = gdirs[i:i + chunk_size]
+            h = hashlib.sha1(' '.join(gd.rgi_id for gd in chunk)
+                             .encode('utf-8')).hexdigest()[:12]
+            path = os.path.join(self._compile_dir, 'run_output{}_{}.nc'
+                                .format(filesuffix, h))
+            if not os.path.exists(path):
+                tmp = path + '.tmp{}'.format(os.getpid())
+                utils.compile_run_output(chunk, path=tmp,
+                                         filesuffix=filesuffix)
+                os.replace(tmp, path)
+            paths.append(path)
+
+        dss = [xr.open_dataset(p) for p in paths]
+        try:
+            ds = xr.concat(dss, dim='rgi_id', data_vars='minimal')
+            opath = os.path.join(cfg.PATHS['working_dir'],
+                                 'run_output' + filesuffix + '.nc')
+            ds.to_netcdf(opath)
+        finally:
+            for d in dss:
+                d.close()
+        return opath
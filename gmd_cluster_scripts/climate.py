@@ -0,0 +1,472 @@
+"""Region-wide extraction of the CRU climate data.
+
+``process_cru_data`` opens the global CRU TS files and reads a 3x3 window
+around each glacier, which makes tens of thousands of small random reads in
+two large netCDF files. Here the climate of all glaciers of a region is
+computed at once, in the main process (:py:func:`cru_region_window`):
+
+- the CRU TS and CRU CL windows covering the region are read in one go
+- the CL and TS grid points of all glaciers, their interpolation weights
+  and the local temperature gradients are computed with array operations
+- the monthly time series of all glaciers are written to memory-mapped
+  arrays in shared memory (``/dev/shm``, where available)
+
+The :py:func:`process_cru_data` task then only copies the row of its
+glacier into the ``climate_monthly`` file. The method is the same as in
+OGGM's ``process_cru_data`` (anomalies to the 1961-1990 TS climatology,
+interpolated to the CL grid point of the glacier and added to the CL
+climatology), including its fallbacks for the missing data.
+"""
+# Built ins
+import os
+import json
+import shutil
+import logging
+import warnings
+import datetime
+from contextlib import contextmanager
+
+# External libs
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import stats
+
+# Locals
+import oggm.cfg as cfg
+from oggm import utils
+from oggm.utils import entity_task
+from gmd_cluster_scripts.scheduling import execute_entity_task
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# How far (in CL grid points) to look for a valid CL grid point around a
+# glacier, and therefore the margin of the CL window
+CL_MARGIN = 50
+
+# Glaciers processed at once when interpolating the TS data
+CHUNK_SIZE = 500
+
+
+def _nearest_index(coord, values):
+    """Nearest indices of values on a regular, 1D coordinate (vectorized).
+    """
+    dc = coord[1] - coord[0]
+    idx = np.round((np.asarray(values) - coord[0]) / dc).astype(int)
+    return np.clip(idx, 0, len(coord) - 1)
+
+
+def _window(coord, idx, margin):
+    return slice(max(idx.min() - margin, 0),
+                 min(idx.max() + margin + 1, len(coord)))
+
+
+def _pad(a, value=np.nan):
+    """Pad the last two dimensions by one, for the 3x3 neighborhoods."""
+    pad = [(0, 0)] * (a.ndim - 2) + [(1, 1), (1, 1)]
+    return np.pad(a, pad, mode='constant', constant_values=value)
+
+
+def _weighted(values, weights):
+    """Sum of the (nt, n, 4) stencil values, ignoring the unused points."""
+    return np.sum(np.where(weights > 0, values * weights, 0.), axis=-1)
+
+
+def _cl_pixels(elev, ilat, ilon):
+    """The CL grid point of each glacier: the nearest, or the first valid
+    one around it (as in ``process_cru_data``).
+
+    Returns
+    -------
+    (ilat, ilon, ok): the grid point indices, and which glaciers have one
+    """
+    ilat = ilat.copy()
+    ilon = ilon.copy()
+    ok = np.ones(len(ilat), dtype=bool)
+    for k in np.nonzero(~np.isfinite(elev[ilat, ilon]))[0]:
+        for margin in range(1, CL_MARGIN + 1):
+            j0 = max(ilat[k] - margin, 0)
+            i0 = max(ilon[k] - margin, 0)
+            isok = np.isfinite(elev[j0:ilat[k] + margin + 1,
+                                    i0:ilon[k] + margin + 1])
+            if isok.any():
+                # Take the first candidate (doesn't matter which)
+                j, i = np.argwhere(isok)[0]
+                ilat[k], ilon[k] = j0 + j, i0 + i
+                break
+        else:
+            ok[k] = False
+    return ilat, ilon, ok
+
+
+def _local_gradient(hgt, tmp):
+    """The monthly temperature gradients of the CL 3x3 neighborhoods.
+
+    Same as ``stats.linregress`` for each glacier and month, where the
+    slope is kept if its p-value is below 0.01 (NaN otherwise).
+
+    Parameters
+    ----------
+    hgt : ndarray
+        the (n, 9) elevations of the neighborhoods (NaN where invalid)
+    tmp : ndarray
+        the (n, 12, 9) temperatures
+
+    Returns
+    -------
+    (grad, ok): the (n, 12) gradients, and where there are enough points
+    to compute them (at least 5)
+    """
+    isok = np.isfinite(hgt)
+    n = isok.sum(axis=1)
+    x = np.where(isok, hgt, 0.)[:, np.newaxis, :]
+    y = np.where(isok[:, np.newaxis, :], tmp, 0.)
+    w = isok[:, np.newaxis, :]
+    nn = np.maximum(n, 1)[:, np.newaxis]
+    dx = np.where(w, x - (x.sum(axis=-1) / nn)[..., np.newaxis], 0.)
+    dy = np.where(w, y - (y.sum(axis=-1) / nn)[..., np.newaxis], 0.)
+    sxx = np.sum(dx * dx, axis=-1)
+    syy = np.sum(dy * dy, axis=-1)
+    sxy = np.sum(dx * dy, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = sxy / sxx
+        r = np.where((sxx == 0) | (syy == 0), 0., sxy / np.sqrt(sxx * syy))
+        r = np.clip(r, -1., 1.)
+        df = (n - 2)[:, np.newaxis]
+        t = r * np.sqrt(df / ((1. - r) * (1. + r) + 1e-20))
+        p_val = 2 * stats.t.sf(np.abs(t), df)
+    return np.where(p_val < 0.01, slope, np.nan), n >= 5
+
+
+def _ts_stencils(ok_pix, lon0, dlon, lat0, dlat, cj, ci, x, y):
+    """The TS grid points and weights to interpolate to the CL points.
+
+    As in ``process_cru_data``: bilinear interpolation if the 3x3
+    neighborhood is valid, nearest neighbor if it has invalid points, and
+    a valid point of the neighborhood if its center is invalid.
+
+    Parameters
+    ----------
+    ok_pix : ndarray
+        the TS grid points with a valid temperature series (padded)
+    lon0, dlon, lat0, dlat : float
+        the TS window coordinates
+    cj, ci : ndarray
+        the TS neighborhood centers (indices in the padded window)
+    x, y : ndarray
+        the CL grid points (lon, lat) to interpolate to
+
+    Returns
+    -------
+    (jj, ii, weights, ok): the (n, 4) indices (in the padded window) and
+    weights, and which glaciers have climate data
+    """
+    n = len(cj)
+    jj = np.repeat(cj[:, np.newaxis], 4, axis=1)
+    ii = np.repeat(ci[:, np.newaxis], 4, axis=1)
+    weights = np.zeros((n, 4))
+    weights[:, 0] = 1.
+
+    # Bilinear (indices in the padded window, hence the + 1)
+    fi = (x - lon0) / dlon + 1
+    fj = (y - lat0) / dlat + 1
+    i0 = np.floor(fi).astype(int)
+    j0 = np.floor(fj).astype(int)
+    wi = fi - i0
+    wj = fj - j0
+    lin_jj = np.stack([j0, j0, j0 + 1, j0 + 1], axis=1)
+    lin_ii = np.stack([i0, i0 + 1, i0, i0 + 1], axis=1)
+    lin_w = np.stack([(1 - wj) * (1 - wi), (1 - wj) * wi,
+                      wj * (1 - wi), wj * wi], axis=1)
+
+    # Nearest
+    nj = np.round(fj).astype(int)
+    ni = np.round(fi).astype(int)
+
+    center_ok = ok_pix[cj, ci]
+    block_ok = np.ones(n, dtype=bool)
+    for dj in [-1, 0, 1]:
+        for di in [-1, 0, 1]:
+            block_ok &= ok_pix[cj + dj, ci + di]
+
+    lin = center_ok & block_ok
+    jj[lin], ii[lin], weights[lin] = lin_jj[lin], lin_ii[lin], lin_w[lin]
+    near = center_ok & ~block_ok
+    jj[near, 0], ii[near, 0] = nj[near], ni[near]
+
+    # Invalid center: the last valid point found in the upper left corner
+    ok = center_ok.copy()
+    for idi in range(2):
+        for idj in range(2):
+            pj, pi = cj + idj - 1, ci + idi - 1
+            sel = ~center_ok & ok_pix[pj, pi]
+            jj[sel, 0], ii[sel, 0] = pj[sel], pi[sel]
+            ok |= sel
+    return jj, ii, weights, ok
+
+
+def _period(hemisphere, times):
+    """The hydrological years period of the TS data, as in
+    ``process_cru_data``.
+
+    Returns
+    -------
+    (t0, t1, y0, y1): the first and last months and years
+    """
+    sm = cfg.PARAMS['hydro_month_' + hemisphere]
+    em = sm - 1 if (sm > 1) else 12
+    y0, y1 = times[0].year, times[-1].year
+    if cfg.PARAMS.get('baseline_y0', 0) != 0:
+        y0 = cfg.PARAMS['baseline_y0']
+    if cfg.PARAMS.get('baseline_y1', 0) != 0:
+        y1 = cfg.PARAMS['baseline_y1']
+    return (datetime.datetime(y0, sm, 1), datetime.datetime(y1, em, 1),
+            y0, y1)
+
+
+def _read_ts(var, ilat, ilon, margin=2):
+    """Read the CRU TS window of all glaciers.
+
+    Returns
+    -------
+    (times, lon, lat, data): the month-begin times, the window coordinates
+    and the (nt, nlat, nlon) data
+    """
+    with xr.open_dataset(utils.get_cru_file(var=var)) as ds:
+        slat = _window(ds.lat, ilat, margin)
+        slon = _window(ds.lon, ilon, margin)
+        sub = ds[var].isel(lat=slat, lon=slon)
+        data = sub.values
+        lon, lat = sub.lon.values, sub.lat.values
+        times = pd.to_datetime(sub.time.values)
+        source = ds.attrs.get('title', '')[:10]
+    times = pd.DatetimeIndex([datetime.datetime(t.year, t.month, 1)
+                              for t in times])
+    return times, lon, lat, data, slat.start, slon.start, source
+
+
+def _write_window(gdirs, output_dir):
+    """Compute the climate of all glaciers and write it to ``output_dir``.
+    """
+
+    rgi_ids = np.array([gdir.rgi_id for gdir in gdirs])
+    lons = np.array([gdir.cenlon for gdir in gdirs])
+    lats = np.array([gdir.cenlat for gdir in gdirs])
+    hemis = np.array([gdir.hemisphere for gdir in gdirs])
+    errors = dict()
+
+    # The CL grid points, in the window of the region
+    with xr.open_dataset(utils.get_cru_cl_file()) as ds:
+        ilat = _nearest_index(ds.lat.values, lats)
+        ilon = _nearest_index(ds.lon.values, lons)
+        cl = ds.isel(lat=_window(ds.lat, ilat, CL_MARGIN + 1),
+                     lon=_window(ds.lon, ilon, CL_MARGIN + 1)).load()
+    cl_lon, cl_lat = cl.lon.values, cl.lat.values
+    cl_elev = cl['elev'].values.astype(np.float64)
+    cl_temp = cl['temp'].values.astype(np.float64)
+    cl_prcp = cl['prcp'].values.astype(np.float64)
+    cj, ci, ok = _cl_pixels(cl_elev, _nearest_index(cl_lat, lats),
+                            _nearest_index(cl_lon, lons))
+    for rid in rgi_ids[~ok]:
+        errors[rid] = 'no valid CRU CL grid point'
+    ref_hgt = cl_elev[cj, ci]
+    ref_lon = cl_lon[ci]
+    ref_lat = cl_lat[cj]
+
+    # The gradients, from the 3x3 CL neighborhoods
+    grad = np.zeros((len(gdirs), 12)) * np.nan
+    grad_ok = np.zeros(len(gdirs), dtype=bool)
+    if cfg.PARAMS['temp_use_local_gradient']:
+        pe, pt = _pad(cl_elev), _pad(cl_temp)
+        hgt9 = np.stack([pe[cj + dj, ci + di] for dj in range(3)
+                         for di in range(3)], axis=1)
+        tmp9 = np.stack([pt[:, cj + dj, ci + di] for dj in range(3)
+                         for di in range(3)], axis=2).transpose(1, 0, 2)
+        grad, grad_ok = _local_gradient(hgt9, tmp9)
+
+    # The TS neighborhoods: around the glacier, or around the CL grid point
+    # if the glacier's one was not valid (as in process_cru_data)
+    moved = ~np.isfinite(cl_elev[_nearest_index(cl_lat, lats),
+                                 _nearest_index(cl_lon, lons)])
+    ts_lon = np.where(moved, ref_lon, lons)
+    ts_lat = np.where(moved, ref_lat, lats)
+    with xr.open_dataset(utils.get_cru_file(var='tmp')) as ds:
+        tj = _nearest_index(ds.lat.values, ts_lat)
+        ti = _nearest_index(ds.lon.values, ts_lon)
+    times, lon, lat, ts_tmp, j0, i0, source = _read_ts('tmp', tj, ti)
+    _, _, _, ts_pre, _, _, _ = _read_ts('pre', tj, ti)
+    tj, ti = tj - j0 + 1, ti - i0 + 1
+
+    meta = dict(source=source, periods=dict())
+    nt = None
+    temp_out = prcp_out = None
+    for hemi in np.unique(hemis):
+        t0, t1, y0, y1 = _period(hemi, times)
+        tsel = np.nonzero((times >= t0) & (times <= t1))[0]
+        tsel = slice(tsel[0], tsel[-1] + 1)
+        ptimes = times[tsel]
+        if nt is None:
+            nt = len(ptimes)
+            shape = (len(gdirs), nt)
+            temp_out = np.lib.format.open_memmap(
+                os.path.join(output_dir, 'temp.npy'), mode='w+',
+                dtype=np.float64, shape=shape)
+            prcp_out = np.lib.format.open_memmap(
+                os.path.join(output_dir, 'prcp.npy'), mode='w+',
+                dtype=np.float64, shape=shape)
+        assert len(ptimes) == nt and nt % 12 == 0
+        meta['periods'][hemi] = dict(t0=str(ptimes[0].date()), nt=nt,
+                                     hydro_yr_0=y0+1, hydro_yr_1=y1)
+
+        # Monthly anomalies to the 1961-1990 climatology, all grid points
+        tmp = ts_tmp[tsel].astype(np.float64)
+        pre = ts_pre[tsel].astype(np.float64)
+        months = ptimes.month.values - 1
+        ref = (ptimes.year >= 1961) & (ptimes.year <= 1990)
+        clim_tmp = np.zeros((12, ) + tmp.shape[1:])
+        clim_pre = np.zeros((12, ) + tmp.shape[1:])
+        with warnings.catch_warnings():
+            # Mean of empty slice (no reference data)
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for m in range(12):
+                clim_tmp[m] = np.nanmean(tmp[ref & (months == m)], axis=0)
+                clim_pre[m] = np.nanmean(pre[ref & (months == m)], axis=0)
+        ok_pix = _pad(np.all(np.isfinite(tmp), axis=0) &
+                      np.all(np.isfinite(clim_tmp), axis=0), value=False)
+        tmp, pre = _pad(tmp), _pad(pre)
+        clim_tmp, clim_pre = _pad(clim_tmp), _pad(clim_pre)
+
+        sel = np.nonzero((hemis == hemi) & ok)[0]
+        jj, ii, weights, has_data = _ts_stencils(
+            ok_pix, lon[0], lon[1] - lon[0], lat[0], lat[1] - lat[0],
+            tj[sel], ti[sel], ref_lon[sel], ref_lat[sel])
+        for rid in rgi_ids[sel[~has_data]]:
+            errors[rid] = 'there is no climate data'
+
+        for c in range(0, len(sel), CHUNK_SIZE):
+            cs = slice(c, c + CHUNK_SIZE)
+            g = sel[cs]
+            j, i, w = jj[cs], ii[cs], weights[cs]
+            ctmp = clim_tmp[months][:, j, i]
+            cpre = clim_pre[months][:, j, i]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                a_tmp = _weighted((tmp[:, j, i] - ctmp), w)
+                a_sca = _weighted(pre[:, j, i] / cpre, w)
+                a_ano = _weighted((pre[:, j, i] - cpre), w)
+                # Add the anomalies to the CL climatology
+                loc_tmp = cl_temp[:, cj[g], ci[g]][months]
+                loc_pre = cl_prcp[:, cj[g], ci[g]][months]
+                out_tmp = a_tmp + loc_tmp
+                out_pre = a_sca * loc_pre
+                # Standard anomalies where the scaled ones are not valid
+                out_pre = np.where(np.isfinite(out_pre), out_pre,
+                                   a_ano + loc_pre).clip(0)
+            temp_out[g] = out_tmp.T
+            prcp_out[g] = out_pre.T
+        for k in sel[has_data]:
+            if not (np.all(np.isfinite(temp_out[k])) and
+                    np.all(np.isfinite(prcp_out[k]))):
+                errors[rgi_ids[k]] = 'non-finite climate data'
+
+    temp_out.flush()
+    prcp_out.flush()
+    np.save(os.path.join(output_dir, 'rgi_ids.npy'), rgi_ids)
+    np.save(os.path.join(output_dir, 'ref_pix.npy'),
+            np.stack([ref_hgt, ref_lon, ref_lat], axis=1))
+    np.save(os.path.join(output_dir, 'grad.npy'), grad)
+    np.save(os.path.join(output_dir, 'grad_ok.npy'), grad_ok)
+    np.save(os.path.join(output_dir, 'hemisphere.npy'), hemis)
+    meta['errors'] = errors
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    log.workflow('CRU window: %d glaciers, %d without climate data',
+                 len(gdirs), len(errors))
+
+
+@contextmanager
+def cru_region_window(gdirs, shm_dir=None):
+    """Context manager computing the climate of all glaciers of a region.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory
+        the glaciers to process
+    shm_dir : str
+        where to write the arrays (default: ``/dev/shm`` if available,
+        the working directory otherwise)
+
+    Yields
+    ------
+    the directory to pass to :py:func:`process_cru_data`
+    """
+
+    if shm_dir is None:
+        shm_dir = '/dev/shm'
+        if not os.path.isdir(shm_dir):
+            shm_dir = cfg.PATHS['working_dir']
+    output_dir = os.path.join(shm_dir, 'cru_region_{}'.format(os.getpid()))
+    utils.mkdir(output_dir, reset=True)
+    try:
+        _write_window(utils.tolist(gdirs), output_dir)
+        yield output_dir
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+@entity_task(log)
+def process_cru_data(gdir, window_dir):
+    """Same as ``tasks.process_cru_data``, from the region window.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    window_dir : str
+        the directory given by :py:func:`cru_region_window`
+    """
+
+    k = np.nonzero(np.load(os.path.join(window_dir, 'rgi_ids.npy')) ==
+                   gdir.rgi_id)[0]
+    if len(k) == 0:
+        raise RuntimeError('({}) not in the CRU window'.format(gdir.rgi_id))
+    k = k[0]
+    with open(os.path.join(window_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if gdir.rgi_id in meta['errors']:
+        raise RuntimeError('({}) {}'.format(gdir.rgi_id,
+                                            meta['errors'][gdir.rgi_id]))
+
+    period = meta['periods'][gdir.hemisphere]
+    time = pd.date_range(period['t0'], periods=period['nt'], freq='MS')
+    temp = np.load(os.path.join(window_dir, 'temp.npy'), mmap_mode='r')[k]
+    prcp = np.load(os.path.join(window_dir, 'prcp.npy'), mmap_mode='r')[k]
+    hgt, lon, lat = np.load(os.path.join(window_dir, 'ref_pix.npy'))[k]
+    ts_grad = None
+    if np.load(os.path.join(window_dir, 'grad_ok.npy'))[k]:
+        # As a time series, like the climate data
+        grad = np.load(os.path.join(window_dir, 'grad.npy'))[k]
+        ts_grad = grad[time.month.values - 1]
+
+    gdir.write_monthly_climate_file(time, np.array(prcp), np.array(temp),
+                                    hgt, lon, lat, gradient=ts_grad)
+    gdir.write_pickle({'baseline_climate_source': meta['source'],
+                       'baseline_hydro_yr_0': period['hydro_yr_0'],
+                       'baseline_hydro_yr_1': period['hydro_yr_1']},
+                      'climate_info')
+
+
+def process_cru_data_region(gdirs, **kwargs):
+    """Same as ``process_cru_data`` on all glaciers, with one bulk read.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory
+        the glaciers to process
+    **kwargs :
+        passed to :py:func:`cru_region_window`
+    """
+    gdirs = utils.tolist(gdirs)
+    if len(gdirs) == 0:
+        return
+    with cru_region_window(gdirs, **kwargs) as window_dir:
+        execute_entity_task(process_cru_data, gdirs, window_dir=window_dir)
@@ -0,0 +1,320 @@
+"""Distributed execution of entity tasks on several nodes.
+
+A region job runs on one node, so that the large regions take many times
+longer than the others. Here the job script runs as a coordinator, and
+worker processes on any number of nodes connect to it over TCP sockets
+(``multiprocessing.connection``, authenticated with a shared key):
+
+- the coordinator hands the glaciers out one by one, in the order given by
+  the scheduler (:py:mod:`gmd_cluster_scripts.scheduling`), to the first idle
+  worker. Workers can join at any time, and the glacier of a worker which
+  dies is handed to another one
+- the workers get the coordinator's config with each task (so that the
+  ``cfg.PARAMS`` of the script apply), and send back the task outputs and
+  the status of each task, which the coordinator keeps in
+  :py:attr:`Coordinator.task_log`
+
+The glacier directories are not transferred: the working directory must be
+on a filesystem shared by all nodes.
+
+Usage, in the run script::
+
+    with Coordinator(port=5123) as coordinator:
+        execute_entity_task(tasks.glacier_masks, gdirs)
+        ...
+    coordinator.write_task_log()
+
+and on each node (e.g. with ``srun``)::
+
+    python3 -m gmd_cluster_scripts.distributed --address host:5123 --nprocs 16
+
+with the same ``GMD_DIST_AUTHKEY`` environment variable everywhere. For
+local tests, :py:meth:`Coordinator.start_local_workers` starts worker
+processes on the same machine.
+"""
+# Built ins
+import os
+import sys
+import time
+import queue
+import socket
+import logging
+import argparse
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+# External libs
+import pandas as pd
+
+# Locals
+import oggm.cfg as cfg
+from gmd_cluster_scripts import scheduling
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Where the authentication key is read from
+AUTHKEY_ENV = 'GMD_DIST_AUTHKEY'
+
+
+def _authkey(authkey=None):
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV)
+    if authkey is None:
+        raise ValueError('No authentication key: set the {} environment '
+                         'variable'.format(AUTHKEY_ENV))
+    if isinstance(authkey, str):
+        authkey = authkey.encode('utf-8')
+    return authkey
+
+
+def _task_statuses(func, item):
+    """Statuses of the tasks of a scheduler chain, for the task log."""
+    chain = getattr(func, 'chain', None)
+    gdir = item[1] if isinstance(item, tuple) else None
+    if chain is None or not hasattr(gdir, 'get_task_status'):
+        return None
+    if len(item) == 3:
+        chain = scheduling._merge_kwargs(chain, item[2])
+    names = [scheduling._status_name(task, kwargs) for task, kwargs in chain]
+    return {name: gdir.get_task_status(name) for name in names}
+
+
+class Coordinator(object):
+    """Hands the glaciers out to the connected workers.
+
+    Parameters
+    ----------
+    host : str
+        the interface to listen on (default: all)
+    port : int
+        the port to listen on (0 for any free port, see ``address``)
+    authkey : str or bytes
+        the key shared with the workers (default: the ``GMD_DIST_AUTHKEY``
+        environment variable)
+    """
+
+    def __init__(self, host='', port=0, authkey=None):
+        self.authkey = _authkey(authkey)
+        self.listener = Listener((host, port), authkey=self.authkey)
+        self.address = (socket.gethostname(), self.listener.address[1])
+        self.task_log = dict()
+        self._todo = queue.Queue()
+        self._results = queue.Queue()
+        self._job = None
+        self._job_id = 0
+        self._closed = False
+        self._n_workers = 0
+        self._lock = threading.Lock()
+        self._local_workers = []
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+        log.workflow('Coordinator listening on %s:%d', *self.address)
+
+    @property
+    def n_workers(self):
+        return self._n_workers
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                # Failed authentication or broken connection
+                log.warning('Refused a worker connection')
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,),
+                                      daemon=True)
+            thread.start()
+
+    def _serve(self, conn):
+        """Feeds one worker (one thread per worker connection)."""
+
+        with self._lock:
+            self._n_workers += 1
+        sent_job = None
+        try:
+            while not self._closed:
+                try:
+                    job_id, k, item = self._todo.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if job_id != self._job_id:
+                    # Leftovers of a previous job which failed
+                    continue
+                try:
+                    if sent_job != job_id:
+                        conn.send(('job', ) + self._job[1:])
+                        sent_job = job_id
+                    conn.send(('item', k, item))
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    log.warning('Lost a worker, giving its glacier to '
+                                'another one')
+                    self._todo.put((job_id, k, item))
+                    return
+                self._results.put((job_id, item) + msg)
+            conn.send(('stop', ))
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._lock:
+                self._n_workers -= 1
+            conn.close()
+
+    def imap_unordered(self, func, items):
+        """Same as ``Pool.imap_unordered``, with the remote workers."""
+
+        items = list(items)
+        self._job_id += 1
+        self._job = (self._job_id, cfg.pack_config(), func)
+        for k, item in enumerate(items):
+            self._todo.put((self._job_id, k, item))
+
+        warned = False
+        for _ in range(len(items)):
+            while True:
+                try:
+                    res = self._results.get(timeout=60)
+                except queue.Empty:
+                    if self._n_workers == 0 and not warned:
+                        log.warning('No worker connected to %s:%d',
+                                    *self.address)
+                        warned = True
+                    continue
+                # Leftovers of a previous job which failed
+                if res[0] == self._job_id:
+                    break
+            _, item, status, k, out, statuses = res
+            if status == 'err':
+                raise RuntimeError('Worker failed on item {}:\n'
+                                   '{}'.format(k, out))
+            if statuses:
+                rgi_id = item[1].rgi_id
+                self.task_log.setdefault(rgi_id, dict()).update(statuses)
+            yield out
+
+    def write_task_log(self, path=None):
+        """Write the task statuses collected from the workers.
+
+        Parameters
+        ----------
+        path : str
+            the csv file (default: ``task_log_distributed.csv`` in the
+            working directory)
+        """
+        if path is None:
+            path = os.path.join(cfg.PATHS['working_dir'],
+                                'task_log_distributed.csv')
+        df = pd.DataFrame.from_dict(self.task_log, orient='index')
+        df.index.name = 'rgi_id'
+        df.sort_index().to_csv(path)
+        return path
+
+    def start_local_workers(self, nprocs):
+        """Start worker processes on this machine (e.g. for tests)."""
+        address = ('localhost', self.address[1])
+        for _ in range(nprocs):
+            p = mp.Process(target=run_worker, args=(address, self.authkey))
+            p.start()
+            self._local_workers.append(p)
+
+    def close(self):
+        self._closed = True
+        self.listener.close()
+        for p in self._local_workers:
+            p.join()
+        self._local_workers = []
+
+    def __enter__(self):
+        scheduling.set_executor(self)
+        return self
+
+    def __exit__(self, *args):
+        scheduling.set_executor(None)
+        self.close()
+
+
+def _connect(address, authkey, timeout=600.):
+    """Connect to the coordinator, waiting for it to be up."""
+    start = time.time()
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except (ConnectionRefusedError, socket.gaierror):
+            if time.time() - start > timeout:
+                raise
+            time.sleep(2)
+
+
+def run_worker(address, authkey=None, timeout=600.):
+    """Run tasks for a coordinator until it stops.
+
+    Parameters
+    ----------
+    address : tuple
+        the (host, port) of the coordinator
+    authkey : str or bytes
+        the shared key (default: the ``GMD_DIST_AUTHKEY`` environment
+        variable)
+    timeout : float
+        how long to wait for the coordinator to be up
+    """
+
+    conn = _connect(tuple(address), _authkey(authkey), timeout=timeout)
+    if not cfg.IS_INITIALIZED:
+        cfg.initialize(logging_level='WORKFLOW')
+    func = None
+    try:
+        while True:
+            msg = conn.recv()
+            if msg[0] == 'stop':
+                break
+            if msg[0] == 'job':
+                _, cfg_contents, func = msg
+                cfg.unpack_config(cfg_contents)
+                continue
+            _, k, item = msg
+            try:
+                out = func(item)
+                conn.send(('ok', k, out, _task_statuses(func, item)))
+            except Exception:
+                conn.send(('err', k, traceback.format_exc(), None))
+    except EOFError:
+        # The coordinator is gone
+        pass
+    finally:
+        conn.close()
+
+
+def run_workers(address, nprocs=None, authkey=None):
+    """Run ``nprocs`` worker processes (default: one per core)."""
+    if nprocs is None:
+        nprocs = mp.cpu_count()
+    procs = [mp.Process(target=run_worker, args=(address, authkey))
+             for _ in range(nprocs)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Start workers for a '
+                                                 'task coordinator.')
+    parser.add_argument('--address', required=True,
+                        help='host:port of the coordinator')
+    parser.add_argument('--nprocs', type=int, default=None,
+                        help='number of worker processes (default: one per '
+                             'core)')
+    args = parser.parse_args(args)
+    host, port = args.address.rsplit(':', 1)
+    run_workers((host, int(port)), nprocs=args.nprocs)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
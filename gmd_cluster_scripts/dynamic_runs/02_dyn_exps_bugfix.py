@@ -1,12 +1,18 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import salem
 import oggm.cfg as cfg
-from oggm import utils, workflow, tasks
+from oggm import utils, tasks
+from gmd_cluster_scripts.batchflow import execute_random_climate_batched
+from gmd_cluster_scripts.runoutput import RunOutputAccumulator
+from gmd_cluster_scripts.scheduling import (execute_entity_task,
+                                            set_checkpoint, sort_by_cost)
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
+from gmd_cluster_scripts.checkpoint import Checkpoint
+from gmd_cluster_scripts.profiling import compile_task_profile
 
 # Time
 start = time.time()
@@ -23,6 +29,10 @@ WORKING_DIR = os.environ["WORKDIR"]
 utils.mkdir(WORKING_DIR)
 cfg.PATHS['working_dir'] = WORKING_DIR
 
+# Durable checkpoints: a restarted job resumes where the last one stopped
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR',
+                                os.path.join(WORKING_DIR, 'checkpoint'))
+
 # Use multiprocessing?
 cfg.PARAMS['use_multiprocessing'] = True
 
@@ -35,58 +45,57 @@ cfg.PARAMS['continue_on_error'] = True
 cfg.PARAMS['auto_skip_task'] = False
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
 log.info('Starting run for RGI reg: ' + rgi_reg)
 log.info('Number of glaciers: {}'.format(len(rgidf)))
 
-# Go - initialize working directories
-gdirs = workflow.init_glacier_regions(rgidf, from_prepro_level=4)
+# Go - initialize working directories (from the checkpoints if any)
+checkpoint = Checkpoint(CHECKPOINT_DIR)
+set_checkpoint(checkpoint)
+gdirs = checkpoint.init_glacier_regions(rgidf, from_prepro_level=4)
 
 # Init glaciers
-workflow.execute_entity_task(tasks.init_present_time_glacier, gdirs)
+execute_entity_task(tasks.init_present_time_glacier, gdirs)
 
-# Runs
+# Runs - the small glaciers by batches, the others with all scenarios of a
+# glacier in one task. The runs write the compiled output directly, without
+# any file per glacier (and are therefore not cached): its rows are kept
+# with the checkpoints, so that a restarted job skips the runs already done
 nyears = 300
 task_names = []
 
-fsuf = '_rdn_2000'
-log.info('Start experiment ' + fsuf)
-workflow.execute_entity_task(tasks.run_random_climate, gdirs, seed=1,
-                             nyears=nyears, y0=2000,
-                             output_filesuffix=fsuf)
-log.info('Compiling output ' + fsuf + ' ...')
-utils.compile_run_output(gdirs, filesuffix=fsuf)
-task_names.append('run_random_climate' + fsuf)
-
-fsuf = '_rdn_2000_tbias_p05'
-log.info('Start experiment ' + fsuf)
-workflow.execute_entity_task(tasks.run_random_climate, gdirs, seed=2,
-                             nyears=nyears, y0=2000,
-                             temperature_bias=0.5,
-                             output_filesuffix=fsuf)
-log.info('Compiling output ' + fsuf + ' ...')
-utils.compile_run_output(gdirs, filesuffix=fsuf)
-task_names.append('run_random_climate' + fsuf)
-
-fsuf = '_rdn_2000_tbias_m05'
-log.info('Start experiment ' + fsuf)
-workflow.execute_entity_task(tasks.run_random_climate, gdirs, seed=3,
-                             nyears=nyears, y0=2000,
-                             temperature_bias=-0.5,
-                             output_filesuffix=fsuf)
-log.info('Compiling output ' + fsuf + ' ...')
-utils.compile_run_output(gdirs, filesuffix=fsuf)
-task_names.append('run_random_climate' + fsuf)
+scenarios = [
+    dict(output_filesuffix='_rdn_2000', seed=1, y0=2000),
+    dict(output_filesuffix='_rdn_2000_tbias_p05',
+         seed=2, y0=2000, temperature_bias=0.5),
+    dict(output_filesuffix='_rdn_2000_tbias_m05',
+         seed=3, y0=2000, temperature_bias=-0.5),
+]
+log.info('Start experiments ' + ', '.join(s['output_filesuffix']
+                                          for s in scenarios))
+accumulator = RunOutputAccumulator(
+    sorted(gd.rgi_id for gd in gdirs), nyears,
+    filesuffixes=[s['output_filesuffix'] for s in scenarios],
+    durable_dir=os.path.join(checkpoint.checkpoint_dir, 'accumulator'))
+execute_random_climate_batched(gdirs, scenarios, nyears=nyears,
+                               accumulator=accumulator)
+for s in scenarios:
+    fsuf = s['output_filesuffix']
+    log.info('Writing output ' + fsuf + ' ...')
+    accumulator.finalize(filesuffix=fsuf)
+    task_names.append('run_random_climate' + fsuf)
+accumulator.close()
 
 
 # End
 utils.compile_task_log(gdirs, filesuffix='_2000bf', task_names=task_names)
+compile_task_profile(gdirs, filesuffix='_2000bf', since=start)
 
 # Log
 m, s = divmod(time.time() - start, 60)
@@ -0,0 +1,288 @@
+"""Several random climate scenarios per glacier, in one task.
+
+The dynamical runs call ``run_random_climate`` once per scenario (t*, 2000,
++/- 0.5 degC...), so that every call reloads the model flowlines, the
+climate and the mass-balance calibration of every glacier, and pays for the
+dispatch of the whole region again. :py:func:`run_random_climate_ensemble`
+runs a list of scenarios per glacier instead:
+
+- the model flowlines are read once, and copied for each run
+- the mass-balance model is built once per climate period (``y0``,
+  ``halfsize`` and ``bias``), and its random state is reset to the seed of
+  each scenario, and its temperature bias set, before the run
+- the mass-balance is interpolated in lookup tables, computed once per
+  climate period (:py:mod:`~gmd_cluster_scripts.mbtable`)
+- optionally, the runs stop when the glacier reaches steady state, and/or
+  write their diagnostics to a region-level accumulator instead of the
+  glacier directory (:py:mod:`~gmd_cluster_scripts.runoutput`)
+
+Each scenario writes the same files as ``run_random_climate`` with its
+``output_filesuffix``, and is logged in the glacier's task log as
+``'run_random_climate' + output_filesuffix``, so that the outputs and task
+logs are compiled as before.
+
+The experiments on another glacier geometry (e.g. rectangular beds) rewrite
+the inversion and model flowlines files. :py:func:`stash_files` and
+:py:func:`unstash_files` move the default files aside and back around such an
+experiment, so that the glacier directory (and its checkpoint) keeps the
+default geometry.
+"""
+# Built ins
+import os
+import copy
+import logging
+
+# External libs
+import numpy as np
+
+# Locals
+from oggm.utils import entity_task
+from oggm.core.massbalance import (MultipleFlowlineMassBalance,
+                                   RandomMassBalance, ConstantMassBalance)
+from gmd_cluster_scripts.mbtable import binned_mb_model
+from gmd_cluster_scripts.runoutput import robust_model_run
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# The arguments which can differ between the scenarios
+SCENARIO_KEYS = ['seed', 'y0', 'halfsize', 'bias', 'temperature_bias',
+                 'output_filesuffix']
+
+
+def scenario_defaults(**kwargs):
+    """The default scenario arguments, updated with ``kwargs``."""
+    out = dict(seed=None, y0=None, halfsize=15, bias=None,
+               temperature_bias=None, output_filesuffix='')
+    out.update(kwargs)
+    return out
+
+
+def random_mb_model(gdir, scenario, climate_filename='climate_monthly',
+                    climate_input_filesuffix='', fls=None, tables=None):
+    """The mass-balance model of ``run_random_climate`` for a scenario.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    scenario : dict
+        the scenario arguments (all of ``SCENARIO_KEYS``)
+    climate_filename : str
+        the climate file to use
+    climate_input_filesuffix : str
+        the suffix of the climate file
+    fls : list
+        the model flowlines: if given, the mass-balance is interpolated in
+        lookup tables (see :py:mod:`~gmd_cluster_scripts.mbtable`)
+    tables : dict
+        the lookup tables to use or fill, shared between the scenarios with
+        the same climate period
+    """
+    mb = MultipleFlowlineMassBalance(gdir, mb_model_class=RandomMassBalance,
+                                     y0=scenario['y0'],
+                                     halfsize=scenario['halfsize'],
+                                     bias=scenario['bias'],
+                                     seed=scenario['seed'],
+                                     filename=climate_filename,
+                                     input_filesuffix=climate_input_filesuffix)
+    if fls is not None:
+        mb = binned_mb_model(mb, fls, tables=tables)
+    if scenario['temperature_bias'] is not None:
+        mb.temp_bias = scenario['temperature_bias']
+    return mb
+
+
+def _reset_random_state(mb, seed):
+    """Same random years as a new mass-balance model with this seed."""
+    for fl_mb in mb.flowline_mb_models:
+        fl_mb = getattr(fl_mb, 'random_mb', fl_mb)
+        fl_mb.rng = np.random.RandomState(seed)
+        fl_mb._state_yr = dict()
+
+
+@entity_task(log)
+def run_random_climate_ensemble(gdir, scenarios, nyears=1000, y0=None,
+                                halfsize=15, bias=None,
+                                climate_filename='climate_monthly',
+                                climate_input_filesuffix='',
+                                init_model_fls=None,
+                                zero_initial_glacier=False, steady_state=None,
+                                accumulator=None, **kwargs):
+    """Same as ``run_random_climate``, for a list of scenarios.
+
+    A scenario which fails does not stop the others: the error is logged
+    for this scenario, and the first error is raised after the last run.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    scenarios : list of dict
+        the arguments of each scenario (see ``SCENARIO_KEYS``), completing
+        the arguments below. The ``output_filesuffix`` must differ between
+        the scenarios.
+    nyears : int
+        the length of the runs
+    y0 : int
+        the central year of the random climate period (default: t*)
+    halfsize : int
+        the half-size of the random climate period
+    bias : float
+        the mass-balance bias (default: the calibrated one)
+    climate_filename : str
+        the climate file to use
+    climate_input_filesuffix : str
+        the suffix of the climate file
+    init_model_fls : list
+        the initial flowlines (default: the model flowlines)
+    zero_initial_glacier : bool
+        start the runs from no glacier
+    steady_state : SteadyState
+        stop the runs when the glacier reaches steady state
+    accumulator : RunOutputAccumulator
+        write the diagnostics there instead of the glacier directory
+    **kwargs :
+        passed to ``robust_model_run``
+    """
+
+    suffixes = [s.get('output_filesuffix', '') for s in scenarios]
+    if len(set(suffixes)) < len(suffixes):
+        raise ValueError('the scenarios must have different output suffixes')
+    for s in scenarios:
+        unknown = set(s) - set(SCENARIO_KEYS)
+        if unknown:
+            raise ValueError('unknown scenario arguments: '
+                             '{}'.format(sorted(unknown)))
+
+    if init_model_fls is None:
+        init_model_fls = gdir.read_pickle('model_flowlines')
+
+    defaults = scenario_defaults(y0=y0, halfsize=halfsize, bias=bias)
+    mb_models = dict()
+    first_error = None
+    for scenario in scenarios:
+        s = dict(defaults, **scenario)
+        task_name = 'run_random_climate' + s['output_filesuffix']
+        try:
+            key = (s['y0'], s['halfsize'], s['bias'])
+            mb = mb_models.get(key)
+            if mb is None:
+                mb = random_mb_model(gdir, s, climate_filename,
+                                     climate_input_filesuffix,
+                                     fls=init_model_fls)
+                mb_models[key] = mb
+            else:
+                _reset_random_state(mb, s['seed'])
+                mb.temp_bias = (0. if s['temperature_bias'] is None else
+                                s['temperature_bias'])
+            robust_model_run(gdir, output_filesuffix=s['output_filesuffix'],
+                             mb_model=mb, ys=0, ye=nyears,
+                             init_model_fls=copy.deepcopy(init_model_fls),
+                             zero_initial_glacier=zero_initial_glacier,
+                             steady_state=steady_state,
+                             accumulator=accumulator, **kwargs)
+        except Exception as err:
+            if first_error is None:
+                first_error = err
+            log.warning('(%s) %s failed: %s', gdir.rgi_id, task_name, err)
+            gdir.log(task_name, err=err)
+            continue
+        gdir.log(task_name)
+
+    log.info('(%s) %d random climate scenarios, %d climate periods',
+             gdir.rgi_id, len(scenarios), len(mb_models))
+    if first_error is not None:
+        raise first_error
+
+
+@entity_task(log)
+def run_constant_climate(gdir, nyears=1000, y0=None, bias=None,
+                         temperature_bias=None,
+                         climate_filename='climate_monthly',
+                         climate_input_filesuffix='', output_filesuffix='',
+                         init_model_fls=None, zero_initial_glacier=False,
+                         steady_state=None, accumulator=None, **kwargs):
+    """Same as ``run_constant_climate``, with an optional steady state.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    nyears : int
+        the length of the run
+    y0 : int
+        the central year of the constant climate period (default: t*)
+    bias : float
+        the mass-balance bias (default: the calibrated one)
+    temperature_bias : float
+        add a bias to the temperature timeseries
+    climate_filename : str
+        the climate file to use
+    climate_input_filesuffix : str
+        the suffix of the climate file
+    output_filesuffix : str
+        the suffix of the output files
+    init_model_fls : list
+        the initial flowlines (default: the model flowlines)
+    zero_initial_glacier : bool
+        start the run from no glacier
+    steady_state : SteadyState
+        stop the run when the glacier reaches steady state
+    accumulator : RunOutputAccumulator
+        write the diagnostics there instead of the glacier directory
+    **kwargs :
+        passed to ``robust_model_run``
+    """
+
+    mb = MultipleFlowlineMassBalance(gdir, mb_model_class=ConstantMassBalance,
+                                     y0=y0, bias=bias,
+                                     filename=climate_filename,
+                                     input_filesuffix=climate_input_filesuffix)
+    if temperature_bias is not None:
+        mb.temp_bias = temperature_bias
+    return robust_model_run(gdir, output_filesuffix=output_filesuffix,
+                            mb_model=mb, ys=0, ye=nyears,
+                            init_model_fls=init_model_fls,
+                            zero_initial_glacier=zero_initial_glacier,
+                            steady_state=steady_state,
+                            accumulator=accumulator, **kwargs)
+
+
+@entity_task(log)
+def stash_files(gdir, filenames, suffix='_stash'):
+    """Move files of the glacier directory aside.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    filenames : list of str
+        the files to move (``gdir.get_filepath`` names)
+    suffix : str
+        the suffix of the moved files
+    """
+    for fname in filenames:
+        path = gdir.get_filepath(fname)
+        if os.path.exists(path):
+            os.replace(path, gdir.get_filepath(fname, filesuffix=suffix))
+
+
+@entity_task(log)
+def unstash_files(gdir, filenames, suffix='_stash'):
+    """Move the files moved aside by :py:func:`stash_files` back.
+
+    The files written since are overwritten, or removed if there was no
+    file to move aside.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    filenames : list of str
+        the files to move back (``gdir.get_filepath`` names)
+    suffix : str
+        the suffix of the moved files
+    """
+    for fname in filenames:
+        path = gdir.get_filepath(fname)
+        stashed = gdir.get_filepath(fname, filesuffix=suffix)
+        if os.path.exists(stashed):
+            os.replace(stashed, path)
+        elif os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,142 @@
+"""Indexed lookup of the RGI intersects.
+
+With ``cfg.set_intersects_db(rgif)``, the whole region intersects
+GeoDataFrame is shipped to every worker, and ``define_glacier_region``
+selects the intersects of each glacier by scanning all of its rows. For the
+large regions, this is a linear scan repeated tens of thousands of times.
+
+Here the intersects are grouped by RGI id once, and written to disk with the
+index. The directories are initialized without intersects, and
+:py:func:`write_intersects` then writes each glacier's ``intersects`` file
+(as ``define_glacier_region`` would) from a dictionary lookup. The workers
+load the index once per process.
+"""
+# Built ins
+import os
+import pickle
+import logging
+from collections import defaultdict
+
+# External libs
+import numpy as np
+import geopandas as gpd
+import salem
+
+# Locals
+import oggm.cfg as cfg
+from oggm import workflow
+from oggm.utils import entity_task
+from gmd_cluster_scripts.scheduling import execute_entity_task
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# The indexes already loaded by this process
+_LOADED_INDEXES = dict()
+
+
+class IntersectsIndex(object):
+    """The RGI intersects, grouped by RGI id.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        the intersects (with ``RGIId_1`` and ``RGIId_2`` columns)
+    """
+
+    def __init__(self, gdf):
+        self.gdf = gdf.reset_index(drop=True)
+        index = defaultdict(list)
+        for col in ['RGIId_1', 'RGIId_2']:
+            for rgi_id, rows in self.gdf.groupby(col).indices.items():
+                index[rgi_id].extend(rows)
+        self.index = {k: np.unique(v) for k, v in index.items()}
+
+    def get(self, rgi_id):
+        """The intersects of a glacier (possibly empty)."""
+        return self.gdf.iloc[self.index.get(rgi_id, [])]
+
+
+def build_intersects_index(intersects_db, path=None):
+    """Build the index and write it to disk.
+
+    Parameters
+    ----------
+    intersects_db : str or GeoDataFrame
+        the intersects, as given to ``cfg.set_intersects_db``
+    path : str
+        where to write the index (default: ``intersects_index.pkl`` in the
+        working directory)
+
+    Returns
+    -------
+    the path to the index
+    """
+    if path is None:
+        path = os.path.join(cfg.PATHS['working_dir'], 'intersects_index.pkl')
+    if isinstance(intersects_db, str):
+        intersects_db = gpd.read_file(intersects_db)
+    with open(path, 'wb') as f:
+        pickle.dump(IntersectsIndex(intersects_db), f, protocol=-1)
+    return path
+
+
+def _get_index(path):
+    if path not in _LOADED_INDEXES:
+        with open(path, 'rb') as f:
+            _LOADED_INDEXES[path] = pickle.load(f)
+    return _LOADED_INDEXES[path]
+
+
+@entity_task(log, writes=['intersects'])
+def write_intersects(gdir, index_path=None):
+    """Writes the glacier's intersects, as ``define_glacier_region`` does.
+
+    Parameters
+    ----------
+    gdir : GlacierDirectory
+        the glacier directory to process
+    index_path : str
+        the index, as written by :py:func:`build_intersects_index`
+    """
+    if index_path is None:
+        index_path = os.path.join(cfg.PATHS['working_dir'],
+                                  'intersects_index.pkl')
+    gdf = _get_index(index_path).get(gdir.rgi_id)
+    if len(gdf) > 0:
+        gdf = salem.transform_geopandas(gdf, to_crs=gdir.grid.proj)
+        if hasattr(gdf.crs, 'srs'):
+            # salem uses pyproj
+            gdf.crs = gdf.crs.srs
+        gdf.to_file(gdir.get_filepath('intersects'))
+
+
+def init_glacier_regions_indexed(rgidf, intersects_db, **kwargs):
+    """Same as ``init_glacier_regions``, with indexed intersects.
+
+    Parameters
+    ----------
+    rgidf : GeoDataFrame
+        the RGI glaciers
+    intersects_db : str or GeoDataFrame
+        the intersects, as given to ``cfg.set_intersects_db``
+    **kwargs :
+        passed to ``init_glacier_regions``
+
+    Returns
+    -------
+    the list of glacier directories
+    """
+
+    # No intersects in the directories creation (and in the workers' config)
+    use_intersects = cfg.PARAMS['use_intersects']
+    cfg.PARAMS['use_intersects'] = False
+    cfg.set_intersects_db()
+    try:
+        gdirs = workflow.init_glacier_regions(rgidf, **kwargs)
+    finally:
+        cfg.PARAMS['use_intersects'] = use_intersects
+
+    index_path = build_intersects_index(intersects_db)
+    execute_entity_task(write_intersects, gdirs, index_path=index_path)
+    return gdirs
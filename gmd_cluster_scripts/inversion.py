@@ -0,0 +1,656 @@
+"""Batched mass-conservation inversion.
+
+The inversion sweeps (``inversion_runs/01_inv_exps.py``, the HEF figure)
+call ``tasks.mass_conservation_inversion`` once per Glen A factor, re-reading
+the inversion input and recomputing the same flux and slope terms each time.
+:py:func:`mass_conservation_inversion_multi` inverts a glacier for a whole
+vector of A factors (and sliding parameters) at once: the flowlines are read
+once, and the thickness is computed for all parameter combinations in one
+array operation per flowline.
+
+The computations are the same as in ``mass_conservation_inversion``,
+including the shape factor iterations (``use_shape_factor_for_inversion``)
+and their order: the thickness is computed with the current shape factors,
+which are then updated from it, until no shape factor decreases by more
+than ``SF_TOL`` (or ``MAX_SF_ITER`` iterations); the thickness is finally
+computed again with the last shape factors. There are two deviations,
+which do not change the converged results:
+
+- the iterations stop separately for each parameter combination (OGGM
+  has a single combination, so this is the same per glacier)
+- with sliding, each Newton solve starts from the thickness of the
+  previous iteration instead of solving from scratch
+With sliding, the thickness is the positive root of a degree 5 polynomial
+at each point: instead of ``np.roots`` point by point, Newton's method is
+run on all points and combinations at once (see
+:py:func:`_inversion_newton`).
+
+:py:func:`run_inversion_sweep` runs the sweeps over several inversion
+configurations for all glaciers of a region, and writes the volumes of all
+glaciers, configurations and A factors to a single file, instead of one
+``glacier_statistics`` file per configuration and factor.
+
+:py:func:`calibrate_glen_a` and :py:func:`calibrate_glacier_glen_a` find
+the A giving a target total (or glacier) volume, with a bracketed Newton
+method using the analytical derivative of the volume with respect to A:
+a few inversions instead of a sweep.
+"""
+# Built ins
+import os
+import logging
+
+# External libs
+import numpy as np
+import xarray as xr
+
+# Locals
+import oggm.cfg as cfg
+from oggm import utils, tasks
+from oggm.utils import entity_task
+from gmd_cluster_scripts.scheduling import execute_entity_task
+from gmd_cluster_scripts.params import ParamsContext
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Shape factor iterations, as in mass_conservation_inversion
+SF_TOL = 1e-2
+MAX_SF_ITER = 20
+
+# Newton iterations of the sliding case
+NEWTON_RTOL = 1e-12
+NEWTON_MAXITER = 50
+
+
+def _shape_factor_func():
+    use_sf = cfg.PARAMS.get('use_shape_factor_for_inversion')
+    if use_sf in ['Adhikari', 'Nye']:
+        return utils.shape_factor_adhikari
+    elif use_sf == 'Huss':
+        return utils.shape_factor_huss
+    return None
+
+
+def _inversion_newton(a3s, a0s, thick_guess=None):
+    """Solve h**5 + a3 h**3 + a0 = 0 for all points at once.
+
+    With a3 > 0 and a0 < 0, the polynomial is increasing and convex for
+    h > 0, with a single positive root: Newton's method converges to it from
+    any positive first guess, and monotonically from the right of the root.
+    Without a guess, it starts from the smallest of the roots of
+    ``h**5 + a0`` and ``a3 h**3 + a0``, which are both above the root. The
+    root is also above ``2**(-1/3)`` times this start: the guesses below
+    this bound (from which the first Newton step would overshoot far to the
+    right) are replaced by the default start.
+
+    Parameters
+    ----------
+    a3s : ndarray
+        the sliding coefficients (broadcastable to ``a0s``)
+    a0s : ndarray
+        the (negative) constant coefficients
+    thick_guess : ndarray, optional
+        a first guess, e.g. the solution for close parameters
+    """
+
+    h = np.minimum((-a0s) ** cfg.ONE_FIFTH, (-a0s / a3s) ** (1. / 3.))
+    if thick_guess is not None:
+        use_guess = thick_guess >= h * 2. ** (-1. / 3.)
+        h = np.where(use_guess, np.minimum(thick_guess, h), h)
+    for _ in range(NEWTON_MAXITER):
+        h2 = h * h
+        dh = (h2 * h2 * h + a3s * h2 * h + a0s) / (5 * h2 * h2 + 3 * a3s * h2)
+        h = h - dh
+        if np.all(np.abs(dh) <= NEWTON_RTOL * h):
+            break
+    else:
+        n = np.sum(~(np.abs(dh) <= NEWTON_RTOL * h))
+        log.warning('inversion: Newton iterations did not converge at %d '
+                    'points after %d iterations', n, NEWTON_MAXITER)
+    return h
+
+
+def _solve_thick(a0s, a3s, has_flux, thick_guess=None):
+    """Thickness at each point, for each parameter combination.
+
+    Parameters
+    ----------
+    a0s : ndarray
+        the (n_combinations, n_points) constant coefficients
+    a3s : ndarray
+        the (n_combinations, 1) sliding coefficients
+    has_flux : ndarray
+        the (n_points, ) points with a positive flux (the others are zero)
+    thick_guess : ndarray, optional
+        a first guess for the sliding case, shaped like ``a0s``
+    """
+
+    out_thick = np.zeros(a0s.shape)
+    if not has_flux.any():
+        return out_thick
+
+    # Without sliding: closed form
+    nofs = a3s[:, 0] == 0
+    out_thick[np.ix_(nofs, has_flux)] = (-a0s[np.ix_(nofs, has_flux)]
+                                         ) ** cfg.ONE_FIFTH
+
+    # With sliding: all points of all combinations at once
+    if not nofs.all():
+        idx = np.ix_(~nofs, has_flux)
+        guess = None if thick_guess is None else thick_guess[idx]
+        out_thick[idx] = _inversion_newton(a3s[~nofs], a0s[idx],
+                                           thick_guess=guess)
+    return out_thick
+
+
+def _invert_flowlines(cls, glen_a, factors, fs, thick_guess=None,
+                      rgi_id=''):
+    """The batched inversion of the flowlines of a glacier.
+
+    Parameters
+    ----------
+    cls : list
+        the ``inversion_input`` of the glacier
+    glen_a : float
+        glen's creep parameter A
+    factors : ndarray
+        the factors applied to ``glen_a``
+    fs : ndarray
+        the sliding parameters
+    thick_guess : list of ndarray, optional
+        a first guess of the thickness along each flowline (e.g. the output
+        of a previous call with close parameters), used with sliding
+    rgi_id : str
+        for the log messages
+
+    Returns
+    -------
+    (volume, dvolume, thick, volumes): the total volume [m3] and its
+    derivative with respect to A (arrays of shape (n_fs * n_factors, )),
+    and the thickness and volume of each flowline (lists of arrays of shape
+    (n_fs * n_factors, n_points))
+    """
+
+    n_fs, n_fac = len(fs), len(factors)
+
+    # Ice flow params, one row per (fs, factor) combination
+    glen_as = (glen_a * np.tile(factors, n_fs))[:, np.newaxis]
+    fd = 2. / (cfg.N+2) * glen_as
+    fss = np.repeat(fs, n_fac)[:, np.newaxis]
+    a3s = fss / fd
+
+    # Clip the slope, in degrees
+    clip_angle = cfg.PARAMS['min_slope']
+    sf_func = _shape_factor_func()
+
+    out_volume = np.zeros(n_fs * n_fac)
+    out_dvolume = np.zeros(n_fs * n_fac)
+    out_thicks = []
+    out_volumes = []
+    for k, cl in enumerate(cls):
+        # Clip slope to avoid negative and small slopes
+        slope = cl['slope_angle']
+        slope = np.clip(slope, np.deg2rad(clip_angle), np.pi/2.)
+
+        w = cl['width']
+        is_rect = cl['is_rectangular']
+        has_flux = cl['flux_a0'] > 0.
+        a0s = - cl['flux_a0'] / ((cfg.RHO*cfg.G*slope)**3*fd)
+        if np.any(~np.isfinite(a0s)):
+            raise RuntimeError('({}) something went wrong with the '
+                               'inversion'.format(rgi_id))
+
+        sf = np.ones(a0s.shape)
+        thick = None
+        if thick_guess is not None:
+            thick = np.array(thick_guess[k], dtype=float)
+        if sf_func is not None:
+            # Iterate each combination until it converges, each iteration
+            # starting from the thickness of the previous one
+            active = np.ones(len(a0s), dtype=bool)
+            if thick is None:
+                thick = np.zeros(a0s.shape)
+            i = 0
+            while i < MAX_SF_ITER and active.any():
+                thick[active] = _solve_thick(a0s[active] / sf[active]**3,
+                                             a3s[active], has_flux,
+                                             thick_guess=thick[active])
+                shape = sf[active].shape
+                new_sf = sf_func(np.broadcast_to(w, shape), thick[active],
+                                 np.broadcast_to(is_rect, shape))
+                converged = ~np.any((sf[active] - new_sf) > SF_TOL, axis=1)
+                sf[active] = new_sf
+                active[np.nonzero(active)[0][converged]] = False
+                i += 1
+            log.info('(%s) shape factor used, took %d iterations for '
+                     'convergence.', rgi_id, i)
+
+        # As in OGGM: once more with the last shape factors
+        out_thick = _solve_thick(a0s / sf**3, a3s, has_flux,
+                                 thick_guess=thick)
+        assert np.all(np.isfinite(out_thick))
+
+        # volume
+        fac = np.where(is_rect, 1, cfg.TWO_THIRDS)
+        volume = fac * out_thick * w * cl['dx']
+        out_volume += np.sum(volume, axis=1)
+
+        # dh/dA, from the derivative of fd h**5 + fs h**3 = flux term (the
+        # shape factors are taken as constant)
+        h2 = out_thick ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dthick = - fd * h2 * out_thick / (glen_as * (5 * fd * h2 +
+                                                          3 * fss))
+        dthick[out_thick == 0] = 0.
+        out_dvolume += np.sum(fac * dthick * w * cl['dx'], axis=1)
+
+        out_thicks.append(out_thick)
+        out_volumes.append(volume)
+
+    return out_volume, out_dvolume, out_thicks, out_volumes
+
+
+def _sliding_volume_limit(cls, fs):
+    """The volume [m3] of the flowlines for A tending to 0, with sliding.
+
+    The flux is then carried by sliding only (``fs h**3 = flux term``):
+    with ``fs > 0``, this is the largest volume which the inversion can
+    reach, whatever A.
+    """
+
+    clip_angle = cfg.PARAMS['min_slope']
+    sf_func = _shape_factor_func()
+    out = 0.
+    for cl in cls:
+        slope = np.clip(cl['slope_angle'], np.deg2rad(clip_angle), np.pi/2.)
+        w = cl['width']
+        is_rect = cl['is_rectangular']
+        flux = np.clip(cl['flux_a0'], 0., None)
+        thick = (flux / ((cfg.RHO*cfg.G*slope)**3 * fs)) ** (1. / 3.)
+        if sf_func is not None:
+            # fs (sf h)**3 = flux term, same iterations as the inversion
+            sf = np.ones(thick.shape)
+            for _ in range(MAX_SF_ITER):
+                new_sf = sf_func(w, thick / sf, is_rect)
+                converged = not np.any((sf - new_sf) > SF_TOL)
+                sf = new_sf
+                if converged:
+                    break
+            thick = thick / sf
+        fac = np.where(is_rect, 1, cfg.TWO_THIRDS)
+        out += np.sum(fac * thick * w * cl['dx'])
+    return out
+
+
+@entity_task(log)
+def sliding_volume_limit(gdir, fs=None):
+    """The largest glacier volume [m3] the inversion can reach with sliding.
+
+    See :py:func:`calibrate_glen_a`: with ``fs > 0``, the volume tends to
+    this value as A tends to 0.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    fs : float
+        the sliding parameter (default: ``cfg.PARAMS['inversion_fs']``)
+    """
+    if fs is None:
+        fs = cfg.PARAMS['inversion_fs']
+    return _sliding_volume_limit(gdir.read_pickle('inversion_input'), fs)
+
+
+@entity_task(log)
+def mass_conservation_inversion_multi(gdir, glen_a_factors, glen_a=None,
+                                      fs=None):
+    """Compute the glacier thickness for several A factors and fs at once.
+
+    Same as ``mass_conservation_inversion`` with ``write=False``, for all
+    combinations of ``glen_a * glen_a_factors`` and ``fs``.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    glen_a_factors : array-like
+        the factors applied to ``glen_a``
+    glen_a : float
+        glen's creep parameter A (default: ``cfg.PARAMS['inversion_glen_a']``)
+    fs : float or array-like
+        the sliding parameter(s) (default: ``cfg.PARAMS['inversion_fs']``)
+
+    Returns
+    -------
+    a dict with the ``glen_a_factors`` and ``fs`` values, the glacier
+    ``area`` [m2], the ``volume`` [m3] and its derivative with respect to A
+    ``dvolume_dglen_a`` (arrays of shape (n_fs, n_factors)), and the
+    ``thick`` [m] and ``volume`` of each inversion flowline in
+    ``flowlines`` (arrays of shape (n_fs, n_factors, n_points)).
+    """
+
+    if glen_a is None:
+        glen_a = cfg.PARAMS['inversion_glen_a']
+    if fs is None:
+        fs = cfg.PARAMS['inversion_fs']
+    factors = np.atleast_1d(np.asarray(glen_a_factors, dtype=float))
+    fs = np.atleast_1d(np.asarray(fs, dtype=float))
+    n_fs, n_fac = len(fs), len(factors)
+
+    cls = gdir.read_pickle('inversion_input')
+    volume, dvolume, thicks, volumes = _invert_flowlines(cls, glen_a, factors,
+                                                         fs,
+                                                         rgi_id=gdir.rgi_id)
+    out_fls = []
+    for thick, vol in zip(thicks, volumes):
+        shape = (n_fs, n_fac, thick.shape[1])
+        out_fls.append(dict(thick=thick.reshape(shape),
+                            volume=vol.reshape(shape)))
+
+    return dict(glen_a_factors=factors, fs=fs,
+                area=gdir.rgi_area_km2 * 1e6,
+                volume=volume.reshape((n_fs, n_fac)),
+                dvolume_dglen_a=dvolume.reshape((n_fs, n_fac)),
+                flowlines=out_fls)
+
+
+def _sweep_groups(configs):
+    """Group the configurations which only differ by their fs."""
+    groups = dict()
+    for name, conf in configs.items():
+        conf = dict(conf)
+        fs = conf.pop('fs', cfg.PARAMS['inversion_fs'])
+        sf = conf.pop('shape_factor', None)
+        key = (sf, tuple(sorted(conf.items())))
+        groups.setdefault(key, []).append((name, fs))
+    return groups
+
+
+@entity_task(log)
+def inversion_sweep(gdir, configs, glen_a_factors, glen_a=None):
+    """Invert a glacier for several configurations and A factors.
+
+    The volumes are not written to the glacier directory. They are those of
+    ``mass_conservation_inversion`` followed by ``filter_inversion_output``
+    (which conserves the volume of each flowline).
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    configs : dict
+        the configurations, by name. Each is a dict with the ``fs``
+        (default: ``cfg.PARAMS['inversion_fs']``), the ``shape_factor``
+        (as ``use_shape_factor_for_inversion``, default: None) and the
+        keyword arguments of ``prepare_for_inversion`` (default: none).
+    glen_a_factors : array-like
+        the factors applied to ``glen_a``
+    glen_a : float
+        glen's creep parameter A (default: ``cfg.PARAMS['inversion_glen_a']``)
+
+    Returns
+    -------
+    a dict of the volumes [m3] (one per A factor) of each configuration
+    """
+
+    out = dict()
+    prepared = ()
+    try:
+        for (sf, prep), members in _sweep_groups(configs).items():
+            if prep != prepared:
+                tasks.prepare_for_inversion(gdir, **dict(prep))
+                if gdir.get_task_status('prepare_for_inversion') != 'SUCCESS':
+                    raise RuntimeError('({}) prepare_for_inversion failed'
+                                       .format(gdir.rgi_id))
+                prepared = prep
+            with ParamsContext(use_shape_factor_for_inversion=sf):
+                res = mass_conservation_inversion_multi(
+                    gdir, glen_a_factors, glen_a=glen_a,
+                    fs=[fs for _, fs in members])
+            for (name, _), vol in zip(members, res['volume']):
+                out[name] = vol
+    finally:
+        if prepared != ():
+            # Leave the default inversion input
+            tasks.prepare_for_inversion(gdir)
+    return out
+
+
+def run_inversion_sweep(gdirs, configs, glen_a_factors, glen_a=None,
+                        filesuffix='', path=None):
+    """Run the inversion sweeps on all glaciers and write one table.
+
+    The output is a netCDF file with the volumes of each glacier,
+    configuration and A factor (``ds.to_dataframe()`` gives the long
+    table), along with the glacier areas and the volume-area scaling
+    volumes, as in ``compile_glacier_statistics``. The volumes of the
+    glaciers where the inversion failed are NaN.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory
+        the glaciers
+    configs : dict
+        the configurations, by name (see :py:func:`inversion_sweep`)
+    glen_a_factors : array-like
+        the factors applied to ``glen_a``
+    glen_a : float
+        glen's creep parameter A (default: ``cfg.PARAMS['inversion_glen_a']``)
+    filesuffix : str
+        added to the output file name
+    path : str
+        the output file (default: ``inversion_sweep{filesuffix}.nc`` in
+        the working directory)
+
+    Returns
+    -------
+    the xarray Dataset
+    """
+
+    if glen_a is None:
+        glen_a = cfg.PARAMS['inversion_glen_a']
+    gdirs = sorted(utils.tolist(gdirs), key=lambda gd: gd.rgi_id)
+    names = list(configs.keys())
+    factors = np.asarray(glen_a_factors, dtype=float)
+
+    outs = execute_entity_task(inversion_sweep, gdirs, configs=configs,
+                               glen_a_factors=factors, glen_a=glen_a)
+
+    vol = np.zeros((len(gdirs), len(names), len(factors))) * np.nan
+    for i, out in enumerate(outs):
+        if out is None:
+            continue
+        for j, name in enumerate(names):
+            vol[i, j, :] = out[name]
+    vol *= 1e-9
+    area = np.array([gd.rgi_area_km2 for gd in gdirs])
+    vas = 0.034 * (area ** 1.375)
+    fs = [configs[n].get('fs', cfg.PARAMS['inversion_fs']) for n in names]
+
+    dims = ('rgi_id', 'config', 'glen_a_factor')
+    ds = xr.Dataset()
+    ds.coords['rgi_id'] = [gd.rgi_id for gd in gdirs]
+    ds.coords['config'] = names
+    ds.coords['glen_a_factor'] = factors
+    ds['fs'] = ('config', np.asarray(fs, dtype=float))
+    ds['rgi_area_km2'] = ('rgi_id', area)
+    ds['vas_volume_km3'] = ('rgi_id', vas)
+    ds['vas_thickness_m'] = ('rgi_id', vas / area * 1000)
+    ds['inv_volume_km3'] = (dims, vol)
+    ds['inv_thickness_m'] = (dims, vol / area[:, np.newaxis, np.newaxis] *
+                             1000)
+    ds.attrs['glen_a'] = glen_a
+
+    if path is None:
+        path = os.path.join(cfg.PATHS['working_dir'],
+                            'inversion_sweep' + filesuffix + '.nc')
+    ds.to_netcdf(path)
+    log.workflow('Inversion sweep: %d glaciers, %d configurations, %d A '
+                 'factors, written to %s', len(gdirs), len(names),
+                 len(factors), path)
+    return ds
+
+
+def _bracketed_newton(func, glen_a, target, rtol, maxiter, vlim=None):
+    """Solve ``func(A)[0] = target`` for A.
+
+    Newton's method on log(V) as a function of log(A) (which is linear
+    without sliding nor shape factors, so that one step is enough), falling
+    back to bisection when a step leaves the bracket of the root found so
+    far. ``func`` returns the volume and its derivative with respect to A,
+    and the volume must decrease with A.
+
+    ``vlim`` returns the limit of the volume as A tends to 0 (with sliding),
+    and is called the first time that the volume is below the target: a
+    target above this limit cannot be reached, and the search would only
+    decrease A until it underflows.
+
+    Returns
+    -------
+    (A, number of inversions)
+    """
+
+    x = np.log(glen_a)
+    lo, hi = -np.inf, np.inf
+    for it in range(maxiter):
+        a = np.exp(x)
+        v, dv = func(a)
+        if v <= 0:
+            raise RuntimeError('Zero volume: cannot calibrate A.')
+        if abs(v / target - 1) <= rtol:
+            return a, it + 1
+        g = np.log(v / target)
+        if g > 0:
+            lo = x
+        else:
+            hi = x
+            if vlim is not None:
+                vmax = vlim()
+                vlim = None
+                if vmax <= target:
+                    raise ValueError('Target volume not reachable: with '
+                                     'sliding, the volume is below {:.4g} '
+                                     'km3 for all A (target: {:.4g} km3).'
+                                     ''.format(vmax * 1e-9, target * 1e-9))
+        slope = a * dv / v
+        xn = x - g / slope if slope < 0 else np.nan
+        if not lo < xn < hi:
+            if np.isfinite(lo) and np.isfinite(hi):
+                xn = (lo + hi) / 2
+            else:
+                xn = x + np.sign(g) * np.log(10)
+        x = xn
+    raise RuntimeError('The calibration of A did not converge in {} '
+                       'iterations.'.format(maxiter))
+
+
+@entity_task(log)
+def calibrate_glacier_glen_a(gdir, target_volume_km3, glen_a=None, fs=None,
+                             rtol=1e-4, maxiter=20):
+    """Find the A for which the inversion gives a target glacier volume.
+
+    The inversion input is read once, and each iteration starts from the
+    thickness of the previous one. With sliding, the volume is bounded
+    whatever A (see :py:func:`sliding_volume_limit`): a ValueError is raised
+    for a target above the bound.
+
+    Parameters
+    ----------
+    gdir : oggm.GlacierDirectory
+    target_volume_km3 : float or dict
+        the target volume, or a dict of the target volumes by RGI id
+    glen_a : float
+        the first guess (default: ``cfg.PARAMS['inversion_glen_a']``)
+    fs : float
+        the sliding parameter (default: ``cfg.PARAMS['inversion_fs']``)
+    rtol : float
+        the relative tolerance on the volume
+    maxiter : int
+        the maximum number of inversions
+
+    Returns
+    -------
+    the calibrated A
+    """
+
+    if glen_a is None:
+        glen_a = cfg.PARAMS['inversion_glen_a']
+    if fs is None:
+        fs = cfg.PARAMS['inversion_fs']
+    if isinstance(target_volume_km3, dict):
+        target_volume_km3 = target_volume_km3[gdir.rgi_id]
+
+    cls = gdir.read_pickle('inversion_input')
+    guess = [None]
+
+    def _volume(a):
+        v, dv, thicks, _ = _invert_flowlines(cls, a, np.ones(1),
+                                             np.atleast_1d(fs),
+                                             thick_guess=guess[0],
+                                             rgi_id=gdir.rgi_id)
+        guess[0] = thicks
+        return v[0], dv[0]
+
+    def _vlim():
+        return _sliding_volume_limit(cls, fs)
+
+    out, n = _bracketed_newton(_volume, glen_a, target_volume_km3 * 1e9,
+                               rtol, maxiter, vlim=_vlim if fs > 0 else None)
+    log.info('(%s) A calibrated to %.3e after %d inversions', gdir.rgi_id,
+             out, n)
+    return out
+
+
+def calibrate_glen_a(gdirs, target_volume_km3, glen_a=None, fs=None,
+                     rtol=1e-4, maxiter=20):
+    """Find the A for which the inversion gives a target total volume.
+
+    Each iteration is one batched inversion of all glaciers, giving the
+    total volume and its derivative with respect to A. The glaciers where
+    the inversion fails are left out of the total. With sliding, a
+    ValueError is raised if the target is above the largest volume
+    reachable (see :py:func:`sliding_volume_limit`). For a target volume
+    per glacier, see :py:func:`calibrate_glacier_glen_a`.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory
+        the glaciers
+    target_volume_km3 : float
+        the target total volume
+    glen_a : float
+        the first guess (default: ``cfg.PARAMS['inversion_glen_a']``)
+    fs : float
+        the sliding parameter (default: ``cfg.PARAMS['inversion_fs']``)
+    rtol : float
+        the relative tolerance on the volume
+    maxiter : int
+        the maximum number of inversions
+
+    Returns
+    -------
+    the calibrated A
+    """
+
+    if glen_a is None:
+        glen_a = cfg.PARAMS['inversion_glen_a']
+    if fs is None:
+        fs = cfg.PARAMS['inversion_fs']
+    gdirs = utils.tolist(gdirs)
+
+    def _volume(a):
+        outs = execute_entity_task(mass_conservation_inversion_multi, gdirs,
+                                   glen_a_factors=[1.], glen_a=a, fs=fs)
+        outs = [o for o in outs if o is not None]
+        if len(outs) < len(gdirs):
+            log.warning('A calibration: %d glaciers left out',
+                        len(gdirs) - len(outs))
+        return (np.sum([o['volume'][0, 0] for o in outs]),
+                np.sum([o['dvolume_dglen_a'][0, 0] for o in outs]))
+
+    def _vlim():
+        outs = execute_entity_task(sliding_volume_limit, gdirs, fs=fs)
+        return np.sum([o for o in outs if o is not None])
+
+    out, n = _bracketed_newton(_volume, glen_a, target_volume_km3 * 1e9,
+                               rtol, maxiter, vlim=_vlim if fs > 0 else None)
+    log.workflow('A calibrated to %.3e (factor %.3f) after %d inversions',
+                 out, out / glen_a, n)
+    return out
@@ -1,12 +1,14 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import salem
 import oggm.cfg as cfg
-from oggm import utils, workflow, tasks
+from oggm import utils, workflow
+from gmd_cluster_scripts.scheduling import sort_by_cost
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
+from gmd_cluster_scripts.inversion import run_inversion_sweep
 
 # Time
 start = time.time()
@@ -35,10 +37,10 @@ cfg.PARAMS['continue_on_error'] = True
 cfg.PARAMS['auto_skip_task'] = False
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
@@ -56,51 +58,18 @@ factors += [6, 7, 8, 9, 10]
 glen_a = cfg.PARAMS['glen_a']
 fs = 5.7e-20
 
-for f in factors:
-    suf = '_{:03d}_nofs'.format(int(f * 10))
-    workflow.execute_entity_task(tasks.mass_conservation_inversion, gdirs,
-                                 glen_a=glen_a*f, fs=0)
-    workflow.execute_entity_task(tasks.filter_inversion_output, gdirs)
-    utils.compile_glacier_statistics(gdirs, filesuffix=suf, inversion_only=True)
-
-for f in factors:
-    suf = '_{:03d}_wfs'.format(int(f * 10))
-    workflow.execute_entity_task(tasks.mass_conservation_inversion, gdirs,
-                                 glen_a=glen_a*f, fs=fs)
-    workflow.execute_entity_task(tasks.filter_inversion_output, gdirs)
-    utils.compile_glacier_statistics(gdirs, filesuffix=suf, inversion_only=True)
-
-cfg.PARAMS['use_shape_factor_for_inversion'] = 'Adhikari'
-
-for f in factors:
-    suf = '_{:03d}_shape_nofs'.format(int(f * 10))
-    workflow.execute_entity_task(tasks.mass_conservation_inversion, gdirs,
-                                 glen_a=glen_a*f, fs=0)
-    workflow.execute_entity_task(tasks.filter_inversion_output, gdirs)
-    utils.compile_glacier_statistics(gdirs, filesuffix=suf, inversion_only=True)
-
-cfg.PARAMS['use_shape_factor_for_inversion'] = None
-
-workflow.execute_entity_task(tasks.prepare_for_inversion, gdirs,
-                             invert_all_rectangular=True)
-
-for f in factors:
-    suf = '_rect_{:03d}_nofs'.format(int(f * 10))
-    workflow.execute_entity_task(tasks.mass_conservation_inversion, gdirs,
-                                 glen_a=glen_a*f, fs=0)
-    workflow.execute_entity_task(tasks.filter_inversion_output, gdirs)
-    utils.compile_glacier_statistics(gdirs, filesuffix=suf, inversion_only=True)
-
-
-workflow.execute_entity_task(tasks.prepare_for_inversion, gdirs,
-                             invert_with_rectangular=False)
-
-for f in factors:
-    suf = '_parab_{:03d}_nofs'.format(int(f * 10))
-    workflow.execute_entity_task(tasks.mass_conservation_inversion, gdirs,
-                                 glen_a=glen_a*f, fs=0)
-    workflow.execute_entity_task(tasks.filter_inversion_output, gdirs)
-    utils.compile_glacier_statistics(gdirs, filesuffix=suf, inversion_only=True)
+# Configurations
+configs = {
+    'nofs': dict(fs=0),
+    'wfs': dict(fs=fs),
+    'shape_nofs': dict(fs=0, shape_factor='Adhikari'),
+    'rect_nofs': dict(fs=0, invert_all_rectangular=True),
+    'parab_nofs': dict(fs=0, invert_with_rectangular=False),
+}
+
+# All configurations and factors in one pass over the glaciers
+run_inversion_sweep(gdirs, configs, factors, glen_a=glen_a,
+                    filesuffix='_{}'.format(rgi_reg))
 
 # Log
 m, s = divmod(time.time() - start, 60)
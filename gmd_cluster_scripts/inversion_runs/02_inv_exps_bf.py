@@ -1,12 +1,14 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import salem
 import oggm.cfg as cfg
-from oggm import utils, workflow, tasks
+from oggm import utils, workflow
+from gmd_cluster_scripts.scheduling import sort_by_cost
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
+from gmd_cluster_scripts.inversion import run_inversion_sweep
 
 # Time
 start = time.time()
@@ -35,10 +37,10 @@ cfg.PARAMS['continue_on_error'] = True
 cfg.PARAMS['auto_skip_task'] = False
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
@@ -56,12 +58,8 @@ factors += [6, 7, 8, 9, 10]
 glen_a = cfg.PARAMS['glen_a']
 fs = 5.7e-20
 
-for f in factors:
-    suf = '_{:03d}_wfs'.format(int(f * 10))
-    workflow.execute_entity_task(tasks.mass_conservation_inversion, gdirs,
-                                 glen_a=glen_a*f, fs=fs)
-    workflow.execute_entity_task(tasks.filter_inversion_output, gdirs)
-    utils.compile_glacier_statistics(gdirs, filesuffix=suf, inversion_only=True)
+run_inversion_sweep(gdirs, {'wfs': dict(fs=fs)}, factors, glen_a=glen_a,
+                    filesuffix='_wfs_{}'.format(rgi_reg))
 
 # Log
 m, s = divmod(time.time() - start, 60)
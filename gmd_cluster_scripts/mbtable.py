@@ -0,0 +1,141 @@
+"""Mass-balance lookup tables for the random climate runs.
+
+``run_random_climate`` samples the years of a 31-year climate period, and
+computes the annual mass-balance of each flowline on the current surface
+heights, from the monthly climate, at the first time step of every year
+(and many more times for the ELA of the diagnostics). But there are only 31
+possible mass-balance profiles per flowline: :py:class:`BinnedMassBalance`
+computes them once on a fine elevation grid, and interpolates in them
+during the run.
+
+The mass-balance depends on the elevation through the temperature only, so
+that when the temperature gradient is the same for all months of the
+period (i.e. without ``temp_use_local_gradient``), the mass-balance with a
+temperature bias ``dT`` at the height ``h`` is the one without bias at
+``h + dT / grad``: the temperature bias scenarios reuse the same tables.
+Otherwise, one set of tables is computed per temperature bias.
+
+The profiles are piecewise linear in elevation (with a few kinks at the
+melt and solid precipitation thresholds), so that the interpolation error
+is negligible with a 5 m grid. The heights outside of the grid (very large
+glacier growth, and the bounds of the ELA search) are computed with the
+original model.
+"""
+# Built ins
+import logging
+
+# External libs
+import numpy as np
+
+# Locals
+from oggm.core.massbalance import MassBalanceModel
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Elevation grid spacing [m]
+DZ = 5.
+# The grid covers the bed, plus this much above (glacier thickness) [m]
+MAX_THICK = 1000.
+# And this much on both sides (shifted heights with a temperature bias) [m]
+MARGIN = 200.
+
+
+class BinnedMassBalance(MassBalanceModel):
+    """A ``RandomMassBalance`` which interpolates in precomputed tables.
+
+    Parameters
+    ----------
+    random_mb : RandomMassBalance
+        the mass-balance model of one flowline (its random years are used)
+    zmin, zmax : float
+        the range of the elevation grid
+    dz : float
+        the spacing of the elevation grid
+    tables : dict
+        where to store the tables (per temperature bias), e.g. to share them
+        with another model of the same flowline and climate period
+    """
+
+    def __init__(self, random_mb, zmin, zmax, dz=DZ, tables=None):
+        super(BinnedMassBalance, self).__init__()
+        self.random_mb = random_mb
+        self.valid_bounds = random_mb.valid_bounds
+        self.grid = np.arange(zmin, zmax + dz, dz)
+        self.tables = dict() if tables is None else tables
+
+        past = random_mb.mbmod
+        grad = past.grad[np.isin(past.years, random_mb.years)]
+        self._grad = grad[0]
+        self._shift_ok = np.ptp(grad) == 0 and self._grad != 0
+
+    @property
+    def temp_bias(self):
+        """Temperature bias to add to the original series."""
+        return self.random_mb.temp_bias
+
+    @temp_bias.setter
+    def temp_bias(self, value):
+        """Temperature bias to add to the original series."""
+        self.random_mb.temp_bias = value
+
+    def _table(self):
+        """The table (years, heights) and height shift for the current bias."""
+        temp_bias = self.temp_bias
+        key = 0. if self._shift_ok else temp_bias
+        if key not in self.tables:
+            past = self.random_mb.mbmod
+            saved = past.temp_bias
+            past.temp_bias = key
+            try:
+                self.tables[key] = np.array([past.get_annual_mb(self.grid,
+                                                                year=y)
+                                             for y in self.random_mb.years])
+            finally:
+                past.temp_bias = saved
+        shift = temp_bias / self._grad if self._shift_ok else 0.
+        return self.tables[key], shift
+
+    def get_monthly_mb(self, heights, year=None):
+        return self.random_mb.get_monthly_mb(heights, year=year)
+
+    def get_annual_mb(self, heights, year=None):
+        ryr = self.random_mb.get_state_yr(int(year))
+        table, shift = self._table()
+        h = np.asarray(heights, dtype=float) + shift
+        if np.any((h < self.grid[0]) | (h > self.grid[-1])):
+            return self.random_mb.get_annual_mb(heights, year=year)
+        return np.interp(h, self.grid, table[ryr - self.random_mb.years[0]])
+
+
+def binned_mb_model(mb, fls, dz=DZ, tables=None):
+    """Interpolate the mass-balance of each flowline in lookup tables.
+
+    Parameters
+    ----------
+    mb : MultipleFlowlineMassBalance
+        a model with ``RandomMassBalance`` flowline models (modified in
+        place)
+    fls : list
+        the model flowlines, for the range of the elevation grid
+    dz : float
+        the spacing of the elevation grid
+    tables : dict
+        where to store the tables (one dict per flowline), e.g. to share
+        them with the model of another scenario with the same climate period
+
+    Returns
+    -------
+    the mass-balance model
+    """
+
+    if tables is None:
+        tables = dict()
+    for fl_id, fl in enumerate(fls):
+        fl_mb = mb.flowline_mb_models[fl_id]
+        zmin = np.min(fl.bed_h) - MARGIN
+        zmax = max(np.max(fl.bed_h) + MAX_THICK,
+                   np.max(fl.surface_h)) + MARGIN
+        mb.flowline_mb_models[fl_id] = BinnedMassBalance(
+            fl_mb, zmin, zmax, dz=dz, tables=tables.setdefault(fl_id, dict()))
+    return mb
@@ -0,0 +1,162 @@
+"""Memory-aware admission of the glaciers to the worker pool.
+
+With a large ``border``, the grids of the largest ice caps need several GB
+per worker, and a few of them running at the same time on one node get the
+workers killed by the OOM killer. Instead of handing the glaciers to the
+pool all at once, :py:func:`imap_admitted` only starts a glacier if the
+projected memory of all glaciers in progress fits in the node budget:
+
+- the next glacier in the scheduling order is started if it fits
+- otherwise, the largest glacier which fits in the remaining budget is
+  started instead (backfilling with the small glaciers while a large one
+  waits for memory to be freed)
+- a glacier which does not fit even alone is started alone
+
+The memory of each glacier is predicted by the scheduler
+(:py:func:`~gmd_cluster_scripts.scheduling.predict_memory`), from the peak
+RSS recorded in earlier runs or, without records, from
+:py:func:`default_memory`.
+"""
+# Built ins
+import os
+import queue
+import bisect
+import logging
+
+# External libs
+import numpy as np
+import pandas as pd
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Memory model without records (MB): the baseline of a worker, plus the
+# gridded fields (about 50 float64 arrays during the geometry tasks), plus
+# the flowlines
+BASE_MB = 300.
+MB_PER_PIXEL = 400. / 1024. / 1024.
+MB_PER_FLOWLINE = 2.
+
+# Fraction of the node memory used for the budget
+BUDGET_FRACTION = 0.85
+
+# The budget, if set with set_memory_budget
+_BUDGET_MB = None
+
+# Flowline counts already read
+_N_FLOWLINES = dict()
+
+
+def set_memory_budget(budget_mb):
+    """Set the memory budget of the node (MB, None for automatic)."""
+    global _BUDGET_MB
+    _BUDGET_MB = budget_mb
+
+
+def memory_budget():
+    """The memory budget for the workers of this node, in MB.
+
+    Unless set with :py:func:`set_memory_budget`, this is a fraction of the
+    memory allocated by SLURM (``SLURM_MEM_PER_NODE``) or, outside of a
+    SLURM job, of the physical memory.
+    """
+    if _BUDGET_MB is not None:
+        return _BUDGET_MB
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        total = float(os.environ['SLURM_MEM_PER_NODE'])
+    else:
+        total = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') /
+                 1024. / 1024.)
+    return BUDGET_FRACTION * total
+
+
+def n_flowlines(gdir):
+    """The number of flowlines of a glacier (0 if not computed yet)."""
+    if gdir.rgi_id not in _N_FLOWLINES:
+        n = 0
+        for fname in ['inversion_flowlines', 'centerlines']:
+            if gdir.has_file(fname):
+                try:
+                    n = len(gdir.read_pickle(fname))
+                except Exception:
+                    pass
+                break
+        if n == 0:
+            # Not computed yet: ask again next time
+            return 0
+        _N_FLOWLINES[gdir.rgi_id] = n
+    return _N_FLOWLINES[gdir.rgi_id]
+
+
+def default_memory(features):
+    """The memory model without records (MB), indexed like ``features``.
+    """
+    mem = BASE_MB + MB_PER_PIXEL * features['npix'].values
+    if 'n_flowlines' in features:
+        mem = mem + MB_PER_FLOWLINE * features['n_flowlines'].values
+    return pd.Series(mem, index=features.index)
+
+
+def imap_admitted(pool, func, items, mem_mb, budget_mb, nprocs):
+    """Same as ``pool.imap_unordered``, with memory admission.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        the pool
+    func : callable
+        the function to apply
+    items : list
+        the arguments, in the order they should be started
+    mem_mb : array
+        the predicted memory of each item (MB)
+    budget_mb : float
+        the memory budget for all items in progress (MB)
+    nprocs : int
+        the number of pool workers
+    """
+
+    n = len(items)
+    mem_mb = np.asarray(mem_mb, dtype=float)
+    done = queue.Queue()
+    by_mem = sorted((m, k) for k, m in enumerate(mem_mb))
+    taken = np.zeros(n, dtype=bool)
+    head = 0
+    in_flight = dict()
+    used = 0.
+    n_backfill = 0
+
+    def _submit(k):
+        taken[k] = True
+        del by_mem[bisect.bisect_left(by_mem, (mem_mb[k], k))]
+        in_flight[k] = mem_mb[k]
+        pool.apply_async(func, (items[k], ),
+                         callback=lambda r: done.put((k, r, None)),
+                         error_callback=lambda e: done.put((k, None, e)))
+
+    for _ in range(n):
+        while len(in_flight) < nprocs and by_mem:
+            while taken[head]:
+                head += 1
+            free = budget_mb - used
+            if mem_mb[head] <= free or not in_flight:
+                k = head
+            else:
+                # The largest one which fits
+                j = bisect.bisect_right(by_mem, (free, n)) - 1
+                if j < 0:
+                    break
+                k = by_mem[j][1]
+                n_backfill += 1
+            used += mem_mb[k]
+            _submit(k)
+
+        k, res, err = done.get()
+        used -= in_flight.pop(k)
+        if err is not None:
+            raise err
+        yield res
+
+    if n_backfill > 0:
+        log.info('%d glaciers were started out of order to fit in the '
+                 'memory budget', n_backfill)
@@ -0,0 +1,78 @@
+"""In-memory passing of intermediate files between chained entity tasks.
+
+Most prepro tasks communicate through pickles in the glacier directory
+(centerlines, inversion flowlines, climate info...), which are written by a
+task and read back by the next one. When a chain of tasks runs in a single
+worker, :py:class:`BufferedGlacierDirectory` keeps these pickles in memory
+and writes them to disk only once, at the end of the chain.
+"""
+# Built ins
+import pickle
+import logging
+
+# Locals
+from oggm import GlacierDirectory
+
+# Module logger
+log = logging.getLogger(__name__)
+
+
+class BufferedGlacierDirectory(GlacierDirectory):
+    """A glacier directory which holds its pickles in memory.
+
+    The pickled objects are stored as (uncompressed) bytes, so that the
+    tasks see the same copy semantics as with files on disk. Any direct
+    access to the path of a buffered file (e.g. by a task opening it itself)
+    writes it to disk first.
+    """
+
+    @classmethod
+    def from_gdir(cls, gdir):
+        """Wrap an existing glacier directory (no disk access)."""
+        new = cls.__new__(cls)
+        new.__dict__.update(gdir.__dict__)
+        new._pickle_buffer = dict()
+        return new
+
+    def write_pickle(self, var, filename, use_compression=None,
+                     filesuffix=''):
+        key = (filename, filesuffix)
+        self._pickle_buffer[key] = (pickle.dumps(var, protocol=-1),
+                                    use_compression)
+
+    def read_pickle(self, filename, use_compression=None, filesuffix=''):
+        key = (filename, filesuffix)
+        if key in self._pickle_buffer:
+            return pickle.loads(self._pickle_buffer[key][0])
+        return super(BufferedGlacierDirectory, self).read_pickle(
+            filename, use_compression=use_compression, filesuffix=filesuffix)
+
+    def has_file(self, filename, **kwargs):
+        key = (filename, kwargs.get('filesuffix', ''))
+        if key in self._pickle_buffer:
+            return True
+        return super(BufferedGlacierDirectory, self).has_file(filename,
+                                                              **kwargs)
+
+    def get_filepath(self, filename, delete=False, filesuffix=''):
+        key = (filename, filesuffix)
+        if key in self._pickle_buffer:
+            if delete:
+                # The file is going to be overwritten anyway
+                del self._pickle_buffer[key]
+            else:
+                self._flush_one(key)
+        return super(BufferedGlacierDirectory, self).get_filepath(
+            filename, delete=delete, filesuffix=filesuffix)
+
+    def _flush_one(self, key):
+        buf, use_compression = self._pickle_buffer.pop(key)
+        filename, filesuffix = key
+        super(BufferedGlacierDirectory, self).write_pickle(
+            pickle.loads(buf), filename, use_compression=use_compression,
+            filesuffix=filesuffix)
+
+    def flush(self):
+        """Write all buffered pickles to disk."""
+        for key in list(self._pickle_buffer.keys()):
+            self._flush_one(key)
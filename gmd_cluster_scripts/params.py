@@ -0,0 +1,103 @@
+"""Parameter contexts for the entity tasks.
+
+The run scripts switch between model configurations by changing
+``cfg.PARAMS`` (e.g. ``cfg.PARAMS['glen_a']``), so that the configurations
+have to run one after another, with a barrier in between. A
+:py:class:`ParamsContext` is an immutable set of ``cfg.PARAMS`` values,
+given to a task call instead::
+
+    ctx = ParamsContext(glen_a=glen_a*2, fs=0)
+    execute_entity_task(tasks.run_random_climate, gdirs, params=ctx,
+                        output_filesuffix='_2A')
+
+The scheduler (:py:mod:`gmd_cluster_scripts.scheduling`) sets the values in
+the worker for the duration of the task only, so that tasks with different
+contexts can run on the same workers at the same time (see
+:py:func:`~gmd_cluster_scripts.scheduling.execute_entity_task_sweep`). In
+the main process, a context is applied with ``with ctx:``.
+"""
+# Built ins
+import logging
+from collections.abc import Mapping
+
+# Locals
+import oggm.cfg as cfg
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Marks the parameters which were not set before a context
+_UNSET = object()
+
+# The values replaced by the active contexts, innermost last. As cfg.PARAMS,
+# this is per process and not per context: the same context can be nested
+# or used by several callers, and stays immutable.
+_SAVED = []
+
+
+class ParamsContext(Mapping):
+    """An immutable set of ``cfg.PARAMS`` values.
+
+    Parameters
+    ----------
+    *args, **kwargs :
+        the parameter values, as for ``dict``
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._params = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._params[key]
+
+    def __iter__(self):
+        return iter(sorted(self._params))
+
+    def __len__(self):
+        return len(self._params)
+
+    def __hash__(self):
+        return hash(tuple((k, repr(self._params[k])) for k in self))
+
+    def __eq__(self, other):
+        return isinstance(other, ParamsContext) and dict(self) == dict(other)
+
+    def __repr__(self):
+        # Sorted, so that it can identify a task call (see taskcache)
+        return 'ParamsContext({})'.format(', '.join(
+            '{}={!r}'.format(k, self._params[k]) for k in self))
+
+    def __reduce__(self):
+        return ParamsContext, (self._params, )
+
+    def replace(self, **kwargs):
+        """A new context, with some values changed or added."""
+        params = dict(self._params)
+        params.update(kwargs)
+        return ParamsContext(params)
+
+    def __enter__(self):
+        _SAVED.append((self, {k: cfg.PARAMS.get(k, _UNSET)
+                              for k in self._params}))
+        for k, v in self._params.items():
+            cfg.PARAMS[k] = v
+        return self
+
+    def __exit__(self, *args):
+        if not _SAVED or _SAVED[-1][0] is not self:
+            raise RuntimeError('parameter contexts must be exited in the '
+                               'reverse order of entry')
+        for k, v in _SAVED.pop()[1].items():
+            if v is _UNSET:
+                del cfg.PARAMS[k]
+            else:
+                cfg.PARAMS[k] = v
+
+
+def apply_params(params):
+    """``with apply_params(params):`` works with a context or None."""
+    if params is None:
+        return ParamsContext()
+    if not isinstance(params, ParamsContext):
+        params = ParamsContext(params)
+    return params
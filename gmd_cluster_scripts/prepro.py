@@ -0,0 +1,191 @@
+"""Chained preprocessing: all prepro levels in one job.
+
+The ``prepro_runs/0*`` scripts compress every glacier directory at the end
+of each stage and extract them again at the start of the next one. Here the
+glacier directories stay live in the working directory from one level to the
+next, and the level archives are written as a side output in the background.
+"""
+# Built ins
+import os
+import shutil
+import logging
+import tarfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Locals
+import oggm.cfg as cfg
+from oggm import workflow, tasks
+from gmd_cluster_scripts.scheduling import execute_task_chain
+from gmd_cluster_scripts.climate import cru_region_window, process_cru_data
+from gmd_cluster_scripts.bundle import write_bundle
+from gmd_cluster_scripts.intersects import init_glacier_regions_indexed
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# The tasks run at each level, in the same order as the prepro_runs scripts
+# (level 1 are the directories as created by init_glacier_regions)
+PREPRO_LEVELS = OrderedDict([
+    (1, []),
+    (2, [tasks.glacier_masks]),
+    (3, [process_cru_data]),
+    (4, [tasks.compute_centerlines,
+         tasks.initialize_flowlines,
+         tasks.compute_downstream_line,
+         tasks.compute_downstream_bedshape,
+         tasks.catchment_area,
+         tasks.catchment_intersections,
+         tasks.catchment_width_geom,
+         tasks.catchment_width_correction,
+         tasks.local_t_star,
+         tasks.mu_star_calibration,
+         tasks.prepare_for_inversion,
+         tasks.mass_conservation_inversion,
+         tasks.filter_inversion_output,
+         ]),
+])
+
+
+def _dir_to_tar(source_dir, delete=True):
+    """Same as utils.gdir_to_tar, but for a path."""
+    source_dir = os.path.normpath(source_dir)
+    opath = source_dir + '.tar.gz'
+    with tarfile.open(opath, 'w:gz') as tar:
+        tar.add(source_dir, arcname=os.path.basename(source_dir))
+    if delete:
+        shutil.rmtree(source_dir)
+    return opath
+
+
+def _dirs_to_bundle(level_dir, gdir_paths, nthreads=2):
+    """Bundle a level snapshot and delete it."""
+    opath = write_bundle(level_dir + '.gbundle', gdir_paths, level_dir,
+                         nthreads=nthreads)
+    shutil.rmtree(level_dir)
+    return opath
+
+
+class LevelTarWriter(object):
+    """Writes the level archives in background threads.
+
+    The glacier directories are copied to ``{output_dir}/L{level}`` (same
+    layout as in the working directory) before the next level starts
+    modifying them: copying is cheap compared to the compression, which
+    happens in the background while the main process continues.
+
+    With ``archive_format='tar'``, one tar file is written per glacier as
+    with ``utils.gdir_to_tar``. With ``archive_format='bundle'``, the level
+    is written to one indexed bundle ``{output_dir}/L{level}.gbundle`` (see
+    :py:mod:`gmd_cluster_scripts.bundle`).
+    """
+
+    def __init__(self, output_dir, nthreads=2, archive_format='tar'):
+        if archive_format not in ['tar', 'bundle']:
+            raise ValueError('archive_format not understood: '
+                             '{}'.format(archive_format))
+        self.output_dir = output_dir
+        self.nthreads = nthreads
+        self.archive_format = archive_format
+        self.executor = ThreadPoolExecutor(max_workers=nthreads)
+        self.futures = []
+
+    def submit(self, gdirs, level):
+        """Snapshot the glacier directories and queue them for compression.
+        """
+        level_dir = os.path.join(self.output_dir, 'L{:d}'.format(level))
+        log.workflow('Writing level %d archives to %s', level, level_dir)
+        snapshots = []
+        for gdir in gdirs:
+            opath = os.path.join(level_dir,
+                                 os.path.relpath(gdir.dir, gdir.base_dir))
+            if os.path.exists(opath):
+                shutil.rmtree(opath)
+            shutil.copytree(gdir.dir, opath)
+            if self.archive_format == 'tar':
+                self.futures.append(self.executor.submit(_dir_to_tar, opath))
+            snapshots.append(opath)
+        if self.archive_format == 'bundle':
+            self.futures.append(self.executor.submit(_dirs_to_bundle,
+                                                     level_dir, snapshots,
+                                                     nthreads=self.nthreads))
+
+    def close(self):
+        """Wait for all archives to be written."""
+        n_err = 0
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as err:
+                n_err += 1
+                log.error('Failed to write archive: %s', err)
+        self.executor.shutdown()
+        self.futures = []
+        if n_err > 0:
+            log.workflow('%d archives could not be written', n_err)
+
+
+def run_prepro_levels(rgidf, max_level=4, output_levels=None,
+                      output_dir=None, nthreads=2, archive_format='tar',
+                      intersects_db=None):
+    """Run the prepro levels 1 to ``max_level`` in one go.
+
+    Parameters
+    ----------
+    rgidf : GeoDataFrame
+        the RGI glaciers to process
+    max_level : int
+        the last prepro level to run
+    output_levels : list of int, optional
+        the levels to write as compressed archives (the default is to write
+        none: the glacier directories are left in the working directory)
+    output_dir : str
+        where to write the level archives (defaults to the working dir)
+    nthreads : int
+        the number of background threads used for compression
+    archive_format : str
+        'tar' (one tar file per glacier) or 'bundle' (one indexed bundle per
+        level, see :py:mod:`gmd_cluster_scripts.bundle`)
+    intersects_db : str or GeoDataFrame, optional
+        the RGI intersects, looked up per glacier with an index (see
+        :py:mod:`gmd_cluster_scripts.intersects`). The default is to use
+        ``cfg.PARAMS['intersects_gdf']`` as usual.
+
+    Returns
+    -------
+    the list of glacier directories
+    """
+
+    if output_dir is None:
+        output_dir = cfg.PATHS['working_dir']
+
+    writer = None
+    if output_levels:
+        writer = LevelTarWriter(output_dir, nthreads=nthreads,
+                                archive_format=archive_format)
+
+    if intersects_db is not None:
+        gdirs = init_glacier_regions_indexed(rgidf, intersects_db)
+    else:
+        gdirs = workflow.init_glacier_regions(rgidf)
+    try:
+        for level, task_list in PREPRO_LEVELS.items():
+            if level > max_level:
+                break
+            log.workflow('Starting prepro level %d', level)
+            if process_cru_data in task_list:
+                # The CRU data of the whole region is computed only once
+                with cru_region_window(gdirs) as window_dir:
+                    chain = [(t, dict(window_dir=window_dir))
+                             if t is process_cru_data else t
+                             for t in task_list]
+                    execute_task_chain(chain, gdirs, in_memory=True)
+            else:
+                execute_task_chain(task_list, gdirs, in_memory=True)
+            if writer is not None and level in output_levels:
+                writer.submit(gdirs, level)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return gdirs
@@ -1,11 +1,13 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import oggm.cfg as cfg
-from oggm import utils, workflow, tasks
+from oggm import utils, tasks
+from gmd_cluster_scripts.scheduling import execute_entity_task, sort_by_cost
+from gmd_cluster_scripts.intersects import init_glacier_regions_indexed
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
 
 # Time
 start = time.time()
@@ -33,15 +35,14 @@ cfg.PARAMS['border'] = 160
 cfg.PARAMS['continue_on_error'] = True
 cfg.PARAMS['auto_skip_task'] = False
 
-# We use intersects
+# We use intersects (looked up per glacier with an index)
 rgif = utils.get_rgi_intersects_region_file(rgi_reg, version=rgi_version)
-cfg.set_intersects_db(rgif)
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
@@ -49,10 +50,10 @@ log.info('Starting run for RGI reg: ' + rgi_reg)
 log.info('Number of glaciers: {}'.format(len(rgidf)))
 
 # Go - initialize working directories
-gdirs = workflow.init_glacier_regions(rgidf)
+gdirs = init_glacier_regions_indexed(rgidf, rgif)
 
 # End - compress all
-workflow.execute_entity_task(utils.gdir_to_tar, gdirs)
+execute_entity_task(utils.gdir_to_tar, gdirs)
 
 # Log
 m, s = divmod(time.time() - start, 60)
@@ -1,11 +1,12 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import oggm.cfg as cfg
 from oggm import utils, workflow, tasks
+from gmd_cluster_scripts.scheduling import execute_entity_task, sort_by_cost
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
 
 # Time
 start = time.time()
@@ -34,10 +35,10 @@ cfg.PARAMS['continue_on_error'] = True
 cfg.PARAMS['auto_skip_task'] = False
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
@@ -48,10 +49,10 @@ log.info('Number of glaciers: {}'.format(len(rgidf)))
 gdirs = workflow.init_glacier_regions(rgidf, from_prepro_level=0)
 
 # Tasks
-workflow.execute_entity_task(tasks.glacier_masks, gdirs)
+execute_entity_task(tasks.glacier_masks, gdirs)
 
 # End - compress all
-workflow.execute_entity_task(utils.gdir_to_tar, gdirs)
+execute_entity_task(utils.gdir_to_tar, gdirs)
 
 # Log
 m, s = divmod(time.time() - start, 60)
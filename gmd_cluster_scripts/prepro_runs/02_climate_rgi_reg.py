@@ -1,11 +1,13 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import oggm.cfg as cfg
-from oggm import utils, workflow, tasks
+from oggm import utils, workflow
+from gmd_cluster_scripts.scheduling import execute_entity_task, sort_by_cost
+from gmd_cluster_scripts.climate import process_cru_data_region
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
 
 # Time
 start = time.time()
@@ -38,10 +40,10 @@ _ = utils.get_cru_file(var='tmp')
 _ = utils.get_cru_file(var='pre')
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
@@ -51,11 +53,11 @@ log.info('Number of glaciers: {}'.format(len(rgidf)))
 # Go - initialize working directories
 gdirs = workflow.init_glacier_regions(rgidf, from_prepro_level=2)
 
-# Tasks
-workflow.execute_entity_task(tasks.process_cru_data, gdirs)
+# Tasks - the CRU data for the whole region is read only once
+process_cru_data_region(gdirs)
 
 # End - compress all
-workflow.execute_entity_task(utils.gdir_to_tar, gdirs)
+execute_entity_task(utils.gdir_to_tar, gdirs)
 
 # Log
 m, s = divmod(time.time() - start, 60)
@@ -1,11 +1,16 @@
 import os
 import time
 import logging
-import geopandas as gpd
 
 # Locals
 import oggm.cfg as cfg
-from oggm import utils, workflow, tasks
+from oggm import utils, tasks
+from gmd_cluster_scripts.scheduling import (execute_entity_task,
+                                            execute_task_chain,
+                                            set_checkpoint, sort_by_cost)
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
+from gmd_cluster_scripts.checkpoint import Checkpoint
+from gmd_cluster_scripts.profiling import compile_task_profile
 
 # Time
 start = time.time()
@@ -22,6 +27,10 @@ WORKING_DIR = os.environ["WORKDIR"]
 utils.mkdir(WORKING_DIR)
 cfg.PATHS['working_dir'] = WORKING_DIR
 
+# Durable checkpoints: a restarted job resumes where the last one stopped
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR',
+                                os.path.join(WORKING_DIR, 'checkpoint'))
+
 # Use multiprocessing?
 cfg.PARAMS['use_multiprocessing'] = True
 
@@ -34,18 +43,20 @@ cfg.PARAMS['continue_on_error'] = True
 cfg.PARAMS['auto_skip_task'] = False
 
 # Get the RGI file
-rgidf = gpd.read_file(utils.get_rgi_region_file(rgi_reg, version=rgi_version))
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
 
-# Sort for more efficient parallel computing
-rgidf = rgidf.sort_values('Area', ascending=False)
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
 
 # Module logger
 log = logging.getLogger(__name__)
 log.info('Starting run for RGI reg: ' + rgi_reg)
 log.info('Number of glaciers: {}'.format(len(rgidf)))
 
-# Go - initialize working directories
-gdirs = workflow.init_glacier_regions(rgidf, from_prepro_level=3)
+# Go - initialize working directories (from the checkpoints if any)
+checkpoint = Checkpoint(CHECKPOINT_DIR)
+set_checkpoint(checkpoint)
+gdirs = checkpoint.init_glacier_regions(rgidf, from_prepro_level=3)
 
 # Tasks
 task_list = [
@@ -63,8 +74,9 @@ task_list = [
     tasks.mass_conservation_inversion,
     tasks.filter_inversion_output,
 ]
-for task in task_list:
-    workflow.execute_entity_task(task, gdirs)
+# One chain per glacier: no need to wait for all glaciers between tasks,
+# and the intermediate pickles are written to disk only once at the end
+execute_task_chain(task_list, gdirs, in_memory=True)
 
 # Glacier stats
 utils.compile_glacier_statistics(gdirs,
@@ -72,8 +84,12 @@ utils.compile_glacier_statistics(gdirs,
 utils.compile_climate_statistics(gdirs, add_climate_period=[1920, 1960, 2000],
                                  filesuffix='_{}'.format(rgi_reg))
 
-# End - compress all
-workflow.execute_entity_task(utils.gdir_to_tar, gdirs)
+# Which tasks and glaciers cost the most
+compile_task_profile(gdirs, since=start)
+
+# End - compress all (this deletes the directories: no more checkpoints)
+set_checkpoint(None)
+execute_entity_task(utils.gdir_to_tar, gdirs)
 
 # Log
 m, s = divmod(time.time() - start, 60)
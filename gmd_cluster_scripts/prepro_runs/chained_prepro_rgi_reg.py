@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+
+# Locals
+import oggm.cfg as cfg
+from oggm import utils
+from gmd_cluster_scripts.prepro import run_prepro_levels
+from gmd_cluster_scripts.scheduling import execute_entity_task, sort_by_cost
+from gmd_cluster_scripts.store import (GlacierStore, default_store_path,
+                                       gdir_to_store, delete_stored_gdirs)
+from gmd_cluster_scripts.rgi_cache import read_rgi_region
+from gmd_cluster_scripts.profiling import compile_task_profile
+
+# Time
+start = time.time()
+
+# Run settings
+rgi_version = '61'
+rgi_reg = '{:02}'.format(int(os.environ.get('RGI_REG')))
+
+# Which levels should be written to disk, and how? ('tar' writes one tar
+# file per glacier, 'bundle' one indexed file per level). The last level
+# is packed into the region's glacier store at the end of the run.
+output_levels = [1, 2, 3]
+archive_format = 'bundle'
+
+# Initialize OGGM and set up the run parameters
+cfg.initialize(logging_level='WORKFLOW')
+
+# Local paths (where to write output and where to download input)
+WORKING_DIR = os.environ["WORKDIR"]
+utils.mkdir(WORKING_DIR)
+cfg.PATHS['working_dir'] = WORKING_DIR
+
+# Use multiprocessing?
+cfg.PARAMS['use_multiprocessing'] = True
+
+# How many grid points around the glacier?
+# Make it large if you expect your glaciers to grow large
+cfg.PARAMS['border'] = 160
+
+# Set to True for operational runs
+cfg.PARAMS['continue_on_error'] = True
+cfg.PARAMS['auto_skip_task'] = False
+
+# We use intersects (looked up per glacier with an index)
+rgif = utils.get_rgi_intersects_region_file(rgi_reg, version=rgi_version)
+
+# Pre-download other files which will be needed later
+_ = utils.get_cru_file(var='tmp')
+_ = utils.get_cru_file(var='pre')
+
+# Get the RGI file
+rgidf = read_rgi_region(rgi_reg, version=rgi_version)
+
+# Sort by expected run time for more efficient parallel computing
+rgidf = sort_by_cost(rgidf)
+
+# Module logger
+log = logging.getLogger(__name__)
+log.info('Starting run for RGI reg: ' + rgi_reg)
+log.info('Number of glaciers: {}'.format(len(rgidf)))
+
+# Go - all levels in one go, the archives are written in the background
+gdirs = run_prepro_levels(rgidf, max_level=4, output_levels=output_levels,
+                          output_dir=WORKING_DIR,
+                          archive_format=archive_format,
+                          intersects_db=rgif)
+
+# Glacier stats
+utils.compile_glacier_statistics(gdirs,
+                                 filesuffix='_{}'.format(rgi_reg))
+utils.compile_climate_statistics(gdirs, add_climate_period=[1920, 1960, 2000],
+                                 filesuffix='_{}'.format(rgi_reg))
+
+# Which tasks and glaciers cost the most
+compile_task_profile(gdirs, since=start)
+
+# End - pack all glacier directories into one container for the region
+execute_entity_task(gdir_to_store, gdirs)
+with GlacierStore(default_store_path()) as store:
+    store.finalize()
+delete_stored_gdirs(gdirs)
+
+# Log
+m, s = divmod(time.time() - start, 60)
+h, m = divmod(m, 60)
+log.info("OGGM is done! Time needed: %02d:%02d:%02d" % (h, m, s))
@@ -0,0 +1,170 @@
+"""Resource usage of the entity tasks, per glacier.
+
+The scheduler (:py:mod:`gmd_cluster_scripts.scheduling`) measures, for each
+task on each glacier, in the worker process:
+
+- the wall time and the CPU time (user + system) of the worker
+- the peak resident memory of the worker during the task (the peak is reset
+  before each task where Linux allows it, see ``/proc/[pid]/clear_refs``;
+  elsewhere, this is the peak since the start of the worker)
+- the bytes read and written by the worker (``/proc/self/io``, counting all
+  read/write calls, including those served by the page cache)
+
+and appends them to the timings file. :py:func:`compile_task_profile`
+compiles them into one table per run, next to ``task_log.csv``, with a
+short report of the most expensive tasks and glaciers.
+"""
+# Built ins
+import os
+import time
+import logging
+import resource
+
+# External libs
+import numpy as np
+import pandas as pd
+
+# Locals
+import oggm.cfg as cfg
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# The measured quantities, in the order of the timings file
+PROFILE_COLUMNS = ['wall_time', 'cpu_time', 'peak_rss_mb', 'read_mb',
+                   'write_mb']
+
+MB = 1024. * 1024.
+
+
+def _io_counters():
+    """The (read, written) bytes of this process, or NaNs."""
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f)
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return np.nan, np.nan
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    # In kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class task_profile(object):
+    """Context manager measuring the resources used by a task.
+
+    The measures are available in the ``result`` dict after the block.
+    """
+
+    def __enter__(self):
+        _reset_peak_rss()
+        self._io = _io_counters()
+        self._cpu = time.process_time()
+        self._wall = time.time()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.time() - self._wall
+        cpu = time.process_time() - self._cpu
+        rchar, wchar = _io_counters()
+        self.result = dict(wall_time=wall, cpu_time=cpu,
+                           peak_rss_mb=_peak_rss_mb(),
+                           read_mb=(rchar - self._io[0]) / MB,
+                           write_mb=(wchar - self._io[1]) / MB)
+
+
+def compile_task_profile(gdirs=None, task_names=None, filesuffix='',
+                         since=None, timings_file=None, n_top=10):
+    """Compile the task profiles of a run into a table and a report.
+
+    Writes ``task_profile{filesuffix}.csv`` (one row per glacier, one column
+    per task and measure) and ``task_profile{filesuffix}.txt`` (the totals
+    per task and the most expensive glaciers) in the working directory.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory, optional
+        the glaciers to report (default: all in the timings file)
+    task_names : list of str, optional
+        the tasks to report (default: all in the timings file)
+    filesuffix : str
+        added to the output file names
+    since : float, optional
+        only report the tasks done after this time (``time.time()``), e.g.
+        the start of the script (the timings file holds the earlier runs
+        too)
+    timings_file : str
+        the timings file (default: ``task_timings.csv`` in the working
+        directory)
+    n_top : int
+        the number of glaciers listed in the report
+
+    Returns
+    -------
+    the compiled DataFrame
+    """
+
+    if timings_file is None:
+        timings_file = os.path.join(cfg.PATHS['working_dir'],
+                                    'task_timings.csv')
+    df = pd.read_csv(timings_file)
+    if since is not None:
+        df = df.loc[df.timestamp >= since]
+    df = df.drop_duplicates(subset=['rgi_id', 'task_name'], keep='last')
+    if gdirs is not None:
+        df = df.loc[df.rgi_id.isin([gd.rgi_id for gd in gdirs])]
+    if task_names is not None:
+        df = df.loc[df.task_name.isin(task_names)]
+    cols = [c for c in PROFILE_COLUMNS if c in df]
+
+    out = df.pivot(index='rgi_id', columns='task_name', values=cols)
+    out.columns = ['{}:{}'.format(t, c) for c, t in out.columns]
+    out = out[sorted(out.columns)]
+    odir = cfg.PATHS['working_dir']
+    out.to_csv(os.path.join(odir, 'task_profile' + filesuffix + '.csv'))
+
+    # Report
+    agg = dict((c, 'sum') for c in cols)
+    if 'peak_rss_mb' in agg:
+        agg['peak_rss_mb'] = 'max'
+    per_task = df.groupby('task_name').agg(agg)
+    per_task['wall_share'] = per_task['wall_time'] / df['wall_time'].sum()
+    per_task = per_task.sort_values('wall_time', ascending=False)
+    per_glacier = df.groupby('rgi_id').agg(agg)
+    per_glacier = per_glacier.sort_values('wall_time', ascending=False)
+
+    report = ['Task profile of {} glaciers, {} tasks'.format(len(out),
+                                                            len(per_task)),
+              '',
+              'Per task (times and I/O summed over all glaciers, peak '
+              'memory is the maximum):',
+              per_task.to_string(float_format='{:.2f}'.format),
+              '',
+              'Most expensive glaciers (all tasks):',
+              per_glacier.iloc[:n_top].to_string(
+                  float_format='{:.2f}'.format),
+              ]
+    report = '\n'.join(report)
+    with open(os.path.join(odir, 'task_profile' + filesuffix + '.txt'),
+              'w') as f:
+        f.write(report + '\n')
+    log.workflow('Most expensive tasks:\n%s',
+                 per_task[['wall_time', 'wall_share']].iloc[:5].to_string())
+    return out
@@ -0,0 +1,262 @@
+"""Columnar cache of the RGI region files.
+
+Parsing the RGI shapefiles takes a long time for the large regions, and it is
+done again by every job and notebook. The first read of a region writes it
+to a columnar cache, in the ``RGI_CACHE_DIR`` directory (this should be on a
+disk shared by the jobs, the default is next to the RGI files, which are
+extracted anew by every job on the cluster):
+
+- one ``.npy`` file per attribute (read with memory mapping, so that only
+  the columns and rows which are asked for are actually read)
+- the geometries as WKB, in one byte buffer with the row offsets
+- a ``meta.json`` with the column names, the CRS and the size and content
+  hash of the shapefile (the cache is rebuilt if they change)
+
+The rows can be filtered on their attributes before the geometries, which
+are the expensive part, are built.
+"""
+# Built ins
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+# External libs
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely.wkb
+
+# Locals
+from oggm import utils
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Change this if the cache format changes
+CACHE_VERSION = 2
+
+# The content hashes already computed, by (path, size, mtime)
+_STAMPS = dict()
+
+
+def _file_stamp(path, blocksize=1 << 20):
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _STAMPS:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+        _STAMPS[key] = [st.st_size, h.hexdigest()]
+    return _STAMPS[key]
+
+
+def _source_stamp(shp_path):
+    # The content and not the modification time: the RGI files are
+    # extracted again by each job
+    out = []
+    for ext in ['.shp', '.dbf']:
+        path = os.path.splitext(shp_path)[0] + ext
+        if os.path.exists(path):
+            out.append(_file_stamp(path))
+    return out
+
+
+def _cache_dir(shp_path, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get('RGI_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(shp_path), 'columnar_cache')
+    name = os.path.splitext(os.path.basename(shp_path))[0]
+    return os.path.join(cache_dir, name)
+
+
+def write_rgi_cache(shp_path, cache_dir=None):
+    """Write the columnar cache of an RGI shapefile.
+
+    Parameters
+    ----------
+    shp_path : str
+        the RGI shapefile
+    cache_dir : str
+        where to write the cache (default: the ``RGI_CACHE_DIR`` environment
+        variable, ``columnar_cache`` next to the shapefile if not set)
+
+    Returns
+    -------
+    the path to the cache directory
+    """
+
+    odir = _cache_dir(shp_path, cache_dir=cache_dir)
+    gdf = gpd.read_file(shp_path)
+
+    # Written to a temporary directory first: parallel jobs may write the
+    # same cache
+    tmp = odir + '.tmp{}'.format(os.getpid())
+    utils.mkdir(tmp, reset=True)
+    columns = []
+    for col in gdf.columns:
+        if col == 'geometry':
+            continue
+        values = np.asarray(gdf[col].values)
+        if values.dtype.kind not in 'biufU':
+            # Strings (with possible missing values)
+            isnull = pd.isnull(values)
+            if isnull.any():
+                np.save(os.path.join(tmp, col + '.null.npy'), isnull)
+            values = np.where(isnull, '', values).astype(str)
+        np.save(os.path.join(tmp, col + '.npy'), values)
+        columns.append(col)
+
+    wkbs = [shapely.wkb.dumps(g) for g in gdf.geometry]
+    offsets = np.zeros(len(wkbs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(w) for w in wkbs])
+    np.save(os.path.join(tmp, 'geometry.offsets.npy'), offsets)
+    np.save(os.path.join(tmp, 'geometry.wkb.npy'),
+            np.frombuffer(b''.join(wkbs), dtype=np.uint8))
+
+    crs = gdf.crs
+    if hasattr(crs, 'srs'):
+        crs = crs.srs
+    meta = dict(cache_version=CACHE_VERSION, columns=columns, crs=crs,
+                nrows=len(gdf), source=_source_stamp(shp_path))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(odir):
+        shutil.rmtree(odir, ignore_errors=True)
+    try:
+        os.rename(tmp, odir)
+    except OSError:
+        # Someone else was faster
+        shutil.rmtree(tmp, ignore_errors=True)
+    return odir
+
+
+class _LazyColumns(object):
+    """Columns of a cache, memory mapped when they are asked for."""
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self._cols = dict()
+
+    def __getitem__(self, col):
+        if col not in self.columns:
+            raise KeyError(col)
+        if col not in self._cols:
+            self._cols[col] = np.load(os.path.join(self.path, col + '.npy'),
+                                      mmap_mode='r')
+        return self._cols[col]
+
+    def get(self, col, rows):
+        values = np.asarray(self[col][rows])
+        fnull = os.path.join(self.path, col + '.null.npy')
+        if os.path.exists(fnull):
+            values = values.astype(object)
+            values[np.load(fnull)[rows]] = None
+        return values
+
+
+def _read_meta(path, shp_path):
+    fmeta = os.path.join(path, 'meta.json')
+    if not os.path.exists(fmeta):
+        return None
+    with open(fmeta) as f:
+        meta = json.load(f)
+    if (meta['cache_version'] != CACHE_VERSION or
+            meta['source'] != _source_stamp(shp_path)):
+        return None
+    return meta
+
+
+def read_rgi_file(shp_path, columns=None, rgi_ids=None, where=None,
+                  geometry=True, cache_dir=None):
+    """Same as ``gpd.read_file`` for an RGI shapefile, using the cache.
+
+    Parameters
+    ----------
+    shp_path : str
+        the RGI shapefile
+    columns : list of str, optional
+        the attributes to read (default: all). ``RGIId`` is always read.
+    rgi_ids : list of str, optional
+        read these glaciers only (in the file's order)
+    where : callable, optional
+        row filter, called with the columns of the file (any column, loaded
+        when asked for: ``where=lambda c: c['Area'] > 1``). It should return
+        a boolean array.
+    geometry : bool
+        build the geometries (set to False for the attributes only, which is
+        much faster)
+    cache_dir : str
+        see :py:func:`write_rgi_cache`
+
+    Returns
+    -------
+    a GeoDataFrame (a DataFrame if ``geometry`` is False)
+    """
+
+    path = _cache_dir(shp_path, cache_dir=cache_dir)
+    meta = _read_meta(path, shp_path)
+    if meta is None:
+        log.info('Writing the RGI cache of %s', os.path.basename(shp_path))
+        path = write_rgi_cache(shp_path, cache_dir=cache_dir)
+        meta = _read_meta(path, shp_path)
+
+    lazy = _LazyColumns(path, meta['columns'])
+    keep = np.ones(meta['nrows'], dtype=bool)
+    if rgi_ids is not None:
+        keep &= np.isin(lazy['RGIId'], utils.tolist(rgi_ids))
+    if where is not None:
+        keep &= np.asarray(where(lazy), dtype=bool)
+    rows = np.nonzero(keep)[0]
+
+    if columns is None:
+        columns = meta['columns']
+    else:
+        columns = ['RGIId'] + [c for c in columns if c != 'RGIId']
+    df = pd.DataFrame(dict((c, lazy.get(c, rows)) for c in columns),
+                      columns=columns)
+    if not geometry:
+        return df
+
+    offsets = np.load(os.path.join(path, 'geometry.offsets.npy'),
+                      mmap_mode='r')
+    wkb = np.load(os.path.join(path, 'geometry.wkb.npy'), mmap_mode='r')
+    geoms = [shapely.wkb.loads(wkb[offsets[i]:offsets[i+1]].tobytes())
+             for i in rows]
+    return gpd.GeoDataFrame(df, geometry=geoms, crs=meta['crs'])
+
+
+def read_rgi_region(rgi_reg, version=None, **kwargs):
+    """Read an RGI region with the cache (see :py:func:`read_rgi_file`).
+
+    Replaces ``gpd.read_file(utils.get_rgi_region_file(rgi_reg, version))``.
+    """
+    shp_path = utils.get_rgi_region_file(rgi_reg, version=version)
+    return read_rgi_file(shp_path, **kwargs)
+
+
+def read_rgi_regions(rgi_regs=None, version=None, **kwargs):
+    """Read several RGI regions (default: all) in one frame.
+
+    Parameters
+    ----------
+    rgi_regs : list, optional
+        the regions to read (default: 1 to 19)
+    version : str
+        the RGI version
+    **kwargs :
+        passed to :py:func:`read_rgi_file`
+    """
+    if rgi_regs is None:
+        rgi_regs = range(1, 20)
+    out = [read_rgi_region('{:02}'.format(int(reg)), version=version,
+                           **kwargs) for reg in rgi_regs]
+    if kwargs.get('geometry', True):
+        return gpd.GeoDataFrame(pd.concat(out, ignore_index=True),
+                                crs=out[0].crs)
+    return pd.concat(out, ignore_index=True)
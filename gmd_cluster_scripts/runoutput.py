@@ -0,0 +1,614 @@
+"""The output of the dynamical runs, with an optional steady-state stop.
+
+The equilibrium experiments (constant or random climate) run for hundreds
+of years, long after most glaciers have stopped changing. With a
+:py:class:`SteadyState` criterion, the run of a glacier stops as soon as the
+trend of its volume over a rolling window is small enough:
+
+- the remaining months of the diagnostics are filled with the mean of each
+  variable over the window (the equilibrium state), and the remaining years
+  of the model run with the last geometry
+- the stop year is stored in the ``steady_state_year`` attribute of the
+  diagnostics, and the standard deviation of each variable over the window
+  in its ``steady_state_std`` attribute
+
+so that the files keep the format and length of ``run_until_and_store``,
+and are compiled as before. This module also holds the writers shared by the
+single glacier and the batched runs (:py:mod:`~gmd_cluster_scripts.batchflow`).
+
+With a :py:class:`RunOutputAccumulator`, the runs write no file at all:
+each run writes the yearly volume, area and length of its glacier into the
+region-level arrays of the accumulator, which are written as the compiled
+``run_output`` file at the end (instead of reading back one diagnostics
+file per glacier with ``compile_run_output``). The models are then stored
+yearly, and the ELA (a root finding at each month) is not computed. The rows
+can be kept on a shared disk as well, so that a restarted job only runs the
+glaciers which are missing.
+"""
+# Built ins
+import os
+import copy
+import hashlib
+import logging
+import functools
+from collections import OrderedDict
+from time import gmtime, strftime
+
+# External libs
+import numpy as np
+import xarray as xr
+
+# Locals
+import oggm
+import oggm.cfg as cfg
+from oggm import utils
+from oggm.core import flowline
+from oggm.core.flowline import FluxBasedModel
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# The time stepping schemes tried by robust_model_run
+TIME_STEPPING = ['default', 'conservative', 'ultra-conservative']
+
+# The diagnostic variables which accumulate over the run
+CUMULATIVE_VARS = ['calving_m3']
+
+
+class SteadyState(object):
+    """A volume-trend criterion for the end of an equilibrium run.
+
+    The glacier is in steady state when the linear trend of its volume
+    (at the start of each year) over the last ``window`` years, times the
+    window, is smaller than ``rtol`` times the mean volume plus ``atol``.
+
+    Parameters
+    ----------
+    window : int
+        the length of the rolling window [years]
+    rtol : float
+        the relative tolerance on the volume change over the window
+    atol : float
+        the absolute tolerance on the volume change over the window [m3]
+        (with the default of zero, a glacier which disappeared for the
+        whole window is in steady state)
+    """
+
+    def __init__(self, window=100, rtol=0.01, atol=0.):
+        if window < 2:
+            raise ValueError('the window must be at least two years long')
+        self.window = int(window)
+        self.rtol = rtol
+        self.atol = atol
+
+    def __repr__(self):
+        return 'SteadyState(window={}, rtol={}, atol={})'.format(
+            self.window, self.rtol, self.atol)
+
+    def checkpoint_key(self):
+        """Identifies the criterion in the checkpoint records."""
+        return [self.window, self.rtol, self.atol]
+
+    def converged(self, volume):
+        """Whether the yearly volume series has reached steady state."""
+        if len(volume) < self.window + 1:
+            return False
+        v = np.asarray(volume[-(self.window + 1):], dtype=float)
+        if not np.all(np.isfinite(v)):
+            return False
+        t = np.arange(len(v)) - self.window / 2.
+        trend = np.sum(t * (v - np.mean(v))) / np.sum(t**2)
+        return abs(trend) * self.window <= self.rtol * np.mean(v) + self.atol
+
+    def fill(self, diag, i, sects=None, widths=None, j=None, per_year=12):
+        """Fill the output after the stop with the equilibrium state.
+
+        Parameters
+        ----------
+        diag : dict
+            the diagnostics, filled up to ``i`` included
+        i : int
+            the index of the last time step run
+        sects, widths : list of arrays
+            the yearly flowline geometry, filled up to ``j`` excluded
+        per_year : int
+            the number of diagnostic time steps per year
+
+        Returns
+        -------
+        a dict with the standard deviation of each variable over the window
+        """
+        w0 = max(i + 1 - per_year * self.window, 0)
+        std = dict()
+        for name, values in diag.items():
+            win = values[w0:i + 1]
+            std[name] = float(np.nanstd(win))
+            if name in CUMULATIVE_VARS:
+                rate = (win[-1] - win[0]) / max(len(win) - 1, 1)
+                values[i + 1:] = win[-1] + rate * np.arange(
+                    1, len(values) - i)
+            else:
+                values[i + 1:] = np.nanmean(win)
+        for s in (sects or []) + (widths or []):
+            s[j:, :] = s[j - 1, :]
+        return std
+
+    def annotate(self, diag_ds, yr, std):
+        """Record the stop year and statistics in the diagnostics dataset."""
+        diag_ds.attrs['steady_state_year'] = yr
+        diag_ds.attrs['steady_state_window'] = self.window
+        diag_ds.attrs['steady_state_rtol'] = self.rtol
+        diag_ds.attrs['steady_state_atol'] = self.atol
+        for name, v in std.items():
+            diag_ds[name].attrs['steady_state_std'] = v
+
+
+def diag_dataset(monthly_time, yrs, months, diag):
+    """The diagnostics dataset, as written by run_until_and_store."""
+
+    cyrs, cmonths = utils.hydrodate_to_calendardate(yrs, months)
+    diag_ds = xr.Dataset()
+
+    # Global attributes
+    diag_ds.attrs['description'] = 'OGGM model output'
+    diag_ds.attrs['oggm_version'] = oggm.__version__
+    diag_ds.attrs['calendar'] = '365-day no leap'
+    diag_ds.attrs['creation_date'] = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+
+    # Coordinates
+    diag_ds.coords['time'] = ('time', monthly_time)
+    diag_ds.coords['hydro_year'] = ('time', yrs)
+    diag_ds.coords['hydro_month'] = ('time', months)
+    diag_ds.coords['calendar_year'] = ('time', cyrs)
+    diag_ds.coords['calendar_month'] = ('time', cmonths)
+
+    diag_ds['time'].attrs['description'] = 'Floating hydrological year'
+    diag_ds['hydro_year'].attrs['description'] = 'Hydrological year'
+    diag_ds['hydro_month'].attrs['description'] = 'Hydrological month'
+    diag_ds['calendar_year'].attrs['description'] = 'Calendar year'
+    diag_ds['calendar_month'].attrs['description'] = 'Calendar month'
+
+    # Variables and attributes
+    diag_ds['volume_m3'] = ('time', diag['volume_m3'])
+    diag_ds['volume_m3'].attrs['description'] = 'Total glacier volume'
+    diag_ds['volume_m3'].attrs['unit'] = 'm 3'
+    diag_ds['area_m2'] = ('time', diag['area_m2'])
+    diag_ds['area_m2'].attrs['description'] = 'Total glacier area'
+    diag_ds['area_m2'].attrs['unit'] = 'm 2'
+    diag_ds['length_m'] = ('time', diag['length_m'])
+    diag_ds['length_m'].attrs['description'] = 'Glacier length'
+    diag_ds['length_m'].attrs['unit'] = 'm 3'
+    diag_ds['ela_m'] = ('time', diag['ela_m'])
+    diag_ds['ela_m'].attrs['description'] = ('Annual Equilibrium Line '
+                                             'Altitude  (ELA)')
+    diag_ds['ela_m'].attrs['unit'] = 'm a.s.l'
+    if 'calving_m3' in diag:
+        diag_ds['calving_m3'] = ('time', diag['calving_m3'])
+        diag_ds['calving_m3'].attrs['description'] = ('Total accumulated '
+                                                      'calving flux')
+        diag_ds['calving_m3'].attrs['unit'] = 'm 3'
+    return diag_ds
+
+
+def write_run(run_path, yearly_time, sects, widths):
+    """Append the flowline time series to the model_run file."""
+    encode = {'ts_section': {'zlib': True, 'complevel': 5},
+              'ts_width_m': {'zlib': True, 'complevel': 5},
+              }
+    for i, (s, w) in enumerate(zip(sects, widths)):
+        ds = xr.Dataset()
+        ds.attrs['description'] = 'OGGM model output'
+        ds.attrs['oggm_version'] = oggm.__version__
+        ds.attrs['calendar'] = '365-day no leap'
+        ds.attrs['creation_date'] = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+        ds.coords['time'] = yearly_time
+        ds['time'].attrs['description'] = 'Floating hydrological year'
+        varcoords = OrderedDict(time=('time', yearly_time),
+                                year=('time', yearly_time))
+        ds['ts_section'] = xr.DataArray(s, dims=('time', 'x'),
+                                        coords=varcoords)
+        ds['ts_width_m'] = xr.DataArray(w, dims=('time', 'x'),
+                                        coords=varcoords)
+        ds.to_netcdf(run_path, 'a', group='fl_{}'.format(i),
+                     encoding=encode)
+
+
+def yearly_volume(diag, months, i):
+    """The volume at the start of each year, up to the month ``i``."""
+    return diag['volume_m3'][:i + 1][months[:i + 1] == 1]
+
+
+def yearly_diagnostics(diag, months):
+    """The volume, area and length at the start of each year."""
+    return {k: diag[k][months == 1] for k in ['volume_m3', 'area_m2',
+                                              'length_m']}
+
+
+def run_until_and_store(model, y1, run_path=None, diag_path=None,
+                        steady_state=None, sink=None):
+    """Same as ``FlowlineModel.run_until_and_store``, with a steady state.
+
+    Parameters
+    ----------
+    model : FlowlineModel
+        the model to run
+    y1 : float
+        the end year of the run
+    run_path, diag_path : str
+        where to write the model run and diagnostics (None for no file)
+    steady_state : SteadyState
+        stop the run when the glacier reaches steady state (default: run
+        until ``y1``)
+    sink : callable
+        called with the yearly diagnostics at the end of the run (see
+        :py:func:`yearly_diagnostics`). Without any file to write, the
+        model is stored yearly and without ELA.
+
+    Returns
+    -------
+    the year at which the run stopped in steady state (None if it did not)
+    """
+
+    # time
+    monthly = run_path is not None or diag_path is not None
+    yearly_time = np.arange(np.floor(model.yr), np.floor(y1)+1)
+    if monthly:
+        times = utils.monthly_timeseries(model.yr, y1)
+    else:
+        times = yearly_time
+    yrs, months = utils.floatyear_to_date(times)
+
+    # init output
+    if run_path is not None:
+        model.to_netcdf(run_path)
+    ny = len(yearly_time)
+    nm = len(times)
+    sects = [(np.zeros((ny, fl.nx)) * np.nan) for fl in model.fls]
+    widths = [(np.zeros((ny, fl.nx)) * np.nan) for fl in model.fls]
+    names = ['volume_m3', 'area_m2', 'length_m']
+    if monthly:
+        names.append('ela_m')
+    if model.is_tidewater:
+        names.append('calving_m3')
+    diag = {k: np.zeros(nm) * np.nan for k in names}
+
+    # Run
+    stop = None
+    j = 0
+    for i, (yr, mo) in enumerate(zip(times, months)):
+        model.run_until(yr)
+        # Model run
+        if mo == 1:
+            for s, w, fl in zip(sects, widths, model.fls):
+                s[j, :] = fl.section
+                w[j, :] = fl.widths_m
+            j += 1
+        # Diagnostics
+        diag['volume_m3'][i] = model.volume_m3
+        diag['area_m2'][i] = model.area_m2
+        diag['length_m'][i] = model.length_m
+        if monthly:
+            diag['ela_m'][i] = model.mb_model.get_ela(year=yr)
+        if model.is_tidewater:
+            diag['calving_m3'][i] = model.calving_m3_since_y0
+        # Steady state?
+        if (steady_state is not None and mo == 1 and i < nm - 1 and
+                steady_state.converged(yearly_volume(diag, months, i))):
+            stop = yr
+            std = steady_state.fill(diag, i, sects, widths, j,
+                                    per_year=12 if monthly else 1)
+            break
+
+    # write output?
+    if run_path is not None:
+        write_run(run_path, yearly_time, sects, widths)
+    if diag_path is not None:
+        diag_ds = diag_dataset(times, yrs, months, diag)
+        if stop is not None:
+            steady_state.annotate(diag_ds, stop, std)
+        diag_ds.to_netcdf(diag_path)
+    if sink is not None:
+        sink(yearly_diagnostics(diag, months))
+    return stop
+
+
+def _flowline_params(gdir, kwargs):
+    """glen_a and fs of the dynamical runs, as in robust_model_run."""
+    if 'glen_a' in kwargs and 'fs' in kwargs:
+        return kwargs['glen_a'], kwargs['fs']
+    if cfg.PARAMS.get('use_optimized_inversion_params'):
+        d = gdir.read_pickle('inversion_params')
+        glen_a, fs = d['glen_a'], d['fs']
+    else:
+        glen_a, fs = cfg.PARAMS['glen_a'], cfg.PARAMS['fs']
+    return kwargs.get('glen_a', glen_a), kwargs.get('fs', fs)
+
+
+def robust_model_run(gdir, output_filesuffix=None, mb_model=None, ys=None,
+                     ye=None, zero_initial_glacier=False,
+                     init_model_fls=None, steady_state=None,
+                     accumulator=None, **kwargs):
+    """Same as OGGM's ``robust_model_run``, with a steady state.
+
+    Without ``steady_state`` and ``accumulator``, this is OGGM's
+    ``robust_model_run``. Otherwise the run stops when the glacier reaches
+    steady state (see :py:func:`run_until_and_store`), and/or its yearly
+    diagnostics are written to the accumulator instead of the glacier
+    directory, with the same time stepping fallbacks.
+    """
+
+    if steady_state is None and accumulator is None:
+        return flowline.robust_model_run(
+            gdir, output_filesuffix=output_filesuffix, mb_model=mb_model,
+            ys=ys, ye=ye, zero_initial_glacier=zero_initial_glacier,
+            init_model_fls=init_model_fls, **kwargs)
+
+    glen_a, fs = _flowline_params(gdir, kwargs)
+    kwargs = dict(kwargs, glen_a=glen_a, fs=fs)
+    run_path = diag_path = sink = None
+    if accumulator is None:
+        run_path = gdir.get_filepath('model_run',
+                                     filesuffix=output_filesuffix,
+                                     delete=True)
+        diag_path = gdir.get_filepath('model_diagnostics',
+                                      filesuffix=output_filesuffix,
+                                      delete=True)
+    else:
+        sink = accumulator.sink(gdir.rgi_id, output_filesuffix)
+    for step in TIME_STEPPING:
+        if init_model_fls is None:
+            fls = gdir.read_pickle('model_flowlines')
+        else:
+            fls = copy.deepcopy(init_model_fls)
+        if zero_initial_glacier:
+            for fl in fls:
+                fl.thick = fl.thick * 0.
+        model = FluxBasedModel(fls, mb_model=mb_model, y0=ys,
+                               time_stepping=step,
+                               is_tidewater=gdir.is_tidewater, **kwargs)
+        try:
+            stop = run_until_and_store(model, ye, run_path=run_path,
+                                       diag_path=diag_path,
+                                       steady_state=steady_state, sink=sink)
+        except (RuntimeError, FloatingPointError):
+            if step == TIME_STEPPING[-1]:
+                raise
+            log.info('(%s) %s time stepping failed', gdir.rgi_id, step)
+            continue
+        break
+    if stop is not None:
+        log.info('(%s) steady state reached in year %d', gdir.rgi_id, stop)
+    return model
+
+
+class RunOutputAccumulator(object):
+    """The compiled run output of a region, written by the runs directly.
+
+    Each run writes the yearly volume, area and length of its glacier to
+    one preallocated array per output suffix, shared by all processes of
+    the node through a memory-mapped file. :py:meth:`finalize` then writes
+    the same ``run_output`` file as ``utils.compile_run_output`` (without
+    the ELA), without any per-glacier file. The glaciers which did not run
+    (or failed) are NaN, as in ``compile_run_output``.
+
+    The accumulator is created in the main process before the runs, and
+    passed to the tasks as an argument. The memory-mapped files must be on
+    a local disk (or in ``/dev/shm``), so that it can't be used with the
+    workers of other nodes.
+
+    With a ``durable_dir`` (e.g. in the checkpoint directory), each row is
+    also written to its own file there, and the rows of an earlier job are
+    read back when the accumulator is created: the runs already done can
+    then be skipped (see :py:meth:`has`) when a job is restarted.
+
+    Parameters
+    ----------
+    rgi_ids : list of str
+        the glaciers of the region (the order of the compiled file)
+    nyears : int
+        the length of the runs
+    filesuffixes : list of str
+        the output suffixes of the runs
+    base_dir : str
+        where to write the memory-mapped files (default: the working
+        directory)
+    durable_dir : str
+        where to keep a copy of each row, which outlives the job (default:
+        no copy)
+    """
+
+    VARS = [('volume', 'volume_m3', 'Total glacier volume', 'm 3'),
+            ('area', 'area_m2', 'Total glacier area', 'm 2'),
+            ('length', 'length_m', 'Glacier length', 'm')]
+
+    def __init__(self, rgi_ids, nyears, filesuffixes=('',), base_dir=None,
+                 durable_dir=None):
+        self.rgi_ids = list(rgi_ids)
+        self.nyears = int(nyears)
+        self.filesuffixes = list(filesuffixes)
+        if base_dir is None:
+            base_dir = cfg.PATHS['working_dir']
+        self.base_dir = base_dir
+        self.durable_dir = durable_dir
+        # One contiguous block per glacier: (glacier, variable, year)
+        self.shape = (len(self.rgi_ids), len(self.VARS), self.nyears + 1)
+        self._index = {rid: i for i, rid in enumerate(self.rgi_ids)}
+        ids = '\n'.join(self.rgi_ids).encode()
+        self._ids_hash = hashlib.sha1(ids).hexdigest()
+        self._mms = dict()
+        # The (glacier, suffix) rows read back from the durable directory
+        self.done = set()
+        for fsuf in self.filesuffixes:
+            mm = np.memmap(self._path(fsuf), dtype=np.float64, mode='w+',
+                           shape=self.shape)
+            mm[:] = np.nan
+            if durable_dir is not None:
+                self._read_rows(fsuf, mm)
+            mm.flush()
+        if self.done:
+            log.workflow('RunOutputAccumulator: %d runs read back from %s',
+                         len(self.done), durable_dir)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mms'] = dict()
+        # Only needed in the main process
+        state['done'] = set()
+        return state
+
+    def __repr__(self):
+        # Stable across processes (e.g. for the task cache keys)
+        return 'RunOutputAccumulator({}, nyears={}, filesuffixes={})'.format(
+            self._path(''), self.nyears, self.filesuffixes)
+
+    def checkpoint_key(self):
+        """Identifies the runs in the checkpoint records (unlike the repr,
+        without the path of the files, which changes from job to job).
+        """
+        return [self._ids_hash, self.nyears, self.filesuffixes]
+
+    def _path(self, filesuffix):
+        return os.path.join(self.base_dir,
+                            'run_output{}.accumulator'.format(filesuffix))
+
+    def _row_path(self, rgi_id, filesuffix):
+        return os.path.join(self.durable_dir, 'run_output' + filesuffix,
+                            rgi_id + '.npy')
+
+    def _read_rows(self, filesuffix, mm):
+        """Read the durable rows of a suffix into its memory-mapped file."""
+        row_dir = os.path.dirname(self._row_path('', filesuffix))
+        if not os.path.isdir(row_dir):
+            return
+        for fname in os.listdir(row_dir):
+            rgi_id, ext = os.path.splitext(fname)
+            if ext != '.npy' or rgi_id not in self._index:
+                continue
+            try:
+                row = np.load(os.path.join(row_dir, fname))
+            except (OSError, ValueError):
+                log.warning('RunOutputAccumulator: cannot read the row of '
+                            '%s%s, the run will be done again', rgi_id,
+                            filesuffix)
+                continue
+            if row.shape != self.shape[1:]:
+                continue
+            mm[self._index[rgi_id]] = row
+            self.done.add((rgi_id, filesuffix))
+
+    def _write_row(self, rgi_id, filesuffix, row):
+        """Write a row to the durable directory (atomically)."""
+        path = self._row_path(rgi_id, filesuffix)
+        utils.mkdir(os.path.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, row)
+        os.replace(tmp, path)
+
+    def has(self, rgi_id, filesuffix):
+        """Whether the row was read back from the durable directory."""
+        return (rgi_id, filesuffix or '') in self.done
+
+    def _memmap(self, filesuffix):
+        if filesuffix not in self._mms:
+            if filesuffix not in self.filesuffixes:
+                raise ValueError('unknown output suffix: '
+                                 '{}'.format(filesuffix))
+            self._mms[filesuffix] = np.memmap(self._path(filesuffix),
+                                              dtype=np.float64, mode='r+',
+                                              shape=self.shape)
+        return self._mms[filesuffix]
+
+    def write(self, rgi_id, filesuffix, diag):
+        """Write the yearly diagnostics of a glacier.
+
+        Parameters
+        ----------
+        rgi_id : str
+            the glacier
+        filesuffix : str
+            the output suffix of the run
+        diag : dict
+            the yearly ``volume_m3``, ``area_m2`` and ``length_m``
+        """
+        mm = self._memmap(filesuffix or '')
+        i = self._index[rgi_id]
+        for k, (_, name, _, _) in enumerate(self.VARS):
+            values = np.asarray(diag[name], dtype=np.float64)
+            if len(values) != self.shape[2]:
+                raise ValueError('({}) the run has {} years, the accumulator '
+                                 '{}'.format(rgi_id, len(values) - 1,
+                                             self.nyears))
+            mm[i, k, :] = values
+        mm.flush()
+        if self.durable_dir is not None:
+            self._write_row(rgi_id, filesuffix or '', np.array(mm[i]))
+
+    def sink(self, rgi_id, filesuffix):
+        """A callable writing the diagnostics of this glacier and suffix."""
+        return functools.partial(self.write, rgi_id, filesuffix or '')
+
+    def finalize(self, filesuffix='', path=True):
+        """Write the compiled run output of a suffix.
+
+        Parameters
+        ----------
+        filesuffix : str
+            the output suffix of the runs
+        path : str
+            where to write the file (default: ``run_output{filesuffix}.nc``
+            in the working directory, as ``compile_run_output``)
+
+        Returns
+        -------
+        the compiled dataset
+        """
+
+        mm = self._memmap(filesuffix)
+        time = np.arange(self.shape[2], dtype=np.float64)
+        yrs, months = utils.floatyear_to_date(time)
+        cyrs, cmonths = utils.hydrodate_to_calendardate(yrs, months)
+
+        ds = xr.Dataset()
+
+        # Global attributes
+        ds.attrs['description'] = 'OGGM model output'
+        ds.attrs['oggm_version'] = oggm.__version__
+        ds.attrs['calendar'] = '365-day no leap'
+        ds.attrs['creation_date'] = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+
+        # Coordinates
+        ds.coords['time'] = ('time', time)
+        ds.coords['rgi_id'] = ('rgi_id', self.rgi_ids)
+        ds.coords['hydro_year'] = ('time', yrs)
+        ds.coords['hydro_month'] = ('time', months)
+        ds.coords['calendar_year'] = ('time', cyrs)
+        ds.coords['calendar_month'] = ('time', cmonths)
+        ds['time'].attrs['description'] = 'Floating hydrological year'
+        ds['rgi_id'].attrs['description'] = 'RGI glacier identifier'
+        ds['hydro_year'].attrs['description'] = 'Hydrological year'
+        ds['hydro_month'].attrs['description'] = 'Hydrological month'
+        ds['calendar_year'].attrs['description'] = 'Calendar year'
+        ds['calendar_month'].attrs['description'] = 'Calendar month'
+
+        # Variables
+        for k, (name, _, desc, units) in enumerate(self.VARS):
+            ds[name] = (('time', 'rgi_id'), np.array(mm[:, k, :].T))
+            ds[name].attrs['description'] = desc
+            ds[name].attrs['units'] = units
+
+        if path:
+            if path is True:
+                path = os.path.join(cfg.PATHS['working_dir'],
+                                    'run_output' + filesuffix + '.nc')
+            ds.to_netcdf(path)
+        return ds
+
+    def close(self):
+        """Remove the memory-mapped files (not the durable rows)."""
+        self._mms = dict()
+        for fsuf in self.filesuffixes:
+            try:
+                os.remove(self._path(fsuf))
+            except FileNotFoundError:
+                pass
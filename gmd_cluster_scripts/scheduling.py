@@ -0,0 +1,564 @@
+"""Runtime-cost-aware scheduling of entity tasks.
+
+Sorting the RGI file by area is a poor proxy for run time: most tasks scale
+with the size of the local grid (which is dominated by ``border``), and the
+dynamical runs with the number of flowline points and simulated years. Here
+the cost of each glacier is predicted from its attributes and, when available,
+from the timings recorded in earlier runs. The glaciers are then sent to the
+pool longest-expected-first, one at a time: a worker which is done picks the
+next glacier in the queue, so that no worker is left alone with a large ice
+cap at the end of the job.
+
+:py:func:`execute_task_chain` goes one step further and sends a whole list
+of tasks per glacier, removing the barrier between two consecutive tasks.
+:py:func:`execute_entity_task_sweep` sends a task with several sets of
+arguments (e.g. parameter contexts, see :py:mod:`gmd_cluster_scripts.params`)
+at once, removing the barrier between the configurations of a sweep.
+"""
+# Built ins
+import os
+import time
+import logging
+
+# External libs
+import numpy as np
+import pandas as pd
+
+# Locals
+import oggm.cfg as cfg
+from oggm import utils, workflow
+from gmd_cluster_scripts.memstore import BufferedGlacierDirectory
+from gmd_cluster_scripts.params import apply_params
+from gmd_cluster_scripts.profiling import PROFILE_COLUMNS, task_profile
+from gmd_cluster_scripts.memory import (default_memory, imap_admitted,
+                                        memory_budget, n_flowlines)
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Where the timings are stored (relative to the working directory)
+TIMINGS_FILE = 'task_timings.csv'
+
+# Minimum number of recorded timings before fitting the cost model
+MIN_TIMINGS_FOR_FIT = 20
+
+# Used instead of the multiprocessing pool if set (see set_executor)
+_EXECUTOR = None
+
+# Where the glaciers are checkpointed, if set (see set_checkpoint)
+_CHECKPOINT = None
+
+
+def _grid_dx(area_km2):
+    """The map resolution as chosen by OGGM's define_glacier_region."""
+    if cfg.PARAMS['grid_dx_method'] == 'fixed':
+        return np.zeros_like(area_km2) + cfg.PARAMS['fixed_dx']
+    if cfg.PARAMS['grid_dx_method'] == 'linear':
+        dx = cfg.PARAMS['d1'] * area_km2 + cfg.PARAMS['d2']
+    else:
+        dx = cfg.PARAMS['d1'] * np.sqrt(area_km2) + cfg.PARAMS['d2']
+    return np.clip(dx, None, cfg.PARAMS['dmax'])
+
+
+def rgidf_features(rgidf):
+    """Cost features of RGI entities, before their directories exist.
+
+    The grid size is estimated from the outline bounds and the OGGM rules
+    for the map resolution and the border.
+    """
+
+    border = cfg.PARAMS['border']
+    area_km2 = rgidf['Area'].values.astype(float)
+    bounds = rgidf.geometry.bounds
+    lat = np.deg2rad((bounds.miny.values + bounds.maxy.values) / 2)
+    ext_x = (bounds.maxx.values - bounds.minx.values) * 111e3 * np.cos(lat)
+    ext_y = (bounds.maxy.values - bounds.miny.values) * 111e3
+    dx = _grid_dx(area_km2)
+    npix = (ext_x / dx + 2 * border) * (ext_y / dx + 2 * border)
+
+    form = rgidf['Form'] if 'Form' in rgidf else 0
+    ttype = rgidf['TermType'] if 'TermType' in rgidf else 0
+    return pd.DataFrame({'npix': npix,
+                         'area_km2': area_km2,
+                         'is_icecap': np.asarray(form).astype(int) == 1,
+                         'is_tidewater': np.isin(np.asarray(ttype).astype(int),
+                                                 [1, 2]),
+                         }, index=rgidf['RGIId'].values)
+
+
+def gdirs_features(gdirs):
+    """Cost features of glacier directories (actual grid size)."""
+
+    out = []
+    for gdir in gdirs:
+        try:
+            npix = gdir.grid.nx * gdir.grid.ny
+        except Exception:
+            # Directory not properly initialized: the task will fail fast
+            npix = 1
+        out.append((gdir.rgi_id, npix, gdir.rgi_area_km2,
+                    gdir.is_icecap, gdir.is_tidewater))
+    df = pd.DataFrame(out, columns=['rgi_id', 'npix', 'area_km2',
+                                    'is_icecap', 'is_tidewater'])
+    return df.set_index('rgi_id')
+
+
+def _design_matrix(features):
+    return np.stack([np.ones(len(features)),
+                     np.log(features['npix'].values.clip(1)),
+                     np.log(features['area_km2'].values.clip(1e-3)),
+                     features['is_icecap'].values.astype(float),
+                     features['is_tidewater'].values.astype(float),
+                     ], axis=1)
+
+
+def read_timings(path=None, value='wall_time'):
+    """Read the timings recorded in earlier runs.
+
+    Parameters
+    ----------
+    path : str
+        the timings file (default: ``task_timings.csv`` in the working
+        directory)
+    value : str
+        the measure to read (one of
+        :py:data:`~gmd_cluster_scripts.profiling.PROFILE_COLUMNS`)
+
+    Returns
+    -------
+    a DataFrame with one row per glacier and one column per task (the last
+    recorded value), or None if no timings are available
+    """
+
+    if path is None:
+        path = os.path.join(cfg.PATHS['working_dir'], TIMINGS_FILE)
+    if not os.path.exists(path):
+        return None
+    df = pd.read_csv(path)
+    if value not in df:
+        return None
+    df = df.loc[np.isfinite(df[value])]
+    df = df.drop_duplicates(subset=['rgi_id', 'task_name'], keep='last')
+    return df.pivot(index='rgi_id', columns='task_name', values=value)
+
+
+def write_timings(records, path=None):
+    """Append records to the timings file.
+
+    The records are lists of: RGI id, task name (with the file suffix, as in
+    the task log), the measures of
+    :py:data:`~gmd_cluster_scripts.profiling.PROFILE_COLUMNS`, and the time
+    at which the glacier was done. Files written before the profiling was
+    added (wall time only) are converted.
+    """
+
+    if path is None:
+        path = os.path.join(cfg.PATHS['working_dir'], TIMINGS_FILE)
+    columns = ['rgi_id', 'task_name'] + PROFILE_COLUMNS + ['timestamp']
+    df = pd.DataFrame(records, columns=columns)
+    if os.path.exists(path):
+        with open(path) as f:
+            header = f.readline().strip().split(',')
+        if header != columns:
+            df = pd.concat([pd.read_csv(path), df], ignore_index=True,
+                           sort=False)[columns]
+            df.to_csv(path, index=False)
+            return
+    df.to_csv(path, mode='a', index=False, header=not os.path.exists(path))
+
+
+def _fit_records(features, default, recorded):
+    """Use the records where available, and fit them for the others.
+
+    If enough records are available, a log-linear model is fitted to them
+    and used for the glaciers without a record. Otherwise, the default values
+    are brought to the scale of the records.
+    """
+
+    out = default.copy()
+    recorded = recorded.reindex(features.index)
+    ok = np.isfinite(recorded.values) & (recorded.values > 0)
+    if ok.sum() < MIN_TIMINGS_FOR_FIT:
+        if ok.any():
+            # Bring the records to the same scale as the default values
+            scale = np.median(recorded.values[ok] / out.values[ok])
+            out = out * scale
+            out[ok] = recorded.values[ok]
+        return out
+
+    x = _design_matrix(features)
+    coefs, _, _, _ = np.linalg.lstsq(x[ok], np.log(recorded.values[ok]),
+                                     rcond=None)
+    out[:] = np.exp(x.dot(coefs))
+    out[ok] = recorded.values[ok]
+    return out
+
+
+def predict_costs(features, task_name=None, timings=None):
+    """Predict the relative cost of each glacier for a task.
+
+    Without recorded timings, the cost is the number of grid points. If
+    enough timings are available for this task, a log-linear model is fitted
+    to them and used for the glaciers without a record, while the glaciers
+    with a record use it directly.
+
+    Parameters
+    ----------
+    features : DataFrame
+        as returned by :py:func:`gdirs_features` or :py:func:`rgidf_features`
+    task_name : str
+        the task to predict the cost for
+    timings : DataFrame
+        as returned by :py:func:`read_timings`
+
+    Returns
+    -------
+    a Series of costs, indexed like ``features``
+    """
+
+    costs = pd.Series(features['npix'].values.astype(float),
+                      index=features.index)
+    if timings is None or task_name not in timings:
+        return costs
+    return _fit_records(features, costs, timings[task_name])
+
+
+def predict_memory(features, task_name=None, peak_rss=None):
+    """Predict the peak memory (MB) of a worker running a task.
+
+    Same as :py:func:`predict_costs`, with the recorded peak RSS and, without
+    records, :py:func:`~gmd_cluster_scripts.memory.default_memory`.
+
+    Parameters
+    ----------
+    features : DataFrame
+        as returned by :py:func:`gdirs_features` (optionally with a
+        ``n_flowlines`` column)
+    task_name : str
+        the task to predict the memory for
+    peak_rss : DataFrame
+        as returned by ``read_timings(value='peak_rss_mb')``
+    """
+
+    mem = default_memory(features)
+    if peak_rss is None or task_name not in peak_rss:
+        return mem
+    return _fit_records(features, mem, peak_rss[task_name])
+
+
+def sort_by_cost(rgidf, task_name='define_glacier_region', timings=None):
+    """Sort the RGI entities by decreasing expected cost.
+
+    To use instead of ``rgidf.sort_values('Area', ascending=False)`` before
+    ``init_glacier_regions``.
+    """
+    costs = predict_costs(rgidf_features(rgidf), task_name=task_name,
+                          timings=timings)
+    order = np.argsort(-costs.values, kind='stable')
+    return rgidf.iloc[order]
+
+
+def set_executor(executor):
+    """Dispatch the glaciers to ``executor`` instead of the local pool.
+
+    The executor needs an ``imap_unordered(func, items)`` method (see
+    :py:class:`~gmd_cluster_scripts.distributed.Coordinator`). Set to None
+    to go back to the multiprocessing pool.
+    """
+    global _EXECUTOR
+    _EXECUTOR = executor
+
+
+def set_checkpoint(checkpoint):
+    """Checkpoint each glacier after its tasks, and skip the done ones.
+
+    See :py:class:`~gmd_cluster_scripts.checkpoint.Checkpoint`. Set to None
+    to stop checkpointing.
+    """
+    global _CHECKPOINT
+    _CHECKPOINT = checkpoint
+
+
+class _timed_chain(object):
+    """Picklable callable which runs a chain of entity tasks and profiles
+    them.
+    """
+
+    def __init__(self, chain, in_memory=False, checkpoint=None):
+        self.chain = chain
+        self.in_memory = in_memory
+        self.checkpoint = checkpoint
+
+    def __call__(self, arg):
+        # The items of a sweep come with their own keyword arguments
+        i, gdir, extra = arg if len(arg) == 3 else arg + (None, )
+        chain = _merge_kwargs(self.chain, extra)
+        if self.in_memory:
+            gdir = BufferedGlacierDirectory.from_gdir(gdir)
+        outs = []
+        profiles = []
+        try:
+            for task, kwargs in chain:
+                kwargs = dict(kwargs)
+                with task_profile() as prof, \
+                        apply_params(kwargs.pop('params', None)):
+                    outs.append(task(gdir, **kwargs))
+                profiles.append([prof.result[c] for c in PROFILE_COLUMNS])
+        finally:
+            if self.in_memory:
+                gdir.flush()
+        if self.checkpoint is not None:
+            keys = [self.checkpoint.task_key(task, kwargs)
+                    for task, kwargs in chain]
+            self.checkpoint.save(gdir, keys, outs)
+        return i, outs, profiles
+
+
+def _n_processes():
+    """The number of workers of the pool, as in ``workflow.init_mp_pool``."""
+    mpp = cfg.PARAMS['mp_processes']
+    if mpp == -1:
+        try:
+            mpp = int(os.environ['SLURM_JOB_CPUS_PER_NODE'])
+        except KeyError:
+            mpp = os.cpu_count()
+    return mpp
+
+
+def _merge_kwargs(chain, extra):
+    """The chain with ``extra`` added to the arguments of each task."""
+    if not extra:
+        return chain
+    return [(task, dict(kwargs, **extra)) for task, kwargs in chain]
+
+
+def _status_name(task, kwargs):
+    """The task name in the glacier's task log (with the file suffix)."""
+    return task.__name__ + (kwargs.get('filesuffix', '') or
+                            kwargs.get('output_filesuffix', ''))
+
+
+def _to_chain(task_list):
+    """Tasks can be given alone or as (task, kwargs) tuples."""
+    chain = []
+    for task in task_list:
+        if isinstance(task, (list, tuple)):
+            task, kwargs = task
+        else:
+            kwargs = {}
+        chain.append((task, kwargs))
+    return chain
+
+
+def _execute_chain(chain, gdirs, timings_file=None, in_memory=False,
+                   item_kwargs=None):
+    """Dispatch a chain of tasks per glacier, longest-expected-first.
+
+    With ``item_kwargs`` (one dict per item of ``gdirs``), the arguments of
+    each item are completed with its own.
+    """
+
+    if item_kwargs is None:
+        item_kwargs = [None] * len(gdirs)
+    item_chains = [_merge_kwargs(chain, extra) for extra in item_kwargs]
+    item_names = [[_status_name(task, kwargs) for task, kwargs in c]
+                  for c in item_chains]
+    # The task names of each position in the chain (they differ between
+    # the items of a sweep by their file suffix)
+    task_names = [sorted(set(names)) for names in zip(*item_names)]
+    features = gdirs_features(gdirs)
+    timings = read_timings(timings_file)
+    costs = np.zeros(len(gdirs))
+    for pos, names in enumerate(task_names):
+        for task_name in names:
+            sel = np.array([n[pos] == task_name for n in item_names])
+            pred = predict_costs(features, task_name=task_name,
+                                 timings=timings).values
+            costs[sel] += pred[sel]
+    order = np.argsort(-costs, kind='stable')
+
+    out = [None] * len(gdirs)
+    if _CHECKPOINT is not None:
+        # Skip the glaciers which are done already
+        todo = []
+        for i in order:
+            keys = [_CHECKPOINT.task_key(task, kwargs)
+                    for task, kwargs in item_chains[i]]
+            outs = _CHECKPOINT.done_outputs(gdirs[i].rgi_id, keys)
+            if outs is None:
+                todo.append(i)
+            else:
+                out[i] = outs
+        if len(todo) < len(order):
+            log.workflow('%d glaciers done already (checkpoints)',
+                         len(order) - len(todo))
+        order = todo
+    items = [(i, gdirs[i]) if item_kwargs[i] is None else
+             (i, gdirs[i], item_kwargs[i]) for i in order]
+
+    pc = _timed_chain(chain, in_memory=in_memory, checkpoint=_CHECKPOINT)
+    if _EXECUTOR is not None:
+        results = _EXECUTOR.imap_unordered(pc, items)
+    elif cfg.PARAMS['use_multiprocessing']:
+        mppool = workflow.init_mp_pool(cfg.CONFIG_MODIFIED)
+        # Admit the glaciers while their peak memory fits in the node
+        features['n_flowlines'] = [n_flowlines(gdir) for gdir in gdirs]
+        peak_rss = read_timings(timings_file, value='peak_rss_mb')
+        mem = np.zeros(len(gdirs))
+        for pos, names in enumerate(task_names):
+            for task_name in names:
+                sel = np.array([n[pos] == task_name for n in item_names])
+                pred = predict_memory(features, task_name=task_name,
+                                      peak_rss=peak_rss).values
+                mem[sel] = np.maximum(mem[sel], pred[sel])
+        results = imap_admitted(mppool, pc, items, mem[order],
+                                memory_budget(), _n_processes())
+    else:
+        results = map(pc, items)
+
+    records = []
+    for i, outs, profiles in results:
+        now = time.time()
+        out[i] = outs
+        if _CHECKPOINT is not None:
+            keys = [_CHECKPOINT.task_key(task, kwargs)
+                    for task, kwargs in item_chains[i]]
+            _CHECKPOINT.mark_done(gdirs[i].rgi_id, keys, outs)
+        for task_name, prof in zip(item_names[i], profiles):
+            records.append([gdirs[i].rgi_id, task_name] + prof + [now])
+
+    write_timings(records, path=timings_file)
+    return out
+
+
+def execute_entity_task(task, gdirs, timings_file=None, **kwargs):
+    """Same as workflow.execute_entity_task, but scheduled by expected cost.
+
+    The glaciers are dispatched longest-expected-first, one by one, to the
+    first idle worker. The wall time (and the other resources, see
+    :py:mod:`~gmd_cluster_scripts.profiling`) of each task is appended to
+    the timings file, so that the next runs can use it.
+
+    Parameters
+    ----------
+    task : function
+        the entity task to apply
+    gdirs : list of GlacierDirectory
+        the glacier directories to process
+    timings_file : str
+        where to read and write the timings (default: ``task_timings.csv``
+        in the working directory)
+    **kwargs :
+        passed to the task, except ``params`` (a
+        :py:class:`~gmd_cluster_scripts.params.ParamsContext`), which is
+        applied to ``cfg.PARAMS`` in the worker during the task
+
+    Returns
+    -------
+    the list of task outputs, in the order of ``gdirs``
+    """
+
+    gdirs = utils.tolist(gdirs)
+    if len(gdirs) == 0:
+        return []
+
+    log.workflow('Execute entity task %s on %d glaciers (cost scheduling)',
+                 task.__name__, len(gdirs))
+
+    out = _execute_chain([(task, kwargs)], gdirs, timings_file=timings_file)
+    return [o[0] for o in out]
+
+
+def execute_entity_task_sweep(task, gdirs, sweep, timings_file=None,
+                              **kwargs):
+    """Run an entity task on all glaciers, for several sets of arguments.
+
+    All (glacier, arguments) pairs are dispatched together, the most
+    expensive first, so that the configurations of a sweep run at the same
+    time instead of one after another. The arguments of each configuration
+    typically hold a :py:class:`~gmd_cluster_scripts.params.ParamsContext`
+    (``params``) and an output file suffix, which must differ between the
+    configurations. The glacier checkpoints (:py:func:`set_checkpoint`)
+    are not supported, since several workers can be busy with the same
+    glacier.
+
+    Parameters
+    ----------
+    task : function
+        the entity task to apply
+    gdirs : list of GlacierDirectory
+        the glacier directories to process
+    sweep : list of dict
+        the arguments of each configuration
+    timings_file : str
+        where to read and write the timings (default: ``task_timings.csv``
+        in the working directory)
+    **kwargs :
+        passed to the task in all configurations
+
+    Returns
+    -------
+    the list (one per configuration) of the lists of task outputs, in the
+    order of ``gdirs``
+    """
+
+    gdirs = utils.tolist(gdirs)
+    if len(gdirs) == 0 or len(sweep) == 0:
+        return [[] for _ in sweep]
+    if _CHECKPOINT is not None:
+        raise ValueError('execute_entity_task_sweep does not support the '
+                         'checkpoints')
+
+    log.workflow('Execute entity task %s on %d glaciers, %d configurations',
+                 task.__name__, len(gdirs), len(sweep))
+
+    out = _execute_chain([(task, kwargs)], gdirs * len(sweep),
+                         timings_file=timings_file,
+                         item_kwargs=[extra for extra in sweep
+                                      for _ in gdirs])
+    n = len(gdirs)
+    return [[o[0] for o in out[k*n:(k+1)*n]] for k in range(len(sweep))]
+
+
+def execute_task_chain(task_list, gdirs, timings_file=None,
+                       in_memory=False):
+    """Run a list of entity tasks as one chain per glacier.
+
+    Unlike a loop over ``execute_entity_task``, there is no barrier between
+    the tasks: each glacier goes through the whole list in one worker, while
+    the other workers are busy with other glaciers. Each task is still an
+    entity task of its own: errors are handled (or not) according to
+    ``continue_on_error`` and logged in the glacier's task log, and later
+    tasks are attempted on a failed glacier just like with a task loop.
+
+    Parameters
+    ----------
+    task_list : list
+        the entity tasks to apply, in order. Tasks which need arguments are
+        given as a ``(task, kwargs)`` tuple (``kwargs`` can hold a
+        ``params`` context, as for :py:func:`execute_entity_task`)
+    gdirs : list of GlacierDirectory
+        the glacier directories to process
+    timings_file : str
+        where to read and write the timings (default: ``task_timings.csv``
+        in the working directory)
+    in_memory : bool
+        keep the pickles written by the tasks in memory and write them to
+        disk only at the end of the chain (see
+        :py:class:`~gmd_cluster_scripts.memstore.BufferedGlacierDirectory`)
+
+    Returns
+    -------
+    a list (one per glacier, in the order of ``gdirs``) of lists of task
+    outputs
+    """
+
+    gdirs = utils.tolist(gdirs)
+    if len(gdirs) == 0:
+        return []
+
+    chain = _to_chain(task_list)
+    log.workflow('Execute task chain %s on %d glaciers',
+                 ', '.join(task.__name__ for task, _ in chain), len(gdirs))
+    return _execute_chain(chain, gdirs, timings_file=timings_file,
+                          in_memory=in_memory)
@@ -0,0 +1,292 @@
+"""Packed per-region storage of glacier directories.
+
+A region run produces one directory per glacier full of small files, and
+copying them to the shared filesystem is dominated by the inode and
+metadata cost. :py:class:`GlacierStore` keeps all the files of all glaciers
+of a region in one SQLite container, indexed by RGI id and file name:
+
+- the glacier directories are still used on the node-local disk during the
+  run (the OGGM tasks need real files), and packed into the store with
+  the :py:func:`gdir_to_store` entity task, which can run in the
+  multiprocessing pool: SQLite serializes the concurrent writers. The
+  directories can then be removed with :py:func:`delete_stored_gdirs`
+- the readers (e.g. the notebooks) get single files or whole directories
+  back without touching the other glaciers
+
+The store should be written on a local disk (SQLite locking is not reliable
+on network filesystems) and copied as one file at the end of the job, after
+:py:meth:`GlacierStore.finalize`.
+"""
+# Built ins
+import os
+import io
+import gzip
+import shutil
+import pickle
+import sqlite3
+import zlib
+import logging
+
+# External libs
+import pandas as pd
+
+# Locals
+import oggm
+import oggm.cfg as cfg
+from oggm import utils
+from oggm.utils import entity_task
+from gmd_cluster_scripts.bundle import ZLIB, _compress_dir, _member_name
+
+# Module logger
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS glaciers (
+    rgi_id TEXT PRIMARY KEY,
+    dir TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    rgi_id TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    method INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (rgi_id, relpath)
+);
+"""
+
+
+class GlacierStore(object):
+    """A region container of glacier directories.
+
+    Parameters
+    ----------
+    path : str
+        the container file
+    readonly : bool
+        open the store for reading only (it must exist)
+    timeout : float
+        how long (in seconds) a writer waits for the others to be done
+    """
+
+    def __init__(self, path, readonly=False, timeout=600.):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            uri = 'file:{}?mode=ro'.format(os.path.abspath(path))
+            self.conn = sqlite3.connect(uri, uri=True, timeout=timeout)
+        else:
+            self.conn = sqlite3.connect(path, timeout=timeout)
+            # Readers do not block the writers and vice versa
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def finalize(self):
+        """Write everything into the main file, ready to be copied."""
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+
+    def __contains__(self, rgi_id):
+        cur = self.conn.execute('SELECT 1 FROM glaciers WHERE rgi_id=?',
+                                (rgi_id,))
+        return cur.fetchone() is not None
+
+    @property
+    def rgi_ids(self):
+        cur = self.conn.execute('SELECT rgi_id FROM glaciers ORDER BY rgi_id')
+        return [r[0] for r in cur]
+
+    def list_files(self, rgi_id):
+        cur = self.conn.execute('SELECT relpath FROM files WHERE rgi_id=? '
+                                'ORDER BY relpath', (rgi_id,))
+        return [r[0] for r in cur]
+
+    def get_dir(self, rgi_id):
+        """The glacier's path relative to the ``per_glacier`` directory."""
+        cur = self.conn.execute('SELECT dir FROM glaciers WHERE rgi_id=?',
+                                (rgi_id,))
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError('{} not in store'.format(rgi_id))
+        return row[0]
+
+    def put_dir(self, rgi_id, gdir_path, base_dir):
+        """Add (or replace) a glacier directory in the store."""
+        members = _compress_dir(gdir_path)
+        with self.conn:
+            # One transaction: the readers see the old or the new directory
+            self.conn.execute('DELETE FROM files WHERE rgi_id=?', (rgi_id,))
+            self.conn.execute('INSERT OR REPLACE INTO glaciers VALUES (?, ?)',
+                              (rgi_id, os.path.relpath(gdir_path, base_dir)))
+            self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)',
+                                  [(rgi_id, relpath, method, size, data)
+                                   for relpath, data, size, method
+                                   in members])
+
+    def read_bytes(self, rgi_id, relpath):
+        """The content of one file of a glacier directory."""
+        cur = self.conn.execute('SELECT method, size, data FROM files '
+                                'WHERE rgi_id=? AND relpath=?',
+                                (rgi_id, relpath))
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError('{}: {} not in store'.format(rgi_id, relpath))
+        method, size, data = row
+        if method == ZLIB:
+            data = zlib.decompress(data)
+        assert len(data) == size
+        return bytes(data)
+
+    def has_file(self, rgi_id, filename, filesuffix=''):
+        cur = self.conn.execute('SELECT 1 FROM files WHERE rgi_id=? AND '
+                                'relpath=?',
+                                (rgi_id, _member_name(filename, filesuffix)))
+        return cur.fetchone() is not None
+
+    def read_pickle(self, rgi_id, filename, filesuffix=''):
+        """Same as GlacierDirectory.read_pickle, without extraction."""
+        data = self.read_bytes(rgi_id, _member_name(filename, filesuffix))
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        return pickle.loads(data)
+
+    def read_csv(self, rgi_id, filename, filesuffix='', **kwargs):
+        data = self.read_bytes(rgi_id, _member_name(filename, filesuffix))
+        return pd.read_csv(io.BytesIO(data), **kwargs)
+
+    def extract(self, rgi_id, base_dir=None):
+        """Extract a glacier directory.
+
+        Parameters
+        ----------
+        rgi_id : str
+            the glacier to extract
+        base_dir : str
+            the ``per_glacier`` directory to extract to (default: the one
+            of the working directory)
+
+        Returns
+        -------
+        the path to the glacier directory
+        """
+        if base_dir is None:
+            base_dir = os.path.join(cfg.PATHS['working_dir'], 'per_glacier')
+        gdir_path = os.path.join(base_dir, self.get_dir(rgi_id))
+        for relpath in self.list_files(rgi_id):
+            opath = os.path.join(gdir_path, relpath)
+            utils.mkdir(os.path.dirname(opath))
+            with open(opath, 'wb') as f:
+                f.write(self.read_bytes(rgi_id, relpath))
+        return gdir_path
+
+
+def default_store_path():
+    """The store of the current working directory."""
+    return os.path.join(cfg.PATHS['working_dir'], 'glacier_store.sqlite')
+
+
+@entity_task(log)
+def gdir_to_store(gdir, path=None):
+    """Pack a glacier directory into the region store.
+
+    The directory is left in place: the entity task logs its status there.
+    Use :py:func:`delete_stored_gdirs` afterwards to remove it.
+
+    Parameters
+    ----------
+    gdir : GlacierDirectory
+        the glacier directory to pack
+    path : str
+        the store (default: ``glacier_store.sqlite`` in the working dir)
+    """
+    if path is None:
+        path = default_store_path()
+    with GlacierStore(path) as store:
+        store.put_dir(gdir.rgi_id, gdir.dir, gdir.base_dir)
+
+
+def delete_stored_gdirs(gdirs, path=None):
+    """Delete the glacier directories which are safely in the store.
+
+    A directory is only deleted if :py:func:`gdir_to_store` succeeded on it
+    (i.e. its transaction was committed) and all its files are found in the
+    store. The others are kept and a warning is logged.
+
+    Parameters
+    ----------
+    gdirs : list of GlacierDirectory
+        the glacier directories to delete
+    path : str
+        the store (default: ``glacier_store.sqlite`` in the working dir)
+    """
+    if path is None:
+        path = default_store_path()
+    with GlacierStore(path, readonly=True) as store:
+        for gdir in utils.tolist(gdirs):
+            if not os.path.exists(gdir.dir):
+                continue
+            stored = (gdir.get_task_status('gdir_to_store') == 'SUCCESS' and
+                      gdir.rgi_id in store)
+            if stored:
+                members = set(store.list_files(gdir.rgi_id))
+                for root, _, files in os.walk(gdir.dir):
+                    for fname in files:
+                        relpath = os.path.relpath(os.path.join(root, fname),
+                                                  gdir.dir)
+                        # The log is written again after packing
+                        if relpath != 'log.txt' and relpath not in members:
+                            stored = False
+            if stored:
+                shutil.rmtree(gdir.dir)
+            else:
+                log.warning('(%s) not in the store, keeping its directory',
+                            gdir.rgi_id)
+
+
+def init_glacier_regions_from_store(rgidf, path=None, reset=False):
+    """Initialize the glacier directories of ``rgidf`` from a store.
+
+    Parameters
+    ----------
+    rgidf : GeoDataFrame or list of str
+        the glaciers to initialize
+    path : str
+        the store (default: ``glacier_store.sqlite`` in the working dir)
+    reset : bool
+        extract the directories even if they already exist
+
+    Returns
+    -------
+    the list of glacier directories
+    """
+
+    if path is None:
+        path = default_store_path()
+    if hasattr(rgidf, 'RGIId'):
+        rgi_ids = rgidf.RGIId.values
+    else:
+        rgi_ids = utils.tolist(rgidf)
+
+    base_dir = os.path.join(cfg.PATHS['working_dir'], 'per_glacier')
+    gdirs = []
+    with GlacierStore(path, readonly=True) as store:
+        for rgi_id in rgi_ids:
+            if rgi_id not in store:
+                log.warning('%s is not in %s', rgi_id, path)
+                continue
+            gdir_path = os.path.join(base_dir, store.get_dir(rgi_id))
+            if reset or not os.path.exists(gdir_path):
+                store.extract(rgi_id, base_dir=base_dir)
+            gdirs.append(oggm.GlacierDirectory(rgi_id, base_dir=base_dir))
+    return gdirs
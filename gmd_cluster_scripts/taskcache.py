@@ -0,0 +1,293 @@
+"""Content-hash cache for entity tasks.
+
+Fixing one experiment meant rerunning whole regions with
+``auto_skip_task = False``, since OGGM only knows whether a task has already
+run, not whether its inputs changed since. :py:class:`cached_task` wraps an
+entity task and keys its outputs by a hash of:
+
+- the content of the task's input files in the glacier directory (see
+  :py:data:`TASK_INPUTS`; for undeclared tasks, all files except the
+  task's own outputs, see below)
+- the ``cfg.PARAMS`` values which the task depends on (all of them for
+  undeclared tasks)
+- the task's keyword arguments
+- the OGGM version and the source file of the task, so that a code update
+  invalidates the cache
+
+The files which the task creates, modifies or deletes are its outputs: their
+hashes after the run are recorded, and their content is stored in the cache
+as well. At the next call with the same arguments, the task is skipped if
+the inputs hash is unchanged: the outputs which are missing or were modified
+since are copied back from the cache into the glacier directory. For tasks
+which read and rewrite the same file (e.g. ``filter_inversion_output``), a
+modification of that file changes the inputs hash, and the task is run
+again.
+
+The records are stored in one file per glacier, which is only accessed by
+the worker processing that glacier and replaced atomically, so that the cache
+stays consistent with parallel workers and killed jobs. The output files are
+stored by content hash, and written atomically too. All of it has to live on
+a disk shared by the jobs (``TASK_CACHE_DIR`` environment variable) to be of
+any use: the working directories on the nodes are wiped after each job.
+"""
+# Built ins
+import os
+import json
+import inspect
+import shutil
+import fnmatch
+import pickle
+import hashlib
+import logging
+
+# Locals
+import oggm
+import oggm.cfg as cfg
+from oggm import utils
+
+# Module logger
+log = logging.getLogger(__name__)
+
+# Files of the glacier directory which are not task inputs
+IGNORE_FILES = ['log.txt']
+
+# Parameters which have no influence on the task results
+IGNORE_PARAMS = ['use_multiprocessing', 'mp_processes', 'continue_on_error',
+                 'auto_skip_task']
+
+# The input files (glob patterns relative to the glacier directory) and the
+# parameters of the cached tasks. A file or parameter missing here would
+# make the cache return stale results: when unsure, leave the task out, all
+# the files and parameters are then hashed.
+TASK_INPUTS = {
+    'run_random_climate': (['model_flowlines.pkl', 'inversion_params.pkl',
+                            'local_mustar.csv', 'climate_monthly*.nc',
+                            'climate_info.pkl'],
+                           ['temp_all_solid', 'temp_all_liq', 'temp_melt',
+                            'prcp_scaling_factor', 'temp_default_gradient',
+                            'temp_use_local_gradient',
+                            'temp_local_gradient_bounds', 'use_bias_for_run',
+                            'use_optimized_inversion_params', 'flowline_fs',
+                            'flowline_glen_a', 'trapezoid_lambdas',
+                            'mixed_min_shape', 'ys', 'ye']),
+}
+
+
+def _file_sha1(path, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _hash_obj(obj):
+    s = json.dumps(obj, sort_keys=True, default=repr)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def dir_manifest(path, previous=None):
+    """The content hashes of all files in a directory.
+
+    Hashes are reused from ``previous`` for the files whose size and
+    modification time did not change.
+
+    Returns
+    -------
+    a dict of {relative path: (size, mtime_ns, sha1)}
+    """
+    previous = previous or dict()
+    out = dict()
+    for root, _, files in os.walk(path):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            rpath = os.path.relpath(fpath, path)
+            if rpath in IGNORE_FILES:
+                continue
+            st = os.stat(fpath)
+            prev = previous.get(rpath)
+            if prev is not None and prev[:2] == (st.st_size, st.st_mtime_ns):
+                out[rpath] = prev
+            else:
+                out[rpath] = (st.st_size, st.st_mtime_ns, _file_sha1(fpath))
+    return out
+
+
+def params_hash(keys=None):
+    """Hash of the current ``cfg.PARAMS``.
+
+    Parameters
+    ----------
+    keys : list of str
+        the parameters to hash (default: all but the irrelevant ones)
+    """
+    if keys is None:
+        keys = [k for k in cfg.PARAMS if k not in IGNORE_PARAMS]
+    return _hash_obj({k: cfg.PARAMS.get(k) for k in keys})
+
+
+def _source_hash(task):
+    """Hash of the source file defining the task (and its helpers)."""
+    func = inspect.unwrap(task)
+    try:
+        return _file_sha1(inspect.getsourcefile(func))
+    except (TypeError, OSError):
+        return repr(func)
+
+
+def _inputs_hash(manifest, outputs, task_key, inputs=None, params=None):
+    if inputs is None:
+        files = [(f, m[2]) for f, m in manifest.items() if f not in outputs]
+    else:
+        files = [(f, m[2]) for f, m in manifest.items()
+                 if any(fnmatch.fnmatch(f, pat) for pat in inputs)]
+    return _hash_obj([task_key, params_hash(params), sorted(files)])
+
+
+class cached_task(object):
+    """Wraps an entity task so that it is skipped when nothing changed.
+
+    Parameters
+    ----------
+    task : function
+        the entity task to wrap
+    inputs : list of str
+        the input files of the task, as glob patterns relative to the glacier
+        directory (default: from :py:data:`TASK_INPUTS`, all files if the
+        task is not listed there)
+    params : list of str
+        the ``cfg.PARAMS`` the task depends on (default: from
+        :py:data:`TASK_INPUTS`, all parameters if the task is not listed)
+    cache_dir : str
+        where to store the records and output files (default: the
+        ``TASK_CACHE_DIR`` environment variable, ``task_cache`` in the
+        working directory if not set). They are outside of the glacier
+        directories, so that they survive a re-extraction of the
+        directories.
+    """
+
+    def __init__(self, task, inputs=None, params=None, cache_dir=None):
+        self.task = task
+        self.__name__ = task.__name__
+        def_inputs, def_params = TASK_INPUTS.get(self.__name__, (None, None))
+        self.inputs = def_inputs if inputs is None else inputs
+        self.params = def_params if params is None else params
+        self.cache_dir = cache_dir
+        self.source_hash = _source_hash(task)
+
+    def _cache_dir(self):
+        cache_dir = self.cache_dir or os.environ.get('TASK_CACHE_DIR')
+        if not cache_dir:
+            cache_dir = os.path.join(cfg.PATHS['working_dir'], 'task_cache')
+        utils.mkdir(cache_dir)
+        return cache_dir
+
+    def _record_path(self, gdir):
+        return os.path.join(self._cache_dir(), gdir.rgi_id + '.pkl')
+
+    def _object_path(self, sha):
+        return os.path.join(self._cache_dir(), 'objects', sha[:2], sha)
+
+    def _store_outputs(self, gdir, outputs):
+        """Copy the output files of the task to the cache."""
+        for f, sha in outputs.items():
+            if sha is None:
+                continue
+            path = self._object_path(sha)
+            if os.path.exists(path):
+                continue
+            utils.mkdir(os.path.dirname(path))
+            tmp = path + '.tmp{}'.format(os.getpid())
+            shutil.copyfile(os.path.join(gdir.dir, f), tmp)
+            os.replace(tmp, path)
+
+    def _restore_outputs(self, gdir, outputs, manifest):
+        """Bring the outputs of the task back into the glacier directory.
+
+        Returns
+        -------
+        False if some output files are missing from the cache (nothing is
+        restored then)
+        """
+        for f, sha in outputs.items():
+            if sha is not None and not os.path.exists(self._object_path(sha)):
+                return False
+        for f, sha in outputs.items():
+            current = manifest.get(f)
+            path = os.path.join(gdir.dir, f)
+            if sha is None:
+                if current is not None:
+                    os.remove(path)
+            elif current is None or current[2] != sha:
+                utils.mkdir(os.path.dirname(path))
+                shutil.copyfile(self._object_path(sha), path)
+        return True
+
+    def _read_records(self, gdir):
+        path = self._record_path(gdir)
+        if not os.path.exists(path):
+            return dict()
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            log.warning('(%s) unreadable task cache, ignoring it', gdir.rgi_id)
+            return dict()
+
+    def _write_records(self, gdir, records):
+        path = self._record_path(gdir)
+        tmp = path + '.tmp{}'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(records, f, protocol=-1)
+        os.replace(tmp, path)
+
+    def __call__(self, gdir, **kwargs):
+
+        task_key = [self.__name__, _hash_obj(kwargs), oggm.__version__,
+                    self.source_hash]
+        rec_key = tuple(task_key)
+        records = self._read_records(gdir)
+        manifest = dir_manifest(gdir.dir, records.get('manifest'))
+
+        # Same as the task name logged by the entity task
+        status_name = self.__name__ + (kwargs.get('filesuffix', '') or
+                                       kwargs.get('output_filesuffix', ''))
+
+        entry = records.get(rec_key)
+        if entry is not None:
+            ok = entry['inputs_hash'] == _inputs_hash(manifest,
+                                                      entry['outputs'],
+                                                      task_key,
+                                                      inputs=self.inputs,
+                                                      params=self.params)
+            if ok and self._restore_outputs(gdir, entry['outputs'],
+                                            manifest):
+                log.info('(%s) %s: inputs unchanged, skipping', gdir.rgi_id,
+                         self.__name__)
+                gdir.log(status_name)
+                return entry['result']
+
+        out = self.task(gdir, **kwargs)
+        if gdir.get_task_status(status_name) != 'SUCCESS':
+            # Never cache failures
+            records.pop(rec_key, None)
+            self._write_records(gdir, records)
+            return out
+
+        new_manifest = dir_manifest(gdir.dir, manifest)
+        outputs = dict()
+        for f in set(manifest) | set(new_manifest):
+            before = manifest.get(f)
+            after = new_manifest.get(f)
+            if before is None or after is None or before[2] != after[2]:
+                outputs[f] = after[2] if after else None
+
+        records[rec_key] = dict(inputs_hash=_inputs_hash(manifest, outputs,
+                                                         task_key,
+                                                         inputs=self.inputs,
+                                                         params=self.params),
+                                outputs=outputs, result=out)
+        self._store_outputs(gdir, outputs)
+        records['manifest'] = new_manifest
+        self._write_records(gdir, records)
+        return out